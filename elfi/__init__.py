@@ -20,6 +20,7 @@ from elfi.model.extensions import ScipyLikeDistribution as Distribution
 from elfi.store import OutputPool, ArrayPool
 from elfi.visualization.visualization import nx_draw as draw
 from elfi.visualization.visualization import plot_params_vs_node
+from elfi.methods.bo.gp_regression import GPRegression, SparseGPRegression
 from elfi.methods.bo.gpy_regression import GPyRegression
 
 __author__ = 'ELFI authors'
@@ -1,15 +1,24 @@
 """This module contains the base client API and batch handler."""
 
+import asyncio
+import hashlib
 import importlib
 import logging
+import os
+import pickle
+import time
+import weakref
 from collections import OrderedDict
-from types import ModuleType
+from functools import partial
+from math import ceil
+from types import FunctionType, MethodType, ModuleType
 
 import networkx as nx
+import numpy as np
 
 from elfi.compiler import (AdditionalNodesCompiler, ObservedCompiler,
                            OutputCompiler, RandomStateCompiler, ReduceCompiler)
-from elfi.executor import Executor
+from elfi.executor import BatchOverlay, ExecutionPlan, Executor
 from elfi.loader import AdditionalNodesLoader, ObservedLoader, PoolLoader, RandomStateLoader
 
 logger = logging.getLogger(__name__)
@@ -35,7 +44,8 @@ def set_client(client=None, **kwargs):
     ----------
     client : ClientBase or str
         Instance of a client from ClientBase,
-        or a string from ['native', 'multiprocessing', 'ipyparallel'].
+        or a string from ['native', 'multiprocessing', 'threading', 'asyncio',
+        'ipyparallel'].
         If string, the respective constructor is called with `kwargs`.
 
     """
@@ -56,10 +66,36 @@ def set_default_class(class_or_module):
     _default_class = class_or_module
 
 
+def run_chunk(calls):
+    """Run a chunk of calls in a worker.
+
+    Parameters
+    ----------
+    calls : list
+        Tuples of `(kallable, args, kwargs)`.
+
+    Returns
+    -------
+    results : list
+    elapsed : float
+        Time in seconds spent in the calls.
+
+    """
+    start = time.time()
+    results = [kallable(*args, **kwargs) for kallable, args, kwargs in calls]
+    return results, time.time() - start
+
+
 class BatchHandler:
     """Responsible for sending computational graphs to be executed in an Executor."""
 
-    def __init__(self, model, context, output_names=None, client=None):
+    # Target ratio of the client latency to the computation time of a chunk in automatic
+    # chunk sizing
+    chunk_latency_ratio = .1
+    max_chunk_size = 100
+
+    def __init__(self, model, context, output_names=None, client=None, chunk_size=1,
+                 cache=False):
         """Compile the computational graph and associate it with a context etc.
 
         Parameters
@@ -68,26 +104,56 @@ class BatchHandler:
         context : ComputationContext
         output_names : list of str, optional
         client : Client, optional
+        chunk_size : int or str, optional
+            Number of consecutive batches packed into a single task of the client. With
+            'auto' the size is tuned from the computation time of the batches in the workers
+            versus the latency of the client. Default 1 sends each batch as its own task.
+        cache : bool, optional
+            Whether to share the compiled net with other handlers of identical models, see
+            `CompileCache`.
 
         """
         client = client or get_client()
 
-        self.compiled_net = client.compile(model.source_net, output_names)
+        if chunk_size != 'auto' and (not isinstance(chunk_size, int) or chunk_size < 1):
+            raise ValueError("chunk_size must be a positive integer or 'auto'")
+
+        self.compiled_net = client.compile(model.source_net, output_names, cache=cache)
         self.context = context
         self.client = client
+        self.chunk_size = chunk_size
 
         self._next_batch_index = 0
         self._pending_batches = OrderedDict()
 
-    def has_ready(self, any=False):
-        """Check if the next batch in succession is ready."""
+        # Indices of the batches received ahead of a pending batch, see `wait_any`
+        self._received_ahead = set()
+
+        # Chunks waiting to be sent and sent chunks by their task ids
+        self._chunk = []
+        self._chunks = {}
+
+        # Statistics for the automatic chunk size
+        self._auto_chunk_size = 1
+        self._latency = None
+        self._batch_time = 0
+        self._n_timed = 0
+
+    def has_ready(self, any_batch=False):
+        """Check if the next batch in succession, or with `any_batch` any pending batch, is ready.
+
+        Parameters
+        ----------
+        any_batch : bool, optional
+
+        """
         if len(self._pending_batches) == 0:
             return False
 
         for bi, id in self._pending_batches.items():
-            if self.client.is_ready(id):
+            if self._is_ready(id):
                 return True
-            if not any:
+            if not any_batch:
                 break
         return False
 
@@ -121,31 +187,58 @@ class BatchHandler:
         """Return the keys to pending batches."""
         return self._pending_batches.keys()
 
-    def cancel_pending(self):
-        """Cancel all pending batches.
+    @property
+    def current_chunk_size(self):
+        """Return the number of batches currently packed into a single task."""
+        if self.chunk_size == 'auto':
+            return self._auto_chunk_size
+        return self.chunk_size
+
+    def cancel_pending(self, from_index=None):
+        """Cancel all pending batches, or the pending batches from `from_index` on.
 
-        Sets the next batch_index to the index of the last cancelled.
+        Sets the next batch_index to the lowest index of the cancelled batches.
 
-        Note that we rely here on the assumption that batches are processed in order.
+        If batches have been received out of order (see `wait_any`), the indices of the
+        received batches above it are skipped when submitting new batches, so that every
+        index is received exactly once.
+
+        Parameters
+        ----------
+        from_index : int, optional
 
         """
-        for batch_index, id in reversed(list(self._pending_batches.items())):
-            if batch_index != self._next_batch_index - 1:
-                raise ValueError('Batches are not in order')
+        cancelled = [batch_index for batch_index in self._pending_batches
+                     if from_index is None or batch_index >= from_index]
+        if not cancelled:
+            return
 
+        for batch_index in reversed(cancelled):
             logger.debug('Cancelling batch {}'.format(batch_index))
-            self.client.remove_task(id)
-            self._pending_batches.pop(batch_index)
-            self._next_batch_index = batch_index
+            id = self._pending_batches.pop(batch_index)
+            if id in self._chunks:
+                self._cancel_chunk_batch(id, batch_index)
+            elif id is not None:
+                self.client.remove_task(id)
+        lowest = min(cancelled)
+        self._chunk = [(i, net) for i, net in self._chunk if i < lowest]
+
+        self._received_ahead = set(i for i in self._received_ahead if i > lowest)
+        self._next_batch_index = lowest
+        self._skip_received()
 
     def reset(self):
         """Cancel all pending batches and set the next index to 0."""
         self.cancel_pending()
+        self._received_ahead.clear()
         self._next_batch_index = 0
 
     def submit(self, batch=None):
         """Submit a batch with a batch index given by `next_index`.
 
+        With chunking, the batch is sent when the chunk is full or when a result is waited
+        for, see `flush`.
+
         Parameters
         ----------
         batch : dict
@@ -159,26 +252,116 @@ class BatchHandler:
         loaded_net = self.client.load_data(self.compiled_net, self.context, batch_index)
         # Override
         for k, v in batch.items():
-            loaded_net.node[k] = {'output': v}
+            loaded_net.set_output(k, v)
 
-        task_id = self.client.submit(loaded_net)
-        self._pending_batches[batch_index] = task_id
+        if self.chunk_size == 1:
+            task_id = self.client.submit(loaded_net)
+            self._pending_batches[batch_index] = task_id
+        else:
+            self._pending_batches[batch_index] = None
+            self._chunk.append((batch_index, loaded_net))
+            if len(self._chunk) >= self.current_chunk_size:
+                self.flush()
 
         # Update counters
         self._next_batch_index += 1
+        self._skip_received()
         self.context.num_submissions += 1
 
+    def flush(self):
+        """Send the batches waiting for their chunk to fill up as a single task."""
+        if not self._chunk:
+            return
+
+        indices, loaded_nets = zip(*self._chunk)
+        self._chunk = []
+
+        logger.debug('Sending batches {}-{} in a chunk'.format(indices[0], indices[-1]))
+        task_id = self.client.submit_chunk(list(loaded_nets))
+        for batch_index in indices:
+            self._pending_batches[batch_index] = task_id
+        self._chunks[task_id] = dict(
+            indices=list(indices), n_pending=len(indices), results=None, submitted=time.time())
+
     def wait_next(self):
         """Wait for the next batch in succession."""
         if len(self._pending_batches) == 0:
             raise ValueError('Cannot wait for a batch, no batches currently submitted')
 
-        batch_index, task_id = self._pending_batches.popitem(last=False)
-        batch = self.client.get_result(task_id)
-        logger.debug('Received batch {}'.format(batch_index))
+        batch_index, task_id = next(iter(self._pending_batches.items()))
+        if task_id is None:
+            self.flush()
+        return self._receive(batch_index)
 
-        self.context.callback(batch, batch_index)
-        return batch, batch_index
+    def wait_any(self):
+        """Wait for any pending batch to complete.
+
+        Unlike `wait_next`, returns whichever batch completes first, so that a slow batch
+        does not stall the processing of the batches after it. Use this only if the
+        results do not depend on the order in which the batches are processed.
+
+        Returns
+        -------
+        batch : dict
+        batch_index : int
+
+        """
+        if len(self._pending_batches) == 0:
+            raise ValueError('Cannot wait for a batch, no batches currently submitted')
+
+        self.flush()
+        while True:
+            for batch_index, task_id in self._pending_batches.items():
+                if self._is_ready(task_id):
+                    return self._receive(batch_index)
+            self.client.wait_any(set(self._pending_batches.values()))
+
+    async def await_next(self):
+        """Wait for the next batch in succession without blocking the event loop.
+
+        Asynchronous version of `wait_next`.
+
+        Returns
+        -------
+        batch : dict
+        batch_index : int
+
+        """
+        if len(self._pending_batches) == 0:
+            raise ValueError('Cannot wait for a batch, no batches currently submitted')
+
+        batch_index, task_id = next(iter(self._pending_batches.items()))
+        if task_id is None:
+            self.flush()
+            task_id = self._pending_batches[batch_index]
+        await self._wait_ready(task_id)
+        return self._receive(batch_index)
+
+    async def await_any(self):
+        """Wait for any pending batch to complete without blocking the event loop.
+
+        Asynchronous version of `wait_any`.
+
+        Returns
+        -------
+        batch : dict
+        batch_index : int
+
+        """
+        if len(self._pending_batches) == 0:
+            raise ValueError('Cannot wait for a batch, no batches currently submitted')
+
+        self.flush()
+        while True:
+            for batch_index, task_id in self._pending_batches.items():
+                if self._is_ready(task_id):
+                    return self._receive(batch_index)
+
+            waiters = [asyncio.ensure_future(self._wait_ready(task_id))
+                       for task_id in set(self._pending_batches.values())]
+            done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
 
     def compute(self, batch_index=0):
         """Blocking call to compute a batch from the model."""
@@ -190,10 +373,395 @@ class BatchHandler:
         """Return the number of processes."""
         return self.client.num_cores
 
+    def _receive(self, batch_index):
+        """Return the pending batch `batch_index` waiting for it if necessary."""
+        task_id = self._pending_batches.pop(batch_index)
+        if not self._pending_batches:
+            self._received_ahead = set(
+                i for i in self._received_ahead if i >= self._next_batch_index)
+        elif batch_index > next(iter(self._pending_batches)):
+            self._received_ahead.add(batch_index)
+        if task_id in self._chunks:
+            batch = self._receive_chunk_batch(task_id, batch_index)
+        else:
+            batch = self.client.get_result(task_id)
+        logger.debug('Received batch {}'.format(batch_index))
+
+        self.context.callback(batch, batch_index)
+        return batch, batch_index
+
+    def _skip_received(self):
+        """Advance the next index past the batches already received."""
+        while self._next_batch_index in self._received_ahead:
+            self._received_ahead.remove(self._next_batch_index)
+            self._next_batch_index += 1
+
+    def _is_ready(self, task_id):
+        if task_id is None:
+            return False
+        if task_id in self._chunks and self._chunks[task_id]['results'] is not None:
+            return True
+        return self.client.is_ready(task_id)
+
+    async def _wait_ready(self, task_id):
+        if not self._is_ready(task_id):
+            await self.client.wait_ready(task_id)
+
+    def _receive_chunk_batch(self, task_id, batch_index):
+        chunk = self._chunks[task_id]
+        if chunk['results'] is None:
+            results, elapsed = self.client.get_result(task_id)
+            chunk['results'] = dict(zip(chunk['indices'], results))
+            self._update_chunk_size(time.time() - chunk['submitted'], elapsed, len(results))
+
+        chunk['n_pending'] -= 1
+        batch = chunk['results'].pop(batch_index)
+        if chunk['n_pending'] == 0:
+            del self._chunks[task_id]
+        return batch
+
+    def _cancel_chunk_batch(self, task_id, batch_index):
+        chunk = self._chunks[task_id]
+        chunk['n_pending'] -= 1
+        if chunk['n_pending'] == 0:
+            if chunk['results'] is None:
+                self.client.remove_task(task_id)
+            del self._chunks[task_id]
+
+    def _update_chunk_size(self, wall_time, elapsed, n_batches):
+        """Tune the automatic chunk size with the timing of a received chunk.
+
+        The smallest observed difference between the wall time and the computation time of
+        a chunk estimates the latency of the client, as it excludes the time the chunks
+        spend waiting in queue. The chunk size is chosen so that this latency is at most
+        `chunk_latency_ratio` of the computation time of a chunk.
+        """
+        latency = max(wall_time - elapsed, 0)
+        self._latency = latency if self._latency is None else min(self._latency, latency)
+        self._batch_time += elapsed
+        self._n_timed += n_batches
+
+        batch_time = self._batch_time / self._n_timed
+        if batch_time > 0:
+            size = ceil(self._latency / (self.chunk_latency_ratio * batch_time))
+        else:
+            size = self.max_chunk_size
+        self._auto_chunk_size = int(min(max(size, 1), self.max_chunk_size))
+        logger.debug('Chunk size set to {}'.format(self._auto_chunk_size))
+
+
+class PlanRegistry:
+    """Submit batches to workers that cache the execution plans.
+
+    The execution plan of a compiled net, including its operations and the observed data, is
+    identified by a content hash. The batches carry only their own data, i.e. the batch
+    index, seed and overriding values, and the plan is delivered to the workers in one of
+    the following ways:
+
+    - with `directory`, the plan is written to a file that the workers load when they do
+      not have the plan cached. The batches carry only the path of the file.
+    - with `broadcast`, the plan is sent to all workers when it is first seen.
+    - the plan is sent with the first `n_sends` batches.
+
+    If a worker still does not have the plan cached, the plan is delivered again with
+    `broadcast` if given and the batch is computed again with the plan included.
+
+    See `Executor.execute_cached`.
+    """
+
+    def __init__(self, n_sends=0, broadcast=None, directory=None, dumps=None):
+        """Create a registry.
+
+        Parameters
+        ----------
+        n_sends : int, optional
+            How many first batches of each plan include the plan.
+        broadcast : callable, optional
+            Called as `broadcast(key, payload)` with new plans and their pickles to send
+            them to all workers.
+        directory : str, optional
+            Directory shared with the workers for the files of the plans.
+        dumps : callable, optional
+            Serializer of the plans used by the client, e.g. `cloudpickle.dumps`. The
+            workers load the plans with `pickle.loads`. Defaults to `pickle.dumps`.
+
+        """
+        self.n_sends = n_sends
+        self.broadcast = broadcast
+        self.directory = directory
+        self.dumps = dumps or partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._plans = weakref.WeakKeyDictionary()
+        self._n_sent = {}
+        self._batches = {}
+
+    def register(self, plan):
+        """Return the content hash and the pickle of `plan`.
+
+        Parameters
+        ----------
+        plan : ExecutionPlan
+
+        Returns
+        -------
+        key : str
+        payload : bytes
+
+        """
+        if plan not in self._plans:
+            payload = self.dumps(plan)
+            key = hashlib.sha1(payload).hexdigest()
+            self._plans[plan] = (key, payload)
+
+            if key not in self._n_sent:
+                self._n_sent[key] = 0
+                if self.directory is not None:
+                    with open(self._path(key), 'wb') as f:
+                        f.write(payload)
+                if self.broadcast is not None:
+                    self.broadcast(key, payload)
+
+        return self._plans[plan]
+
+    def submit(self, client, loaded_net):
+        """Submit `loaded_net` to `client` and return the task id.
+
+        Parameters
+        ----------
+        client : ClientBase
+        loaded_net : BatchOverlay
+
+        """
+        args, kwargs, payload = self._prepare(loaded_net)
+        task_id = client.apply(Executor.execute_cached, *args, **kwargs)
+        self._batches[task_id] = (args, payload)
+        return task_id
+
+    def submit_chunk(self, client, loaded_nets):
+        """Submit `loaded_nets` to `client` as a single task and return the task id.
+
+        Parameters
+        ----------
+        client : ClientBase
+        loaded_nets : list of BatchOverlay
+
+        """
+        calls = []
+        batches = []
+        for loaded_net in loaded_nets:
+            args, kwargs, payload = self._prepare(loaded_net)
+            calls.append((Executor.execute_cached, args, kwargs))
+            batches.append((args, payload))
+
+        task_id = client.apply(run_chunk, calls)
+        self._batches[task_id] = batches
+        return task_id
+
+    def resolve(self, client, task_id, result):
+        """Return the result of the task `task_id` computing batches again if necessary.
+
+        Parameters
+        ----------
+        client : ClientBase
+        task_id : int
+        result
+            The result received from the worker.
+
+        """
+        batch = self._batches.pop(task_id, None)
+        if batch is None:
+            return result
+        elif isinstance(batch, list):
+            results, elapsed = result
+            results = [self._resolve(client, b, r) for b, r in zip(batch, results)]
+            return results, elapsed
+        return self._resolve(client, batch, result)
+
+    def _prepare(self, loaded_net):
+        key, payload = self.register(loaded_net.plan)
+        args = (key, loaded_net.outputs, loaded_net.batch_data(), loaded_net.operations)
+
+        kwargs = {}
+        if self.directory is not None:
+            kwargs['plan'] = self._path(key)
+        elif self._n_sent[key] < self.n_sends:
+            kwargs['plan'] = payload
+            self._n_sent[key] += 1
+        return args, kwargs, payload
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.plan'.format(key))
+
+    def _resolve(self, client, batch, result):
+        if result is None:
+            args, payload = batch
+            logger.debug('Plan {} was not cached in the worker, resending'.format(args[0]))
+            if self.broadcast is not None:
+                self.broadcast(args[0], payload)
+            result = client.apply_sync(Executor.execute_cached, *args, plan=payload)
+        return result
+
+    def discard(self, task_id):
+        """Forget the batch `task_id`."""
+        self._batches.pop(task_id, None)
+
+    def clear(self):
+        """Forget all batches and the plans sent to the workers."""
+        self._batches.clear()
+        self._n_sent.clear()
+        self._plans = weakref.WeakKeyDictionary()
+
+
+class CompileCache:
+    """Share the compiled nets of structurally identical source nets.
+
+    The key of a compilation consists of the requested outputs and the nodes, edges and
+    observed data of the source net in their order. The values in the node states are
+    compared by their contents if they are scalars, strings, NumPy arrays or containers of
+    such, structurally if they are partials, bound methods or closures, and otherwise by
+    their identity. The cache keeps references to the objects compared by identity, so that
+    their ids are not reused while the compilation is cached. The name of the model is
+    compared only if its nodes use the meta information, which includes the name.
+
+    A source net thus hits the cache if it is a copy of a compiled one, e.g. the copy of
+    the model in every `ParameterInference`, unless its nodes have been replaced or
+    modified since. Changes inside the objects compared by identity, e.g. the attributes of
+    a simulator object, are not seen. The caching is therefore opt-in, see
+    `ClientBase.compile`, and meant for operations that are deterministic given their
+    inputs and are not modified while in use. The users of a cached compilation also share
+    its memoized batch invariant outputs, see `ExecutionPlan`.
+
+    The compiled nets are referenced weakly, so a compilation stays cached only while it
+    is in use, e.g. by an inference. At most `max_size` compilations are kept, dropping the
+    least recently used.
+    """
+
+    # Depth of the nested values compared by their contents
+    max_depth = 8
+
+    def __init__(self, max_size=64):
+        """Create a cache.
+
+        Parameters
+        ----------
+        max_size : int, optional
+            Number of compiled nets to keep.
+
+        """
+        self.max_size = max_size
+        self._nets = OrderedDict()
+
+    def get(self, source_net, outputs, compile):
+        """Return the compiled net of `source_net` calling `compile()` if not cached.
+
+        Parameters
+        ----------
+        source_net : nx.DiGraph
+        outputs : list
+        compile : callable
+
+        Returns
+        -------
+        compiled_net : nx.DiGraph
+
+        """
+        refs = []
+        key = self.key(source_net, outputs, refs)
+
+        if key in self._nets:
+            compiled_net = self._nets[key][0]()
+            if compiled_net is not None:
+                self._nets.move_to_end(key)
+                return compiled_net
+
+        compiled_net = compile()
+        self._nets[key] = (weakref.ref(compiled_net, partial(self._drop, key)), refs)
+        self._nets.move_to_end(key)
+        if len(self._nets) > self.max_size:
+            self._nets.popitem(last=False)
+        return compiled_net
+
+    def clear(self):
+        """Drop all the compiled nets."""
+        self._nets.clear()
+
+    def _drop(self, key, ref):
+        """Drop the compilation `key` when its compiled net `ref` is garbage collected."""
+        entry = self._nets.get(key)
+        if entry is not None and entry[0] is ref:
+            self._nets.pop(key, None)
+
+    def __len__(self):
+        """Return the number of cached compiled nets."""
+        return len(self._nets)
+
+    @classmethod
+    def key(cls, source_net, outputs, refs):
+        """Return the key of the compilation and append the compared objects to `refs`."""
+        nodes = tuple((name, cls._fingerprint(state, refs))
+                      for name, state in source_net.nodes_iter(data=True))
+        edges = tuple((parent, child, cls._fingerprint(data, refs))
+                      for parent, child, data in source_net.edges_iter(data=True))
+        observed = cls._fingerprint(source_net.graph['observed'], refs)
+
+        uses_meta = any(state.get('_uses_meta') for _, state in source_net.nodes_iter(data=True))
+        name = source_net.graph['name'] if uses_meta else None
+        return tuple(outputs), nodes, edges, observed, name
+
+    @classmethod
+    def _fingerprint(cls, value, refs, depth=0):
+        if depth > cls.max_depth:
+            refs.append(value)
+            return id(value)
+
+        depth += 1
+        if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+            # Include the type, since e.g. 1 == 1.0 == True
+            return type(value), value
+        elif isinstance(value, (tuple, list)):
+            return type(value), tuple(cls._fingerprint(v, refs, depth) for v in value)
+        elif isinstance(value, dict):
+            return dict, tuple((k, cls._fingerprint(v, refs, depth)) for k, v in value.items())
+        elif isinstance(value, partial):
+            return (partial, cls._fingerprint(value.func, refs, depth),
+                    cls._fingerprint(value.args, refs, depth),
+                    cls._fingerprint(value.keywords or {}, refs, depth))
+        elif isinstance(value, (np.ndarray, np.generic)):
+            value = np.asarray(value)
+            if value.dtype.hasobject:
+                return np.ndarray, value.shape, cls._fingerprint(value.tolist(), refs, depth)
+            # Hash the contents, so that a modified or a reallocated array does not match
+            digest = hashlib.sha1(value.tobytes()).hexdigest()
+            return np.ndarray, value.dtype, value.shape, digest
+        elif isinstance(value, MethodType):
+            return (MethodType, cls._fingerprint(value.__self__, refs, depth),
+                    cls._fingerprint(value.__func__, refs, depth))
+        elif isinstance(value, FunctionType) and value.__closure__:
+            refs.append(value)
+            try:
+                cells = [c.cell_contents for c in value.__closure__]
+            except ValueError:
+                # An empty cell
+                return id(value)
+            refs.extend([value.__code__, value.__globals__])
+            return (FunctionType, id(value.__code__), id(value.__globals__),
+                    cls._fingerprint(value.__defaults__, refs, depth),
+                    cls._fingerprint(value.__kwdefaults__, refs, depth),
+                    cls._fingerprint(cells, refs, depth))
+
+        refs.append(value)
+        return id(value)
+
 
 class ClientBase:
     """Client api for serving multiple simultaneous inferences."""
 
+    # Seconds between checks for a completed task in `wait_ready` and `wait_any`
+    poll_interval = .001
+
+    # Compilations shared by all the clients while they are in use, if requested
+    compile_cache = CompileCache()
+
     def apply(self, kallable, *args, **kwargs):
         """Add `kallable(*args, **kwargs)` to the queue of tasks and return immediately.
 
@@ -250,6 +818,35 @@ class ClientBase:
         """
         raise NotImplementedError
 
+    async def wait_ready(self, task_id):
+        """Wait until the task `task_id` is ready without blocking the event loop.
+
+        The default implementation polls `is_ready`. Clients that are notified of completed
+        tasks should override this.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        while not self.is_ready(task_id):
+            await asyncio.sleep(self.poll_interval)
+
+    def wait_any(self, task_ids):
+        """Block until any of the tasks `task_ids` is ready.
+
+        The default implementation polls `is_ready`. Clients that are notified of completed
+        tasks should override this.
+
+        Parameters
+        ----------
+        task_ids : iterable of int
+
+        """
+        task_ids = list(task_ids)
+        while not any(self.is_ready(task_id) for task_id in task_ids):
+            time.sleep(self.poll_interval)
+
     def remove_task(self, task_id):
         """Remove task with identifier `task_id` from pool.
 
@@ -268,6 +865,14 @@ class ClientBase:
         """Add `loaded_net` to the queue of tasks and return immediately."""
         return self.apply(Executor.execute, loaded_net)
 
+    def submit_chunk(self, loaded_nets):
+        """Add `loaded_nets` to the queue as a single task and return immediately.
+
+        The result of the task is a tuple of the list of the outputs of `loaded_nets` and the
+        time in seconds spent computing them in the worker.
+        """
+        return self.apply(run_chunk, [(Executor.execute, (net, ), {}) for net in loaded_nets])
+
     def compute(self, loaded_net):
         """Request evaluation of `loaded_net` and wait for result."""
         return self.apply_sync(Executor.execute, loaded_net)
@@ -278,7 +883,7 @@ class ClientBase:
         raise NotImplementedError
 
     @classmethod
-    def compile(cls, source_net, outputs=None):
+    def compile(cls, source_net, outputs=None, cache=False):
         """Compile the structure of the output net.
 
         Does not insert any data into the net.
@@ -288,11 +893,16 @@ class ClientBase:
         source_net : nx.DiGraph
             Can be acquired from `model.source_net`
         outputs : list of node names
+        cache : bool, optional
+            Whether to share the compiled net with the previous compilations of identical
+            source nets, see `CompileCache`. The compiled net must then not be modified.
+            Default False.
 
         Returns
         -------
         output_net : nx.DiGraph
-            output_net codes the execution of the model
+            output_net codes the execution of the model. Its precompiled `ExecutionPlan`
+            is stored to `output_net.graph['plan']`.
 
         """
         if outputs is None:
@@ -301,6 +911,13 @@ class ClientBase:
             logger.warning("Compiling for no outputs!")
         outputs = outputs if isinstance(outputs, list) else [outputs]
 
+        if cache:
+            return cls.compile_cache.get(source_net, outputs,
+                                         partial(cls._compile, source_net, outputs))
+        return cls._compile(source_net, outputs)
+
+    @classmethod
+    def _compile(cls, source_net, outputs):
         compiled_net = nx.DiGraph(
             outputs=outputs, name=source_net.graph['name'], observed=source_net.graph['observed'])
 
@@ -310,11 +927,16 @@ class ClientBase:
         compiled_net = RandomStateCompiler.compile(source_net, compiled_net)
         compiled_net = ReduceCompiler.compile(source_net, compiled_net)
 
+        compiled_net.graph['plan'] = ExecutionPlan(compiled_net)
+
         return compiled_net
 
     @classmethod
     def load_data(cls, compiled_net, context, batch_index):
-        """Load data from the sources of the model and adds them to the compiled net.
+        """Load data from the sources of the model for a batch of the compiled net.
+
+        The compiled net is not copied. The loaded data is stored to a `BatchOverlay` that
+        references the execution plan of the compiled net.
 
         Parameters
         ----------
@@ -324,18 +946,17 @@ class ClientBase:
 
         Returns
         -------
-        output_net : nx.DiGraph
+        loaded_net : BatchOverlay
 
         """
-        # Make a shallow copy of the graph
-        loaded_net = nx.DiGraph(compiled_net)
+        plan = compiled_net.graph.get('plan')
+        if plan is None:
+            plan = ExecutionPlan(compiled_net)
+        loaded_net = BatchOverlay(plan)
 
         loaded_net = ObservedLoader.load(context, loaded_net, batch_index)
         loaded_net = AdditionalNodesLoader.load(context, loaded_net, batch_index)
         loaded_net = RandomStateLoader.load(context, loaded_net, batch_index)
         loaded_net = PoolLoader.load(context, loaded_net, batch_index)
 
-        # Add cache from the contect
-        loaded_net.graph['_executor_cache'] = context.caches['executor']
-
         return loaded_net
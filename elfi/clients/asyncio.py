@@ -0,0 +1,214 @@
+"""This module implements a client for running inferences in an asyncio event loop."""
+
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import elfi.client
+
+logger = logging.getLogger(__name__)
+
+
+def set_as_default():
+    """Set this as the default client."""
+    elfi.client.set_client()
+    elfi.client.set_default_class(Client)
+
+
+def _set_ready(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Client(elfi.client.ClientBase):
+    """Client for running several inferences concurrently in an asyncio event loop.
+
+    The batches are computed in a pool of workers shared by all the inferences using the
+    client. Coroutines such as `ParameterInference.ainfer` waiting for their batches are
+    woken up by the completion of the tasks, so that any number of inferences can be
+    multiplexed in a single thread without blocking or polling. The blocking client API is
+    supported as well.
+
+    If the workers are processes, they cache the compiled nets and the observed data like
+    the workers of the multiprocessing client.
+    """
+
+    def __init__(self, num_processes=None, executor=None):
+        """Create an asyncio client.
+
+        Parameters
+        ----------
+        num_processes : int, optional
+            Number of worker processes to use. Defaults to os.cpu_count(). Ignored if
+            `executor` is given.
+        executor : concurrent.futures.Executor, optional
+            Pool of workers computing the tasks. Defaults to a ProcessPoolExecutor.
+
+        """
+        self.executor = executor or ProcessPoolExecutor(max_workers=num_processes)
+
+        self.tasks = {}
+        self._id_counter = itertools.count()
+
+        # Event loops and futures of the coroutines waiting for the tasks, see `wait_ready`
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+
+        # The workers load the plans they do not have cached from files
+        self.plans_dir = tempfile.mkdtemp(prefix='elfi-')
+        weakref.finalize(self, shutil.rmtree, self.plans_dir, ignore_errors=True)
+        self.plans = elfi.client.PlanRegistry(directory=self.plans_dir)
+
+    def apply(self, kallable, *args, **kwargs):
+        """Add `kallable(*args, **kwargs)` to the queue of tasks. Returns immediately.
+
+        Parameters
+        ----------
+        kallable : callable
+
+        Returns
+        -------
+        id : int
+            Number of the queued task.
+
+        """
+        id = self._id_counter.__next__()
+        future = self.executor.submit(kallable, *args, **kwargs)
+        self.tasks[id] = future
+        future.add_done_callback(partial(self._notify_ready, id))
+        return id
+
+    def apply_sync(self, kallable, *args, **kwargs):
+        """Call and returns the result of `kallable(*args, **kwargs)`.
+
+        Parameters
+        ----------
+        kallable : callable
+
+        """
+        return self.executor.submit(kallable, *args, **kwargs).result()
+
+    def get_result(self, task_id):
+        """Return the result from task identified by `task_id` when it arrives.
+
+        The workers load the plans missing from their cache by themselves, so a ready task
+        is not computed again here and receiving it does not block the event loop.
+
+        Parameters
+        ----------
+        task_id : int
+            Id of the task whose result to return.
+
+        """
+        future = self.tasks.pop(task_id)
+        return self.plans.resolve(self, task_id, future.result())
+
+    def is_ready(self, task_id):
+        """Return whether task with identifier `task_id` is ready.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        return self.tasks[task_id].done()
+
+    def wait_any(self, task_ids):
+        """Block until any of the tasks `task_ids` is ready.
+
+        Parameters
+        ----------
+        task_ids : iterable of int
+
+        """
+        concurrent.futures.wait([self.tasks[task_id] for task_id in task_ids],
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+
+    async def wait_ready(self, task_id):
+        """Wait until the task `task_id` is ready without blocking the event loop.
+
+        The waiting coroutine is woken up from the worker pool when the task completes, or
+        when the task is removed. The coroutines waiting for the same task share a single
+        future.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        with self._waiters_lock:
+            if self.tasks[task_id].done():
+                return
+            if task_id not in self._waiters:
+                loop = asyncio.get_event_loop()
+                self._waiters[task_id] = (loop, loop.create_future())
+            loop, waiter = self._waiters[task_id]
+
+        # Cancelling a waiting coroutine, e.g. in `BatchHandler.await_any`, must not cancel
+        # the shared future
+        await asyncio.shield(waiter)
+
+    def remove_task(self, task_id):
+        """Remove task with identifier `task_id` from pool.
+
+        The task is cancelled if it has not started yet. The coroutines waiting for the
+        task are woken up.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        if task_id in self.tasks:
+            self.tasks.pop(task_id).cancel()
+            self.plans.discard(task_id)
+            # A running task cannot be cancelled, so its completion would come too late
+            self._notify_ready(task_id)
+
+    def reset(self):
+        """Cancel the tasks that have not started and clear pending tasks."""
+        for future in self.tasks.values():
+            future.cancel()
+        self.tasks.clear()
+        self.plans.clear()
+        with self._waiters_lock:
+            waiters = list(self._waiters.values())
+            self._waiters.clear()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_set_ready, waiter)
+
+    def submit(self, loaded_net):
+        """Add `loaded_net` to the queue of tasks and return immediately.
+
+        Only the path of the file of the execution plan of `loaded_net` is sent.
+        """
+        return self.plans.submit(self, loaded_net)
+
+    def submit_chunk(self, loaded_nets):
+        """Add `loaded_nets` to the queue as a single task and return immediately.
+
+        Only the paths of the files of the execution plans of `loaded_nets` are sent.
+        """
+        return self.plans.submit_chunk(self, loaded_nets)
+
+    def _notify_ready(self, task_id, future=None):
+        """Wake up the coroutines waiting for the task `task_id`."""
+        with self._waiters_lock:
+            loop, waiter = self._waiters.pop(task_id, (None, None))
+        if waiter is not None:
+            loop.call_soon_threadsafe(_set_ready, waiter)
+
+    @property
+    def num_cores(self):
+        """Return the number of workers."""
+        return self.executor._max_workers  # N.B. Not necessarily the number of actual cores.
+
+
+set_as_default()
@@ -3,12 +3,15 @@
 http://ipyparallel.readthedocs.io
 """
 
+import concurrent.futures
 import itertools
 import logging
 
 import ipyparallel as ipp
+import ipyparallel.serialize.serialize as ipp_serialize
 
 import elfi.client
+from elfi.executor import cache_plan
 
 logger = logging.getLogger(__name__)
 
@@ -19,9 +22,17 @@ def set_as_default():
     elfi.client.set_default_class(Client)
 
 
+def _dumps(obj):
+    """Serialize `obj` with the pickler of ipyparallel, e.g. cloudpickle if in use."""
+    return ipp_serialize.pickle.dumps(obj, ipp_serialize.PICKLE_PROTOCOL)
+
+
 class Client(elfi.client.ClientBase):
     """A multiprocessing client using ipyparallel.
 
+    The engines cache the compiled nets and the observed data, so that only the data
+    specific to each batch is sent with the batches.
+
     http://ipyparallel.readthedocs.io
     """
 
@@ -40,6 +51,8 @@ class Client(elfi.client.ClientBase):
         self.tasks = {}
         self._id_counter = itertools.count()
 
+        self.plans = elfi.client.PlanRegistry(broadcast=self._broadcast_plan, dumps=_dumps)
+
     def apply(self, kallable, *args, **kwargs):
         """Add `kallable(*args, **kwargs)` to the queue of tasks. Returns immediately.
 
@@ -78,7 +91,7 @@ class Client(elfi.client.ClientBase):
 
         """
         async_result = self.tasks.pop(task_id)
-        return async_result.get()
+        return self.plans.resolve(self, task_id, async_result.get())
 
     def is_ready(self, task_id):
         """Return whether task with identifier `task_id` is ready.
@@ -90,6 +103,17 @@ class Client(elfi.client.ClientBase):
         """
         return self.tasks[task_id].ready()
 
+    def wait_any(self, task_ids):
+        """Block until any of the tasks `task_ids` is ready.
+
+        Parameters
+        ----------
+        task_ids : iterable of int
+
+        """
+        concurrent.futures.wait([self.tasks[task_id] for task_id in task_ids],
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+
     def remove_task(self, task_id):
         """Remove task with identifier `task_id` from pool.
 
@@ -99,6 +123,7 @@ class Client(elfi.client.ClientBase):
 
         """
         async_result = self.tasks.pop(task_id)
+        self.plans.discard(task_id)
         if not async_result.ready():
             # Note: Ipyparallel is only able to abort if the job hasn't started.
             return self.ipp_client.abort(async_result, block=False)
@@ -110,6 +135,28 @@ class Client(elfi.client.ClientBase):
         """
         self.view.abort(block=False)
         self.tasks.clear()
+        self.plans.clear()
+
+    def submit(self, loaded_net):
+        """Add `loaded_net` to the queue of tasks and return immediately.
+
+        The execution plan of `loaded_net` is sent only if the engines do not have it
+        cached.
+        """
+        return self.plans.submit(self, loaded_net)
+
+    def submit_chunk(self, loaded_nets):
+        """Add `loaded_nets` to the queue as a single task and return immediately.
+
+        The execution plans of `loaded_nets` are sent only if the workers do not have them
+        cached.
+        """
+        return self.plans.submit_chunk(self, loaded_nets)
+
+    def _broadcast_plan(self, key, payload):
+        """Send a new plan to be cached in all the engines without waiting."""
+        if len(self.ipp_client.ids) > 0:
+            self.ipp_client[:].apply_async(cache_plan, key, payload)
 
     @property
     def num_cores(self):
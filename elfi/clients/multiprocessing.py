@@ -3,11 +3,25 @@
 import itertools
 import logging
 import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import uuid
+import weakref
+from functools import partial
+
+import numpy as np
 
 import elfi.client
+from elfi.executor import Cancelled, cancel_token
 
 logger = logging.getLogger(__name__)
 
+# Table of the tasks of the client, set in the worker processes by `_init_worker`
+_task_table = None
+
 
 def set_as_default():
     """Set this as the default client."""
@@ -15,24 +29,250 @@ def set_as_default():
     elfi.client.set_default_class(Client)
 
 
+class SharedArray:
+    """Descriptor of an array written by a worker to a scratch file.
+
+    Only the descriptor is pickled back to the parent process, which reads the file
+    instead of receiving the array through a pipe.
+    """
+
+    def __init__(self, path):
+        """Create a descriptor of the array in `path`."""
+        self.path = path
+
+    def load(self):
+        """Return the array read to memory and remove its file.
+
+        The array is copied out of the file, so that the results kept do not hold on to
+        the scratch files in shared memory.
+        """
+        array = np.load(self.path)
+        os.remove(self.path)
+        return array
+
+
+class TaskTable:
+    """Running and cancelled tasks shared by the client and its worker processes.
+
+    A worker occupies a free slot of the table while it runs a task, so that the table
+    needs only a slot per worker. The slot holds the id of the task running in it, the pid
+    of the worker and whether the task has been cancelled. The ids of the recently
+    cancelled tasks are kept in a ring buffer, so that the tasks cancelled before they
+    start are not run at all.
+    """
+
+    def __init__(self, n_workers, n_cancelled=1024):
+        """Allocate the table in shared memory.
+
+        Parameters
+        ----------
+        n_workers : int
+            Number of the worker processes.
+        n_cancelled : int, optional
+            Number of the recently cancelled task ids to keep.
+
+        """
+        self.running = multiprocessing.Array('l', [-1] * n_workers, lock=False)
+        self.pids = multiprocessing.Array('l', n_workers, lock=False)
+        self.stopped = multiprocessing.Array('b', n_workers, lock=False)
+        self.cancelled = multiprocessing.Array('l', [-1] * n_cancelled, lock=False)
+        self.n_cancelled = multiprocessing.Value('l', 0, lock=False)
+        self.lock = multiprocessing.Lock()
+
+    def cancel(self, task_id):
+        """Mark `task_id` cancelled, so that its worker stops at the next node."""
+        with self.lock:
+            self.cancelled[self.n_cancelled.value % len(self.cancelled)] = task_id
+            self.n_cancelled.value += 1
+            for slot, running in enumerate(self.running):
+                if running == task_id:
+                    self.stopped[slot] = True
+
+    def kill(self, task_id):
+        """Terminate the worker process running `task_id` and free its slot.
+
+        Returns
+        -------
+        bool
+            Whether the task was running.
+
+        """
+        with self.lock:
+            for slot, running in enumerate(self.running):
+                if running == task_id:
+                    logger.debug('Terminating worker {} of task {}'.format(
+                        self.pids[slot], task_id))
+                    os.kill(self.pids[slot], signal.SIGTERM)
+                    self.running[slot] = -1
+                    return True
+        return False
+
+    def start(self, task_id):
+        """Occupy a free slot for running `task_id` and return it.
+
+        Returns None if the task was cancelled before it started.
+        """
+        with self.lock:
+            if task_id in self.cancelled:
+                return None
+            if -1 not in self.running:
+                self._reclaim()
+            if -1 not in self.running:
+                raise RuntimeError('No free slot in the task table. Were the worker '
+                                   'processes of the pool terminated by others?')
+            slot = list(self.running).index(-1)
+            self.running[slot] = task_id
+            self.pids[slot] = os.getpid()
+            self.stopped[slot] = False
+            return slot
+
+    def finish(self, slot):
+        """Free `slot` after its task has finished."""
+        with self.lock:
+            self.running[slot] = -1
+
+    def _reclaim(self):
+        """Free the slots of the workers that died while running a task."""
+        if os.name != 'posix':
+            # Cannot check the processes without terminating them
+            return
+        for slot, pid in enumerate(self.pids):
+            if self.running[slot] != -1 and not _is_alive(pid):
+                logger.warning('Worker {} died while running task {}'.format(
+                    pid, self.running[slot]))
+                self.running[slot] = -1
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _init_worker(task_table, initializer=None, initargs=()):
+    global _task_table
+    _task_table = task_table
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_task(task_id, kallable, args, kwargs, directory=None, min_bytes=None):
+    """Run `kallable(*args, **kwargs)` as the task `task_id` in a worker.
+
+    The execution stops at the next node of the graph once the task is cancelled.
+
+    If `directory` is given, NumPy arrays of at least `min_bytes` bytes in the result, also
+    inside dicts, lists and tuples, are written to scratch files in it and replaced by
+    `SharedArray` descriptors.
+    """
+    table = _task_table
+    slot = table.start(task_id)
+    if slot is None:
+        raise Cancelled('Task {} was cancelled before it started'.format(task_id))
+
+    try:
+        with cancel_token(lambda: table.stopped[slot]):
+            result = kallable(*args, **kwargs)
+    finally:
+        table.finish(slot)
+
+    if directory is not None:
+        result = _export(result, directory, min_bytes)
+    return result
+
+
+def _export(obj, directory, min_bytes):
+    if isinstance(obj, dict):
+        return {k: _export(v, directory, min_bytes) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+        return type(obj)(_export(v, directory, min_bytes) for v in obj)
+    elif type(obj) is np.ndarray and obj.nbytes >= min_bytes and not obj.dtype.hasobject:
+        path = os.path.join(directory, '{}.npy'.format(uuid.uuid4().hex))
+        np.save(path, obj)
+        return SharedArray(path)
+    return obj
+
+
+def _import(obj):
+    if isinstance(obj, SharedArray):
+        return obj.load()
+    elif isinstance(obj, dict):
+        return {k: _import(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+        return type(obj)(_import(v) for v in obj)
+    return obj
+
+
+def _scratch_directory():
+    """Return a new scratch directory preferably in shared memory."""
+    base = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+    return tempfile.mkdtemp(prefix='elfi-', dir=base)
+
+
 class Client(elfi.client.ClientBase):
-    """Client based on Python's built-in multiprocessing module."""
+    """Client based on Python's built-in multiprocessing module.
+
+    The worker processes cache the compiled nets and the observed data, so that only the
+    data specific to each batch is sent with the batches. The workers load the compiled
+    nets they do not have cached from scratch files written once per net.
+
+    Large NumPy arrays in the results are not pickled through a pipe. The workers write
+    them to scratch files, preferably in shared memory (/dev/shm), which are read in this
+    process with a single copy.
 
-    def __init__(self, num_processes=None, **kwargs):
+    Removed tasks stop computing at the next node of their graph. A single node that runs
+    for long, e.g. an external simulator, cannot be interrupted this way. With
+    `force_cancel` the worker processes running removed tasks are terminated instead and
+    replaced by new ones. The terminated workers lose their cached nets and anything the
+    nodes held, so use it only with operations that are safe to kill.
+    """
+
+    def __init__(self, num_processes=None, shared_min_bytes=2**16, force_cancel=False,
+                 **kwargs):
         """Create a multiprocessing client.
 
         Parameters
         ----------
         num_processes : int, optional
             Number of worker processes to use. Defaults to os.cpu_count().
+        shared_min_bytes : int, optional
+            Minimum size of the arrays in the results that are passed through scratch
+            files. None sends all the results through a pipe.
+        force_cancel : bool, optional
+            Terminate the worker processes running removed tasks instead of letting the
+            tasks stop at the next node of their graph.
 
         """
-        num_processes = num_processes or kwargs.pop('processes', None)
-        self.pool = multiprocessing.Pool(processes=num_processes, **kwargs)
+        num_processes = num_processes or kwargs.pop('processes', None) or os.cpu_count()
+        self.task_table = TaskTable(num_processes)
+        initargs = (self.task_table, kwargs.pop('initializer', None),
+                    kwargs.pop('initargs', ()))
+        self.pool = multiprocessing.Pool(
+            processes=num_processes, initializer=_init_worker, initargs=initargs, **kwargs)
+
+        self.shared_min_bytes = shared_min_bytes
+        self.force_cancel = force_cancel
+        self.scratch_dir = _scratch_directory()
+        weakref.finalize(self, shutil.rmtree, self.scratch_dir, ignore_errors=True)
 
         self.tasks = {}
+        self._removed = []
         self._id_counter = itertools.count()
 
+        # Ids of the completed tasks, notified from the result handler thread of the pool
+        self._completed = set()
+        self._completion = threading.Condition()
+
+        # The plans have their own directory, so that only results are written to the
+        # scratch directory
+        plan_dir = os.path.join(self.scratch_dir, 'plans')
+        os.mkdir(plan_dir)
+        self.plans = elfi.client.PlanRegistry(directory=plan_dir)
+
     def apply(self, kallable, *args, **kwargs):
         """Add `kallable(*args, **kwargs)` to the queue of tasks. Returns immediately.
 
@@ -47,8 +287,13 @@ class Client(elfi.client.ClientBase):
 
         """
         id = self._id_counter.__next__()
-        async_res = self.pool.apply_async(kallable, args, kwargs)
-        self.tasks[id] = async_res
+        directory = self.scratch_dir if self.shared_min_bytes is not None else None
+        notify = partial(self._notify_completed, id)
+        # The task must be in the table before its completion can be notified
+        with self._completion:
+            self.tasks[id] = self.pool.apply_async(
+                run_task, (id, kallable, args, kwargs, directory, self.shared_min_bytes),
+                callback=notify, error_callback=notify)
         return id
 
     def apply_sync(self, kallable, *args, **kwargs):
@@ -71,7 +316,11 @@ class Client(elfi.client.ClientBase):
 
         """
         async_result = self.tasks.pop(task_id)
-        return async_result.get()
+        with self._completion:
+            self._completed.discard(task_id)
+        result = self.plans.resolve(self, task_id, _import(async_result.get()))
+        self._clear_removed()
+        return result
 
     def is_ready(self, task_id):
         """Return whether task with identifier `task_id` is ready.
@@ -83,23 +332,86 @@ class Client(elfi.client.ClientBase):
         """
         return self.tasks[task_id].ready()
 
+    def wait_any(self, task_ids):
+        """Block until any of the tasks `task_ids` is ready.
+
+        Parameters
+        ----------
+        task_ids : iterable of int
+
+        """
+        task_ids = list(task_ids)
+        with self._completion:
+            self._completion.wait_for(lambda: not self._completed.isdisjoint(task_ids))
+
     def remove_task(self, task_id):
         """Remove task with identifier `task_id` from pool.
 
+        The task is not started if it is still in queue. A running task stops at the next
+        node of its graph, or its worker process is terminated and replaced if
+        `force_cancel` is set.
+
         Parameters
         ----------
         task_id : int
 
         """
         if task_id in self.tasks:
-            del self.tasks[task_id]
-            # TODO: also kill the pid?
+            with self._completion:
+                async_result = self.tasks.pop(task_id)
+                self._completed.discard(task_id)
+            self.plans.discard(task_id)
+            self.task_table.cancel(task_id)
+
+            if self.force_cancel and self.task_table.kill(task_id):
+                # The result of the terminated task never arrives. The pool replaces the
+                # worker, but would wait for the result when closed unless it is resolved.
+                async_result._set(
+                    None, (False, Cancelled('Task {} was terminated'.format(task_id))))
+                return
+
+            # Keep the task for removing the scratch files of its result when it completes
+            self._removed.append(async_result)
 
     def reset(self):
         """Stop all worker processes immediately and clear pending tasks."""
         self.pool.terminate()
         self.pool.join()
         self.tasks.clear()
+        self._removed.clear()
+        self._completed.clear()
+        self.plans.clear()
+
+    def submit(self, loaded_net):
+        """Add `loaded_net` to the queue of tasks and return immediately.
+
+        Only the path of the file of the execution plan of `loaded_net` is sent.
+        """
+        return self.plans.submit(self, loaded_net)
+
+    def submit_chunk(self, loaded_nets):
+        """Add `loaded_nets` to the queue as a single task and return immediately.
+
+        Only the paths of the files of the execution plans of `loaded_nets` are sent.
+        """
+        return self.plans.submit_chunk(self, loaded_nets)
+
+    def _notify_completed(self, task_id, result):
+        """Wake up `wait_any` when the task `task_id` completes."""
+        with self._completion:
+            if task_id in self.tasks:
+                self._completed.add(task_id)
+                self._completion.notify_all()
+
+    def _clear_removed(self):
+        """Remove the scratch files of the completed tasks that were removed."""
+        pending = []
+        for async_result in self._removed:
+            if not async_result.ready():
+                pending.append(async_result)
+            elif async_result.successful():
+                _import(async_result.get())
+        self._removed = pending
 
     @property
     def num_cores(self):
@@ -0,0 +1,151 @@
+"""This module implements a thread pool client."""
+
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import elfi.client
+from elfi.executor import cancel_token
+
+logger = logging.getLogger(__name__)
+
+
+def run_task(kallable, args, kwargs, cancelled):
+    """Run `kallable(*args, **kwargs)` until the event `cancelled` is set.
+
+    The execution stops at the next node of the graph once the event is set.
+    """
+    with cancel_token(cancelled.is_set):
+        return kallable(*args, **kwargs)
+
+
+def set_as_default():
+    """Set this as the default client."""
+    elfi.client.set_client()
+    elfi.client.set_default_class(Client)
+
+
+class Client(elfi.client.ClientBase):
+    """Client based on a pool of threads in the current process.
+
+    The threads share the compiled nets and the observed data in memory, so nothing is
+    pickled or copied to compute the batches. Because of the global interpreter lock of
+    Python, the batches are computed in parallel only if the simulator releases it, e.g.
+    when the time is spent in NumPy or SciPy routines or in external processes run with
+    `elfi.tools.external_operation`.
+    """
+
+    def __init__(self, num_threads=None, **kwargs):
+        """Create a thread pool client.
+
+        Parameters
+        ----------
+        num_threads : int, optional
+            Number of worker threads to use. Defaults to os.cpu_count().
+
+        """
+        num_threads = num_threads or kwargs.pop('max_workers', None) or os.cpu_count()
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self._num_threads = num_threads
+
+        self.tasks = {}
+        self._cancelled = {}
+        self._id_counter = itertools.count()
+
+    def apply(self, kallable, *args, **kwargs):
+        """Add `kallable(*args, **kwargs)` to the queue of tasks. Returns immediately.
+
+        Parameters
+        ----------
+        kallable : callable
+
+        Returns
+        -------
+        id : int
+            Number of the queued task.
+
+        """
+        id = self._id_counter.__next__()
+        cancelled = threading.Event()
+        self.tasks[id] = self.pool.submit(run_task, kallable, args, kwargs, cancelled)
+        self._cancelled[id] = cancelled
+        return id
+
+    def apply_sync(self, kallable, *args, **kwargs):
+        """Call and returns the result of `kallable(*args, **kwargs)`.
+
+        Parameters
+        ----------
+        kallable : callable
+
+        """
+        return kallable(*args, **kwargs)
+
+    def get_result(self, task_id):
+        """Return the result from task identified by `task_id` when it arrives.
+
+        Parameters
+        ----------
+        task_id : int
+            Id of the task whose result to return.
+
+        """
+        future = self.tasks.pop(task_id)
+        self._cancelled.pop(task_id)
+        return future.result()
+
+    def is_ready(self, task_id):
+        """Return whether task with identifier `task_id` is ready.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        return self.tasks[task_id].done()
+
+    def wait_any(self, task_ids):
+        """Block until any of the tasks `task_ids` is ready.
+
+        Parameters
+        ----------
+        task_ids : iterable of int
+
+        """
+        concurrent.futures.wait([self.tasks[task_id] for task_id in task_ids],
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def remove_task(self, task_id):
+        """Remove task with identifier `task_id` from pool.
+
+        The task is cancelled if it has not started yet. A running task stops at the next
+        node of its graph.
+
+        Parameters
+        ----------
+        task_id : int
+
+        """
+        if task_id in self.tasks:
+            self.tasks.pop(task_id).cancel()
+            self._cancelled.pop(task_id).set()
+
+    def reset(self):
+        """Cancel all tasks and clear pending tasks."""
+        for future in self.tasks.values():
+            future.cancel()
+        for cancelled in self._cancelled.values():
+            cancelled.set()
+        self.tasks.clear()
+        self._cancelled.clear()
+
+    @property
+    def num_cores(self):
+        """Return the number of threads."""
+        return self._num_threads  # N.B. Not necessarily the number of actual cores.
+
+
+set_as_default()
@@ -1,17 +1,419 @@
 """This module includes the Executor of ELFI graphs."""
 
 import logging
-from operator import itemgetter
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import networkx as nx
 
+from elfi.utils import observed_name
+
 logger = logging.getLogger(__name__)
 
+# Execution plans cached in this (worker) process, see `Executor.execute_cached`
+_plan_cache = OrderedDict()
+PLAN_CACHE_SIZE = 16
+
+# Cancel token of the task being executed in this thread, see `cancel_token`
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised when the execution of a cancelled task is stopped."""
+
+
+@contextmanager
+def cancel_token(token):
+    """Check `token` between the nodes of the plans executed in this context.
+
+    Clients use this to stop computing the batches of removed tasks. The execution raises
+    `Cancelled` before running the next node once `token()` returns True.
+
+    Parameters
+    ----------
+    token : callable
+        Returns whether the task has been cancelled.
+
+    """
+    previous = getattr(_local, 'cancel_token', None)
+    _local.cancel_token = token
+    try:
+        yield
+    finally:
+        _local.cancel_token = previous
+
+
+class ExecutionPlan:
+    """Precompiled execution instructions of a compiled ELFI graph.
+
+    The plan is produced once per compilation (see `ClientBase.compile`). It stores the
+    nodes of the compiled graph as a flat list of slots in a constant topological order,
+    together with their operations, constant outputs and the slot indices of their
+    positional and keyword arguments. Executing a batch is then a loop over these arrays
+    instead of a traversal of the `nx.DiGraph`.
+
+    The minimal sequence of slots to run depends only on the requested outputs and on which
+    nodes have their outputs given for the batch. These sequences are resolved once and
+    memoized in the plan.
+
+    Nodes that depend neither on the random state, the batch size and meta information nor
+    on any output given for the batch, except for the observed data, are batch invariant,
+    e.g. the summaries of the observed data. Their outputs are memoized in the plan when
+    they are first computed, so that each process computes them only once per plan. Their
+    operations must thus be deterministic and must not modify their inputs in place. Each
+    compilation has its own plan, also in the worker processes, so the memoized outputs are
+    not shared between inferences unless they share the compilation, see
+    `elfi.client.CompileCache`.
+
+    Attributes
+    ----------
+    nodes : tuple
+        Node names in the execution order.
+    index : dict
+        Maps node names to their slots.
+    outputs : tuple
+        Names of the nodes whose outputs are returned by default.
+    name : str
+        Name of the compiled model.
+    observed : dict
+        Observed data of the compiled model.
+
+    """
+
+    def __init__(self, G):
+        """Compile the execution plan of the graph `G`.
+
+        Parameters
+        ----------
+        G : nx.DiGraph
+            Compiled net, see `Executor` for the format.
+
+        """
+        nodes = tuple(nx_constant_topological_sort(G))
+        index = {node: i for i, node in enumerate(nodes)}
+
+        operations = []
+        constants = []
+        has_constant = []
+        parents = []
+        args = []
+        kwargs = []
+
+        for node in nodes:
+            attr = G.node[node]
+            if attr.keys() >= {'operation', 'output'}:
+                raise ValueError('Generative graph has both op and output present for '
+                                 'node {}'.format(node))
+            operations.append(attr.get('operation'))
+            constants.append(attr.get('output'))
+            has_constant.append('output' in attr)
+
+            positional = []
+            keyword = []
+            for parent_name in G.predecessors(node):
+                param = G[parent_name][node]['param']
+                if isinstance(param, int):
+                    positional.append((param, index[parent_name]))
+                else:
+                    keyword.append((param, index[parent_name]))
+            positional.sort()
+            keyword.sort()
+
+            parents.append(tuple(index[p] for p in G.predecessors(node)))
+            args.append(tuple(slot for _, slot in positional))
+            kwargs.append(tuple(keyword))
+
+        self.nodes = nodes
+        self.index = index
+        self.outputs = tuple(G.graph.get('outputs', ()))
+        self.name = G.graph.get('name')
+        self.observed = G.graph.get('observed', {})
+        self._operations = tuple(operations)
+        self._constants = tuple(constants)
+        self._has_constant = tuple(has_constant)
+        self._parents = tuple(parents)
+        self._args = tuple(args)
+        self._kwargs = tuple(kwargs)
+        self._observed_data = tuple(
+            (index[node], obs) for node, obs in self.observed_outputs().items())
+        self._steps = {}
+        self._memo = {}
+        self._warm = set()
+
+        # Tells the plans of different compilations apart in the caches of the workers, so
+        # that they do not share the memoized outputs
+        self._uid = uuid.uuid4().hex
+
+    def __getstate__(self):
+        """Return the state for pickling without the memoized steps and outputs."""
+        state = self.__dict__.copy()
+        state['_steps'] = {}
+        state['_memo'] = {}
+        state['_warm'] = set()
+        return state
+
+    def __contains__(self, node):
+        """Return whether `node` has a slot in the plan."""
+        return node in self.index
+
+    def observed_outputs(self):
+        """Return the observed data of the nodes in the plan keyed by the observed node names."""
+        outputs = {}
+        for name, obs in self.observed.items():
+            obs_name = observed_name(name)
+            if obs_name in self.index:
+                outputs[obs_name] = obs
+        return outputs
+
+    def operation(self, node):
+        """Return the compiled operation of `node` or None."""
+        return self._operations[self.index[node]]
+
+    def execution_order(self, outputs, given=(), operations=()):
+        """Return the names of the nodes that need to be run to produce `outputs`.
+
+        Parameters
+        ----------
+        outputs : list
+            Names of the requested nodes.
+        given : iterable, optional
+            Names of the nodes whose outputs are given.
+        operations : iterable, optional
+            Names of the nodes whose operations are given.
+
+        Returns
+        -------
+        list
+
+        """
+        steps = self._resolve(tuple(outputs), frozenset(given), frozenset(operations))
+        return [self.nodes[step[0]] for step in steps]
+
+    def execute(self, outputs, data=None, operations=None):
+        """Run the plan.
+
+        Parameters
+        ----------
+        outputs : list
+            Names of the nodes whose outputs are returned.
+        data : dict, optional
+            Outputs of nodes given for this execution. These take precedence over the
+            compiled operations and constants.
+        operations : dict, optional
+            Operations given for this execution. These take precedence over the compiled
+            operations and constants.
+
+        Returns
+        -------
+        dict of node outputs
+
+        """
+        data = data or {}
+        operations = operations or {}
+        index = self.index
+        nodes = self.nodes
+
+        # Batch invariant outputs can be memoized only with the compiled observed data
+        key = (tuple(outputs), frozenset(data), frozenset(operations))
+        memoize = all(data.get(nodes[slot], obs) is obs for slot, obs in self._observed_data)
+        warm = memoize and key in self._warm
+        steps = self._resolve(*key, warm=warm)
+
+        values = list(self._constants)
+        if warm:
+            for slot, output in self._memo.items():
+                values[slot] = output
+        for node, output in data.items():
+            if node in index:
+                values[index[node]] = output
+
+        ops = self._operations
+        if operations:
+            ops = list(ops)
+            for node, op in operations.items():
+                ops[index[node]] = op
+
+        token = getattr(_local, 'cancel_token', None)
+        for slot, args, kwargs, invariant in steps:
+            if token is not None and token():
+                raise Cancelled('Cancelled before executing node {}'.format(nodes[slot]))
+            try:
+                values[slot] = ops[slot](*[values[i] for i in args],
+                                         **{k: values[i] for k, i in kwargs})
+            except Exception as exc:
+                raise exc.__class__("In executing node '{}': {}."
+                                    .format(nodes[slot], exc)).with_traceback(
+                                        exc.__traceback__)
+            if invariant and memoize:
+                self._memo[slot] = values[slot]
+
+        if memoize:
+            self._warm.add(key)
+
+        return {node: values[index[node]] for node in outputs}
+
+    def _resolve(self, outputs, given, operations, warm=False):
+        """Return the memoized minimal sequence of steps for the execution.
+
+        The steps tell whether their node is batch invariant. With `warm`, the outputs of the
+        batch invariant nodes are taken as given.
+        """
+        key = (outputs, given, operations, warm)
+        steps = self._steps.get(key)
+        if steps is not None:
+            return steps
+
+        for node in given & operations:
+            raise ValueError('Generative graph has both op and output present for '
+                             'node {}'.format(node))
+
+        index = self.index
+        given = {index[node] for node in given if node in index}
+        operations = {index[node] for node in operations}
+
+        invariant = self._invariant(given, operations)
+
+        needed = [False] * len(self.nodes)
+        for node in outputs:
+            needed[index[node]] = True
+
+        steps = []
+        for slot in reversed(range(len(self.nodes))):
+            if not needed[slot] or slot in given or (warm and slot in invariant):
+                continue
+            if slot not in operations:
+                if self._has_constant[slot]:
+                    continue
+                if self._operations[slot] is None:
+                    raise ValueError('Generative graph has no op or output present for '
+                                     'node {}'.format(self.nodes[slot]))
+            steps.append((slot, self._args[slot], self._kwargs[slot], slot in invariant))
+            for parent in self._parents[slot]:
+                needed[parent] = True
+
+        steps.reverse()
+        steps = tuple(steps)
+        self._steps[key] = steps
+        return steps
+
+    def _invariant(self, given, operations):
+        """Return the slots whose outputs are the same for all the batches.
+
+        Parameters
+        ----------
+        given : set
+            Slots whose outputs are given for the batch.
+        operations : set
+            Slots whose operations are given for the batch.
+
+        """
+        observed = {slot for slot, _ in self._observed_data}
+        invariant = set()
+        for slot in range(len(self.nodes)):
+            if slot in operations:
+                continue
+            elif slot in given:
+                if slot in observed:
+                    invariant.add(slot)
+            elif self._has_constant[slot]:
+                invariant.add(slot)
+            elif self._operations[slot] is not None and \
+                    all(parent in invariant for parent in self._parents[slot]):
+                invariant.add(slot)
+        return invariant
+
+
+class BatchOverlay:
+    """Data of a single batch laid over an execution plan.
+
+    Loading data for a batch does not copy the compiled net. The overlay only references
+    the shared `ExecutionPlan` and holds the outputs and operations given for this batch,
+    such as the observed data, the random state or values from an `OutputPool`. Creating
+    and sending an overlay thus costs O(given nodes) instead of O(graph).
+
+    Attributes
+    ----------
+    plan : ExecutionPlan
+    outputs : list
+        Names of the nodes whose outputs are returned.
+    data : dict
+        Outputs given for this batch.
+    operations : dict
+        Operations given for this batch.
+
+    """
+
+    def __init__(self, plan, outputs=None):
+        """Create an empty overlay over `plan`.
+
+        Parameters
+        ----------
+        plan : ExecutionPlan
+        outputs : list, optional
+            Defaults to the outputs of the plan.
+
+        """
+        self.plan = plan
+        self.outputs = list(plan.outputs if outputs is None else outputs)
+        self.data = {}
+        self.operations = {}
+
+    @property
+    def name(self):
+        """Return the name of the compiled model."""
+        return self.plan.name
+
+    @property
+    def observed(self):
+        """Return the observed data of the compiled model."""
+        return self.plan.observed
+
+    def has_node(self, node):
+        """Return whether `node` is in the compiled net."""
+        return node in self.plan
+
+    def set_output(self, node, output):
+        """Give the output of `node` for this batch."""
+        self.operations.pop(node, None)
+        self.data[node] = output
+
+    def set_operation(self, node, operation):
+        """Give the operation of `node` for this batch."""
+        self.data.pop(node, None)
+        self.operations[node] = operation
+
+    def batch_data(self):
+        """Return the given outputs that are specific to this batch.
+
+        Observed data is shared by all the batches of the plan and is left out.
+        """
+        observed = self.plan.observed_outputs()
+        data = {}
+        for node, output in self.data.items():
+            if node in observed and observed[node] is output:
+                continue
+            data[node] = output
+        return data
+
+    def execute(self):
+        """Execute the plan with the data of this batch.
+
+        Returns
+        -------
+        dict of node outputs
+
+        """
+        return self.plan.execute(self.outputs, self.data, self.operations)
+
 
 class Executor:
     """Responsible for computing the graph G.
 
-    The format of the computable graph G is `nx.DiGraph`. The execution order of the nodes
+    The computable graph G is either a `BatchOverlay` produced by `ClientBase.load_data`, or
+    a loaded `nx.DiGraph` of the format described below. The execution order of the nodes
     is fixed and follows the topological ordering of G. The following properties are
     required.
 
@@ -19,6 +421,8 @@ class Executor:
 
     outputs : list
         lists all the names of the nodes whose outputs are returned.
+    plan : ExecutionPlan, optional
+        Precompiled execution plan of G. If missing, it will be compiled from G.
 
 
     ### Keys in edge dictionaries, G[parent_name][child_name]
@@ -47,37 +451,23 @@ class Executor:
 
         Parameters
         ----------
-        G : nx.DiGraph
+        G : BatchOverlay or nx.DiGraph
 
         Returns
         -------
         dict of node outputs
 
         """
-        order = cls.get_execution_order(G)
+        if isinstance(G, BatchOverlay):
+            return G.execute()
 
-        for node in order:
-            attr = G.node[node]
-            logger.debug("Executing {}".format(node))
+        plan, data, operations = cls._load_plan(G)
+        result = plan.execute(G.graph['outputs'], data, operations)
 
-            if attr.keys() >= {'operation', 'output'}:
-                raise ValueError('Generative graph has both op and output present for '
-                                 'node {}'.format(node))
+        # Store the outputs to G so that executing it again gives the same result
+        for node, output in result.items():
+            G.node[node] = {'output': output}
 
-            if 'operation' in attr:
-                op = attr['operation']
-                try:
-                    G.node[node] = cls._run(op, node, G)
-                except Exception as exc:
-                    raise exc.__class__("In executing node '{}': {}."
-                                        .format(node, exc)).with_traceback(exc.__traceback__)
-
-            elif 'output' not in attr:
-                raise ValueError('Generative graph has no op or output present for node '
-                                 '{}'.format(node))
-
-        # Make a result dict based on the requested outputs
-        result = {k: G.node[k]['output'] for k in G.graph['outputs']}
         return result
 
     @classmethod
@@ -91,7 +481,7 @@ class Executor:
 
         Parameters
         ----------
-        G : nx.DiGraph
+        G : BatchOverlay or nx.DiGraph
 
         Returns
         -------
@@ -99,60 +489,99 @@ class Executor:
             nodes that require execution
 
         """
-        # Get the cache dict if it exists
-        cache = G.graph.get('_executor_cache', {})
+        if isinstance(G, BatchOverlay):
+            return G.plan.execution_order(G.outputs, G.data, G.operations)
 
-        output_nodes = G.graph['outputs']
-        # Filter those output nodes who have an operation to run
-        needed = tuple(sorted(node for node in output_nodes if 'operation' in G.node[node]))
+        plan, data, operations = cls._load_plan(G)
+        return plan.execution_order(G.graph['outputs'], data, operations)
 
-        if needed not in cache:
-            # Resolve the nodes that need to be executed in the graph
-            nodes_to_execute = set(needed)
+    @classmethod
+    def execute_cached(cls, key, outputs, data, operations, plan=None):
+        """Execute a batch with an execution plan cached in this process.
+
+        Clients use this to avoid sending the compiled plan and the observed data with
+        every batch to their workers. Only the per batch data is sent, see
+        `BatchOverlay.batch_data`.
 
-            if 'sort_order' not in cache:
-                cache['sort_order'] = nx_constant_topological_sort(G)
-            sort_order = cache['sort_order']
+        Parameters
+        ----------
+        key : str
+            Content hash of the plan.
+        outputs : list
+        data : dict
+            Outputs given for the batch, excluding the observed data.
+        operations : dict
+            Operations given for the batch.
+        plan : ExecutionPlan, bytes or str, optional
+            The plan or its pickle. If given, the plan is stored to the cache. A str is the
+            path of a file containing the pickle, which is loaded only if the plan is not
+            cached.
 
-            # Resolve the dependencies of needed
-            dep_graph = nx.DiGraph(G.edges())
-            for node in sort_order:
-                attr = G.node[node]
-                if attr.keys() >= {'operation', 'output'}:
-                    raise ValueError('Generative graph has both op and output present')
+        Returns
+        -------
+        dict of node outputs or None
+            None is returned if the plan was neither given nor found from the cache.
 
-                # Remove those nodes from the dependency graph whose outputs are present
-                if 'output' in attr:
-                    dep_graph.remove_node(node)
-                elif 'operation' not in attr:
-                    raise ValueError('Generative graph has no op or output present')
+        """
+        if isinstance(plan, str):
+            if key not in _plan_cache:
+                with open(plan, 'rb') as f:
+                    cache_plan(key, f.read())
+        elif plan is not None:
+            cache_plan(key, plan)
+
+        plan = _plan_cache.get(key)
+        if plan is None:
+            return None
+        _plan_cache.move_to_end(key)
+
+        loaded_net = BatchOverlay(plan, outputs)
+        loaded_net.data.update(plan.observed_outputs())
+        loaded_net.data.update(data)
+        loaded_net.operations.update(operations)
+        return loaded_net.execute()
 
-            # Add the dependencies of the needed nodes
-            for needed_node in needed:
-                nodes_to_execute.update(nx.ancestors(dep_graph, needed_node))
+    @staticmethod
+    def _load_plan(G):
+        """Return the plan of G with the outputs and operations that differ from it."""
+        plan = G.graph.get('plan')
+        if plan is None:
+            plan = ExecutionPlan(G)
+
+        data = {}
+        operations = {}
+        for node, attr in G.node.items():
+            if attr.keys() >= {'operation', 'output'}:
+                raise ValueError('Generative graph has both op and output present for '
+                                 'node {}'.format(node))
+            if 'output' in attr:
+                data[node] = attr['output']
+            elif 'operation' in attr and node in plan:
+                if attr['operation'] is not plan.operation(node):
+                    operations[node] = attr['operation']
 
-            # Turn in to a sorted list and cache
-            cache[needed] = [n for n in sort_order if n in nodes_to_execute]
+        return plan, data, operations
 
-        return cache[needed]
 
-    @staticmethod
-    def _run(fn, node, G):
-        args = []
-        kwargs = {}
+def cache_plan(key, plan):
+    """Store `plan` to the plan cache of this process.
 
-        for parent_name in G.predecessors(node):
-            param = G[parent_name][node]['param']
-            output = G.node[parent_name]['output']
-            if isinstance(param, int):
-                args.append((param, output))
-            else:
-                kwargs[param] = output
+    The least recently used plans are evicted when the cache has more than
+    `PLAN_CACHE_SIZE` plans.
 
-        args = [a[1] for a in sorted(args, key=itemgetter(0))]
+    Parameters
+    ----------
+    key : str
+    plan : ExecutionPlan or bytes
+        The plan or its pickle.
 
-        output_dict = {'output': fn(*args, **kwargs)}
-        return output_dict
+    """
+    if isinstance(plan, bytes):
+        plan = pickle.loads(plan)
+    _plan_cache[key] = plan
+    _plan_cache.move_to_end(key)
+    while len(_plan_cache) > PLAN_CACHE_SIZE:
+        _plan_cache.popitem(last=False)
 
 
 def nx_constant_topological_sort(G, nbunch=None, reverse=False):
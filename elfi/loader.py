@@ -1,5 +1,7 @@
 """Loading makes precomputed data accessible to nodes."""
 
+from functools import partial
+
 import numpy as np
 
 from elfi.utils import get_sub_seed, observed_name
@@ -9,19 +11,19 @@ class Loader:
     """Base class for Loaders."""
 
     @classmethod
-    def load(cls, context, compiled_net, batch_index):
-        """Load precomputed data into nodes of `compiled_net`.
+    def load(cls, context, loaded_net, batch_index):
+        """Load precomputed data into the nodes of `loaded_net`.
 
         Parameters
         ----------
         context : ComputationContext
-        compiled_net : nx.DiGraph
+        loaded_net : BatchOverlay
         batch_index : int
 
         Returns
         -------
-        net : nx.DiGraph
-            Loaded net, which is the `compiled_net` that has been loaded with data that
+        net : BatchOverlay
+            Loaded net, which is the `loaded_net` that has been loaded with data that
             can depend on the batch_index.
 
         """
@@ -30,49 +32,46 @@ class Loader:
 
 class ObservedLoader(Loader):  # noqa: D101
     @classmethod
-    def load(cls, context, compiled_net, batch_index):
-        """Add the observed data to the `compiled_net`.
+    def load(cls, context, loaded_net, batch_index):
+        """Add the observed data to the `loaded_net`.
 
         Parameters
         ----------
         context : ComputationContext
-        compiled_net : nx.DiGraph
+        loaded_net : BatchOverlay
         batch_index : int
 
         Returns
         -------
-        net : nx.DiGraph
-            Loaded net, which is the `compiled_net` that has been loaded with data that
+        net : BatchOverlay
+            Loaded net, which is the `loaded_net` that has been loaded with data that
             can depend on the batch_index.
 
         """
-        observed = compiled_net.graph['observed']
-
-        for name, obs in observed.items():
+        for name, obs in loaded_net.observed.items():
             obs_name = observed_name(name)
-            if not compiled_net.has_node(obs_name):
+            if not loaded_net.has_node(obs_name):
                 continue
-            compiled_net.node[obs_name] = dict(output=obs)
+            loaded_net.set_output(obs_name, obs)
 
-        del compiled_net.graph['observed']
-        return compiled_net
+        return loaded_net
 
 
 class AdditionalNodesLoader(Loader):  # noqa: D101
     @classmethod
-    def load(cls, context, compiled_net, batch_index):
+    def load(cls, context, loaded_net, batch_index):
         """Add runtime information to instruction nodes.
 
         Parameters
         ----------
         context : ComputationContext
-        compiled_net : nx.DiGraph
+        loaded_net : BatchOverlay
         batch_index : int
 
         Returns
         -------
-        net : nx.DiGraph
-            Loaded net, which is the `compiled_net` that has been loaded with data that
+        net : BatchOverlay
+            Loaded net, which is the `loaded_net` that has been loaded with data that
             can depend on the batch_index.
 
         """
@@ -80,53 +79,52 @@ class AdditionalNodesLoader(Loader):  # noqa: D101
             'batch_index': batch_index,
             'submission_index': context.num_submissions,
             'master_seed': context.seed,
-            'model_name': compiled_net.graph['name']
+            'model_name': loaded_net.name
         }
 
         details = dict(_batch_size=context.batch_size, _meta=meta_dict)
 
         for node, v in details.items():
-            if compiled_net.has_node(node):
-                compiled_net.node[node]['output'] = v
+            if loaded_net.has_node(node):
+                loaded_net.set_output(node, v)
 
-        return compiled_net
+        return loaded_net
 
 
 class PoolLoader(Loader):  # noqa: D101
     @classmethod
-    def load(cls, context, compiled_net, batch_index):
+    def load(cls, context, loaded_net, batch_index):
         """Add data from the pools in `context`.
 
         Parameters
         ----------
         context : ComputationContext
-        compiled_net : nx.DiGraph
+        loaded_net : BatchOverlay
         batch_index : int
 
         Returns
         -------
-        net : nx.DiGraph
-            Loaded net, which is the `compiled_net` that has been loaded with data that
+        net : BatchOverlay
+            Loaded net, which is the `loaded_net` that has been loaded with data that
             can depend on the batch_index.
 
         """
         if context.pool is None:
-            return compiled_net
+            return loaded_net
 
         batch = context.pool.get_batch(batch_index)
 
         for node in context.pool.stores:
-            if not compiled_net.has_node(node):
+            if not loaded_net.has_node(node):
                 continue
             elif node in batch:
-                compiled_net.node[node]['output'] = batch[node]
-                compiled_net.node[node].pop('operation', None)
-            elif node not in compiled_net.graph['outputs']:
+                loaded_net.set_output(node, batch[node])
+            elif node not in loaded_net.outputs:
                 # We are missing this item from the batch so add the output to the
                 # requested outputs so that it can be stored when the results arrive
-                compiled_net.graph['outputs'].append(node)
+                loaded_net.outputs.append(node)
 
-        return compiled_net
+        return loaded_net
 
 
 # We use a getter function so that the local process np.random doesn't get
@@ -138,41 +136,41 @@ def get_np_random():
 
 class RandomStateLoader(Loader):  # noqa: D101
     @classmethod
-    def load(cls, context, compiled_net, batch_index):
-        """Add an instance of random state to the corresponding node.
+    def load(cls, context, loaded_net, batch_index):
+        """Add the acquirer of a random state instance to the corresponding node.
 
         Parameters
         ----------
         context : ComputationContext
-        compiled_net : nx.DiGraph
+        loaded_net : BatchOverlay
         batch_index : int
 
         Returns
         -------
-        net : nx.DiGraph
-            Loaded net, which is the `compiled_net` that has been loaded with data that
+        net : BatchOverlay
+            Loaded net, which is the `loaded_net` that has been loaded with data that
             can depend on the batch_index.
 
         """
-        key = 'output'
         seed = context.seed
 
         if seed is 'global':
             # Get the random_state of the respective worker by delaying the evaluation
             random_state = get_np_random
-            key = 'operation'
         elif isinstance(seed, (int, np.int32, np.uint32)):
             # TODO: In the future, we could use https://pypi.python.org/pypi/randomstate to enable
             # jumps?
             cache = context.caches.get('sub_seed', None)
             sub_seed = get_sub_seed(seed, batch_index, cache=cache)
-            random_state = np.random.RandomState(sub_seed)
+            # Only the sub seed is carried with the loaded net, the instance is created when
+            # the net is executed
+            random_state = partial(np.random.RandomState, sub_seed)
         else:
             raise ValueError("Seed of type {} is not supported".format(seed))
 
-        # Assign the random state or its acquirer function to the corresponding node
+        # Assign the acquirer function of the random state to the corresponding node
         node_name = '_random_state'
-        if compiled_net.has_node(node_name):
-            compiled_net.node[node_name][key] = random_state
+        if loaded_net.has_node(node_name):
+            loaded_net.set_operation(node_name, random_state)
 
-        return compiled_net
+        return loaded_net
@@ -27,7 +27,8 @@ class AcquisitionBase:
                  max_opt_iters=1000,
                  noise_var=None,
                  exploration_rate=10,
-                 seed=None):
+                 seed=None,
+                 batch_method='tile'):
         """Initialize AcquisitionBase.
 
         Parameters
@@ -52,8 +53,17 @@ class AcquisitionBase:
         seed : int, optional
             Seed for getting consistent acquisition results. Used in getting random
             starting locations in acquisition function optimization.
+        batch_method : str, optional
+            How to acquire several points at once: 'tile' repeats the minimizer of the
+            acquisition function and 'kriging_believer' acquires the points one at a time,
+            adding each point to a copy of the model with its predicted mean as the
+            observation before acquiring the next one.
 
         """
+        if batch_method not in ('tile', 'kriging_believer'):
+            raise ValueError("Unknown batch method {}. Use 'tile' or 'kriging_believer'."
+                             .format(batch_method))
+
         self.model = model
         self.prior = prior
         self.n_inits = int(n_inits)
@@ -66,6 +76,7 @@ class AcquisitionBase:
         self.exploration_rate = exploration_rate
         self.random_state = np.random if seed is None else np.random.RandomState(seed)
         self.seed = 0 if seed is None else seed
+        self.batch_method = batch_method
 
     def evaluate(self, x, t=None):
         """Evaluate the acquisition function at 'x'.
@@ -111,7 +122,14 @@ class AcquisitionBase:
         """
         logger.debug('Acquiring the next batch of %d values', n)
 
-        # Optimize the current minimum
+        x = self._acquire_batch(n, t)
+        # Add noise for more efficient fitting of GP
+        x = self._add_noise(x)
+
+        return x
+
+    def _minimize(self, t):
+        """Return the minimizer of the acquisition function."""
         def obj(x):
             return self.evaluate(x, t)
 
@@ -125,12 +143,33 @@ class AcquisitionBase:
             self.prior,
             self.n_inits,
             self.max_opt_iters,
-            random_state=self.random_state)
-
-        # Create n copies of the minimum
-        x = np.tile(xhat, (n, 1))
-        # Add noise for more efficient fitting of GP
-        x = self._add_noise(x)
+            random_state=self.random_state,
+            vectorized=True)
+        return xhat
+
+    def _acquire_batch(self, n, t):
+        """Return n points from the minimizers of the acquisition function."""
+        if self.batch_method == 'tile' or n == 1:
+            # Create n copies of the minimum
+            return np.tile(self._minimize(t), (n, 1))
+
+        model = self.model
+        x = np.empty((n, model.input_dim))
+        try:
+            for i in range(n):
+                x[i] = self._minimize(t)
+                if i == n - 1:
+                    break
+
+                if i == 0:
+                    self.model = model.copy()
+                    # Add the believed points with cheap updates if the model supports them
+                    if hasattr(self.model, 'incremental'):
+                        self.model.incremental = True
+                mean, _ = self.model.predict(x[i:i + 1], noiseless=True)
+                self.model.update(x[i:i + 1], mean)
+        finally:
+            self.model = model
 
         return x
 
@@ -313,6 +352,9 @@ class MaxVar(AcquisitionBase):
         # Updating the ABC threshold.
         self.eps = np.percentile(gp.Y, self.quantile_eps * 100)
 
+        return self._acquire_batch(n, t)
+
+    def _minimize(self, t):
         def _negate_eval(theta):
             return -self.evaluate(theta)
 
@@ -321,17 +363,14 @@ class MaxVar(AcquisitionBase):
 
         # Obtaining the location where the variance is maximised.
         theta_max, _ = minimize(_negate_eval,
-                                gp.bounds,
+                                self.model.bounds,
                                 _negate_eval_grad,
                                 self.prior,
                                 self.n_inits,
                                 self.max_opt_iters,
-                                random_state=self.random_state)
-
-        # Using the same location for all points in theta batch.
-        batch_theta = np.tile(theta_max, (n, 1))
-
-        return batch_theta
+                                random_state=self.random_state,
+                                vectorized=True)
+        return theta_max
 
     def evaluate(self, theta_new, t=None):
         """Evaluate the acquisition function at the location theta_new.
@@ -646,7 +685,6 @@ class ExpIntVar(MaxVar):
         """
         logger.debug('Acquiring the next batch of %d values', n)
         gp = self.model
-        self.sigma2_n = gp.noise
 
         # Updating the discrepancy threshold.
         self.eps = np.percentile(gp.Y, self.quantile_eps * 100)
@@ -656,7 +694,6 @@ class ExpIntVar(MaxVar):
             self.points_int = self.density_is.acquire(self._n_samples_imp)
 
         # Obtaining the omegas_int and priors_int terms to be used in the evaluate function.
-        self.mean_int, self.var_int = gp.predict(self.points_int, noiseless=True)
         self.priors_int = (self.prior.pdf(self.points_int)**2)[np.newaxis, :]
         if self._integration == 'importance' and t % self._iter_imp == 0:
             omegas_int_unnormalised = (1 / MaxVar.evaluate(self, self.points_int)).T
@@ -666,9 +703,16 @@ class ExpIntVar(MaxVar):
             self.omegas_int = np.empty(len(self.points_int))
             self.omegas_int.fill(1 / len(self.points_int))
 
+        return self._acquire_batch(n, t)
+
+    def _minimize(self, t):
+        gp = self.model
+        self.sigma2_n = gp.noise
+        self.mean_int, self.var_int = gp.predict(self.points_int, noiseless=True)
+
         # Initialising the attributes used in the evaluate function.
         self.thetas_old = np.array(gp.X)
-        self._K = gp._gp.kern.K
+        self._K = gp.kern.K
         self.K = self._K(self.thetas_old, self.thetas_old) + \
             self.sigma2_n * np.identity(self.thetas_old.shape[0])
         self.k_int_old = self._K(self.points_int, self.thetas_old).T
@@ -684,11 +728,9 @@ class ExpIntVar(MaxVar):
                                 prior=self.prior,
                                 n_start_points=self.n_inits,
                                 maxiter=self.max_opt_iters,
-                                random_state=self.random_state)
-
-        # Using the same location for all points in the batch.
-        batch_theta = np.tile(theta_min, (n, 1))
-        return batch_theta
+                                random_state=self.random_state,
+                                vectorized=True)
+        return theta_min
 
     def evaluate(self, theta_new, t=None):
         """Evaluate the acquisition function at the location theta_new.
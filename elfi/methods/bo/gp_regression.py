@@ -0,0 +1,864 @@
+"""This module contains a Gaussian process regression implemented with NumPy and SciPy."""
+
+import copy
+import logging
+
+import numpy as np
+import scipy.linalg as sl
+import scipy.optimize
+from scipy.spatial import cKDTree
+
+from elfi.methods.bo.utils import append_cholesky, parse_parameter_bounds
+
+logger = logging.getLogger(__name__)
+
+
+class Stationary:
+    """Base class for stationary kernels with ARD lengthscales and an optional bias.
+
+    The kernel is k(x, x') = variance * f(r) + bias, where r is the distance between x and x'
+    scaled by the lengthscale of each dimension. The hyperparameters are optimized in log space.
+    """
+
+    def __init__(self, input_dim, variance=1., lengthscale=1., bias=None):
+        """Initialize the kernel.
+
+        Parameters
+        ----------
+        input_dim : int
+        variance : float, optional
+        lengthscale : float or array_like, optional
+            A scalar is used for all the dimensions.
+        bias : float, optional
+            Variance of the constant term. If None, the kernel has no bias.
+
+        """
+        self.input_dim = input_dim
+        self.variance = float(variance)
+        self.lengthscale = np.ones(input_dim) * lengthscale
+        self.bias = None if bias is None else float(bias)
+
+    def __str__(self):
+        """Return the hyperparameters of the kernel."""
+        s = "{} kernel\n  variance: {:.4g}\n  lengthscale: {}".format(
+            self.__class__.__name__, self.variance, np.array2string(self.lengthscale, precision=4))
+        if self.bias is not None:
+            s += "\n  bias: {:.4g}".format(self.bias)
+        return s
+
+    @property
+    def n_params(self):
+        """Return the number of hyperparameters."""
+        return self.input_dim + 1 + (self.bias is not None)
+
+    def get_params(self):
+        """Return the logarithms of the variance, the lengthscales and the bias."""
+        params = np.log(np.r_[self.variance, self.lengthscale])
+        if self.bias is not None:
+            params = np.r_[params, np.log(self.bias)]
+        return params
+
+    def set_params(self, params):
+        """Set the hyperparameters from their logarithms."""
+        self.variance = float(np.exp(params[0]))
+        self.lengthscale = np.exp(params[1:self.input_dim + 1])
+        if self.bias is not None:
+            self.bias = float(np.exp(params[-1]))
+
+    def K(self, X, X2=None):
+        """Return the covariance matrix between X and X2."""
+        K = self.variance * self._f(self._r(X, X2))
+        if self.bias is not None:
+            K += self.bias
+        return K
+
+    def Kdiag(self, X):
+        """Return the variances at X."""
+        return np.full(len(X), self.variance + (self.bias or 0.))
+
+    def gradients_X(self, dL_dK, X, X2):
+        """Return the gradient of sum(dL_dK * K(X, X2)) with respect to X."""
+        W = dL_dK * self.variance * self._g(self._r(X, X2))
+        return (W.sum(1)[:, None] * X - W.dot(X2)) / self.lengthscale**2
+
+    def gradients_params(self, dL_dK, X, X2=None):
+        """Return the gradient of sum(dL_dK * K(X, X2)) with respect to `get_params()`."""
+        X2 = X if X2 is None else X2
+        r = self._r(X, X2)
+        grad_variance = self.variance * np.sum(dL_dK * self._f(r))
+
+        # dr_ij/dlog(l_k) = -(x_ik - x2_jk)**2 / (l_k**2 * r_ij) and f'(r) / r = g(r)
+        B = dL_dK * self.variance * self._g(r)
+        sq_dist = B.sum(1).dot(X**2) + B.sum(0).dot(X2**2) - 2. * np.sum(X * B.dot(X2), 0)
+        grad_lengthscale = -sq_dist / self.lengthscale**2
+
+        grad = np.r_[grad_variance, grad_lengthscale]
+        if self.bias is not None:
+            grad = np.r_[grad, self.bias * np.sum(dL_dK)]
+        return grad
+
+    def gradients_params_diag(self, dL_dKdiag):
+        """Return the gradient of sum(dL_dKdiag * Kdiag(X)) with respect to `get_params()`."""
+        grad = np.r_[self.variance * np.sum(dL_dKdiag), np.zeros(self.input_dim)]
+        if self.bias is not None:
+            grad = np.r_[grad, self.bias * np.sum(dL_dKdiag)]
+        return grad
+
+    def _r(self, X, X2=None):
+        X = X / self.lengthscale
+        X2 = X if X2 is None else X2 / self.lengthscale
+        r2 = np.sum(X**2., 1)[:, None] + np.sum(X2**2., 1)[None, :] - 2. * X.dot(X2.T)
+        return np.sqrt(np.clip(r2, 0, np.inf))
+
+    def _f(self, r):
+        """Return the correlation at the scaled distance r."""
+        raise NotImplementedError
+
+    def _g(self, r):
+        """Return f'(r) / r."""
+        raise NotImplementedError
+
+
+class RBF(Stationary):
+    """Squared exponential kernel."""
+
+    def _f(self, r):
+        return np.exp(-.5 * r**2.)
+
+    def _g(self, r):
+        return -np.exp(-.5 * r**2.)
+
+
+class Matern32(Stationary):
+    """Matern kernel with smoothness 3/2."""
+
+    def _f(self, r):
+        return (1. + np.sqrt(3.) * r) * np.exp(-np.sqrt(3.) * r)
+
+    def _g(self, r):
+        return -3. * np.exp(-np.sqrt(3.) * r)
+
+
+class Matern52(Stationary):
+    """Matern kernel with smoothness 5/2."""
+
+    def _f(self, r):
+        return (1. + np.sqrt(5.) * r + 5. / 3. * r**2.) * np.exp(-np.sqrt(5.) * r)
+
+    def _g(self, r):
+        return -5. / 3. * (1. + np.sqrt(5.) * r) * np.exp(-np.sqrt(5.) * r)
+
+
+class GPRegression:
+    """Gaussian process regression implemented with NumPy and SciPy.
+
+    An alternative to `GPyRegression` without the GPy dependency. The posterior is kept as
+    a Cholesky factor that is updated incrementally when new evidence arrives, and the
+    hyperparameters are found by maximizing the marginal likelihood with analytic gradients
+    from several starting points.
+    """
+
+    kernels = {'rbf': RBF, 'matern32': Matern32, 'matern52': Matern52}
+    # Bounds of the logarithms of the hyperparameters in optimization
+    param_bounds = (np.log(1e-6), np.log(1e6))
+
+    def __init__(self,
+                 parameter_names=None,
+                 bounds=None,
+                 kernel='rbf',
+                 noise_var=None,
+                 n_restarts=5,
+                 max_opt_iters=50,
+                 seed=None):
+        """Initialize GPRegression.
+
+        Parameters
+        ----------
+        parameter_names : list of str, optional
+            Names of parameter nodes. If None, sets dimension to 1.
+        bounds : dict, optional
+            The region where to estimate the posterior for each parameter in
+            model.parameters.
+            `{'parameter_name':(lower, upper), ... }`
+            If not supplied, defaults to (0, 1) bounds for all dimensions.
+        kernel : str or Stationary, optional
+            One of 'rbf', 'matern32' and 'matern52' or a kernel instance. For the named
+            kernels the initial hyperparameters and their priors are chosen from the initial
+            data and a bias term is added as in `GPyRegression`.
+        noise_var : float, optional
+            Initial noise variance. Defaults to max(y)**2 / 100 of the initial data.
+        n_restarts : int, optional
+            Number of starting points in the optimization of the hyperparameters. The first
+            one is the current hyperparameters and the rest are random perturbations of them.
+        max_opt_iters : int, optional
+            Maximum number of iterations from each starting point.
+        seed : int, optional
+            Seed for the starting points of the optimization.
+
+        """
+        input_dim, bounds = parse_parameter_bounds(parameter_names, bounds)
+
+        if isinstance(kernel, str) and kernel not in self.kernels:
+            raise ValueError("Unknown kernel {}. Use one of {}.".format(
+                kernel, sorted(self.kernels)))
+
+        self.input_dim = input_dim
+        self.bounds = bounds
+
+        self.kernel = kernel
+        self.noise_var = noise_var
+        self.n_restarts = n_restarts
+        self.max_opt_iters = max_opt_iters
+        self.random_state = np.random.RandomState(seed)
+
+        self.kern = None if isinstance(kernel, str) else copy.deepcopy(kernel)
+        # Gamma priors (shape, rate) of the hyperparameters including the noise or None
+        self._priors = None
+        self._noise_var = None
+
+        self._X = None
+        self._Y = None
+        self._chol = None
+        self._woodbury_vector = None
+
+        self.is_sampling = False  # set to True once in sampling phase
+
+    def __str__(self):
+        """Return the hyperparameters of the GP."""
+        if self.kern is None:
+            return "GPRegression with no evidence"
+        return "GPRegression with {} evidence points\n{}\n  noise variance: {:.4g}".format(
+            self.n_evidence, self.kern, self._noise_var)
+
+    def __repr__(self):
+        """Return the hyperparameters of the GP."""
+        return self.__str__()
+
+    def predict(self, x, noiseless=False):
+        """Return the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+        noiseless : bool
+            whether to include the noise variance or not to the returned variance
+
+        Returns
+        -------
+        tuple
+            GP (mean, var) at x where
+                mean : np.array
+                    with shape (x.shape[0], 1)
+                var : np.array
+                    with shape (x.shape[0], 1)
+
+        """
+        x = np.asanyarray(x).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], 1)), \
+                np.ones((x.shape[0], 1))
+
+        kx = self.kern.K(x, self._X)
+        mu = kx.dot(self._woodbury_vector)
+
+        v = sl.solve_triangular(self._chol, kx.T, lower=True)
+        var = self.kern.Kdiag(x)[:, None] - np.sum(v**2., 0)[:, None]
+        var = np.clip(var, 1e-15, np.inf)
+        if not noiseless:
+            var += self._noise_var
+
+        return mu, var
+
+    def predict_mean(self, x):
+        """Return the GP model mean function at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        np.array
+            with shape (x.shape[0], 1)
+
+        """
+        return self.predict(x)[0]
+
+    def predictive_gradients(self, x):
+        """Return the gradients of the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        tuple
+            GP (grad_mean, grad_var) at x where
+                grad_mean : np.array
+                    with shape (x.shape[0], input_dim)
+                grad_var : np.array
+                    with shape (x.shape[0], input_dim)
+
+        """
+        x = np.asanyarray(x).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], self.input_dim)), \
+                np.zeros((x.shape[0], self.input_dim))
+
+        n = len(x)
+        grad_mu = self.kern.gradients_X(np.tile(self._woodbury_vector.T, (n, 1)), x, self._X)
+
+        # The variance of a stationary kernel is constant, so only -k(x, X) K^{-1} k(X, x)
+        # depends on x
+        v = sl.cho_solve((self._chol, True), self.kern.K(self._X, x))
+        grad_var = self.kern.gradients_X(-2. * v.T, x, self._X)
+
+        return grad_mu, grad_var
+
+    def predictive_gradient_mean(self, x):
+        """Return the gradient of the GP model mean at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        np.array
+            with shape (x.shape[0], input_dim)
+
+        """
+        return self.predictive_gradients(x)[0]
+
+    def _init_kernel(self, x, y):
+        if self.kern is None:
+            # Same heuristics as in GPyRegression, with a lengthscale for each dimension
+            bounds = np.asarray(self.bounds, dtype=float)
+            length_scale = (bounds[:, 1] - bounds[:, 0]) / 3.
+            kernel_var = (np.max(y) / 3.)**2. or 1.
+            bias_var = kernel_var / 4.
+
+            self.kern = self.kernels[self.kernel](
+                self.input_dim, variance=kernel_var, lengthscale=length_scale, bias=bias_var)
+
+            # Gamma priors with the initial values as their mean and variance
+            self._priors = [(kernel_var, 1.)] + [(scale, 1.) for scale in length_scale] + \
+                [(bias_var, 1.), None]
+
+        self._noise_var = self.noise_var or max(np.max(y)**2. / 100., 1e-6)
+
+    def update(self, x, y, optimize=False):
+        """Update the GP model with new data.
+
+        Parameters
+        ----------
+        x : np.array
+        y : np.array
+        optimize : bool, optional
+            Whether to optimize hyperparameters.
+
+        """
+        x = np.asanyarray(x).reshape((-1, self.input_dim))
+        y = np.asanyarray(y).reshape((-1, 1))
+
+        if self._noise_var is None:
+            self._init_kernel(x, y)
+
+        if self._X is not None and not optimize:
+            try:
+                self._update_incremental(x, y)
+                return
+            except np.linalg.LinAlgError:
+                logger.warning("Numerical error in the incremental GP update. Refitting the GP")
+
+        self._X = x if self._X is None else np.r_[self._X, x]
+        self._Y = y if self._Y is None else np.r_[self._Y, y]
+        if optimize:
+            self.optimize()
+        else:
+            self._fit()
+
+    def _noise_diag(self, n, noise_var):
+        # Jitter for the numerical stability of the Cholesky decomposition
+        return (noise_var + 1e-8) * np.eye(n)
+
+    def _fit(self):
+        K = self.kern.K(self._X) + self._noise_diag(len(self._X), self._noise_var)
+        self._chol = np.linalg.cholesky(K)
+        self._woodbury_vector = sl.cho_solve((self._chol, True), self._Y)
+
+    def _update_incremental(self, x, y):
+        k_new = self.kern.K(x) + self._noise_diag(len(x), self._noise_var)
+        chol = append_cholesky(self._chol, self.kern.K(self._X, x), k_new)
+
+        Y = np.r_[self._Y, y]
+        self._woodbury_vector = sl.cho_solve((chol, True), Y)
+        self._X = np.r_[self._X, x]
+        self._Y, self._chol = Y, chol
+
+    def _objective(self, params, kern):
+        """Return the negative log marginal likelihood and log prior and its gradient.
+
+        Parameters
+        ----------
+        params : np.ndarray
+            Logarithms of the kernel hyperparameters and the noise variance.
+        kern : Stationary
+            Kernel whose hyperparameters are set to `params`.
+
+        """
+        X, Y = self._X, self._Y
+        n = len(X)
+        kern.set_params(params[:-1])
+        noise_var = np.exp(params[-1])
+
+        chol = np.linalg.cholesky(kern.K(X) + self._noise_diag(n, noise_var))
+        alpha = sl.cho_solve((chol, True), Y)
+        value = .5 * Y[:, 0].dot(alpha[:, 0]) + np.sum(np.log(np.diag(chol))) + \
+            .5 * n * np.log(2. * np.pi)
+
+        # dlog p(Y)/dtheta = 1/2 tr((alpha alpha^T - K^{-1}) dK/dtheta)
+        dL_dK = .5 * (alpha.dot(alpha.T) - sl.cho_solve((chol, True), np.eye(n)))
+        grad = -np.r_[kern.gradients_params(dL_dK, X), noise_var * np.trace(dL_dK)]
+
+        log_prior, grad_log_prior = self._log_prior(params)
+        return value - log_prior, grad - grad_log_prior
+
+    def _log_prior(self, params):
+        # Gamma priors of the hyperparameters in log space including the Jacobian
+        value = 0.
+        grad = np.zeros(len(params))
+        if self._priors is None:
+            return value, grad
+
+        for i, prior in enumerate(self._priors):
+            if prior is None:
+                continue
+            shape, rate = prior
+            value += shape * params[i] - rate * np.exp(params[i])
+            grad[i] = shape - rate * np.exp(params[i])
+        return value, grad
+
+    def optimize(self):
+        """Optimize GP hyperparameters."""
+        logger.debug("Optimizing GP hyperparameters")
+        if self._X is None:
+            return
+
+        kern = copy.deepcopy(self.kern)
+        params = np.r_[self.kern.get_params(), np.log(self._noise_var)]
+        bounds = [self.param_bounds] * len(params)
+
+        best = None
+        for i in range(self.n_restarts):
+            start = params if i == 0 else params + self.random_state.normal(size=len(params))
+            start = np.clip(start, *self.param_bounds)
+            try:
+                result = scipy.optimize.minimize(
+                    self._objective,
+                    start,
+                    args=(kern, ),
+                    jac=True,
+                    method='L-BFGS-B',
+                    bounds=bounds,
+                    options={'maxiter': self.max_opt_iters})
+            except np.linalg.LinAlgError:
+                continue
+            if np.isfinite(result.fun) and (best is None or result.fun < best.fun):
+                best = result
+
+        if best is None:
+            logger.warning("Numerical error in GP optimization. Keeping the hyperparameters")
+        else:
+            self.kern.set_params(best.x[:-1])
+            self._noise_var = float(np.exp(best.x[-1]))
+        self._fit()
+
+    @property
+    def n_evidence(self):
+        """Return the number of observed samples."""
+        if self._X is None:
+            return 0
+        return len(self._X)
+
+    @property
+    def X(self):
+        """Return input evidence."""
+        return self._X
+
+    @property
+    def Y(self):
+        """Return output evidence."""
+        return self._Y
+
+    @property
+    def noise(self):
+        """Return the noise."""
+        return self._noise_var
+
+    @property
+    def instance(self):
+        """Return the gp instance."""
+        return self
+
+    def copy(self):
+        """Return a copy of current instance."""
+        kopy = copy.copy(self)
+        kopy.kern = copy.deepcopy(self.kern)
+        kopy.random_state = copy.deepcopy(self.random_state)
+        return kopy
+
+
+class SparseGPRegression(GPRegression):
+    """Sparse Gaussian process regression with inducing points.
+
+    The GP is approximated with `n_inducing` inducing points using the variational free
+    energy (VFE) or the fully independent training conditional (FITC) approximation. Fitting
+    the model costs O(n m^2) and the predictions and their gradients O(m^2) per point for m
+    inducing points. The inducing points are chosen by k-means or by greedy variance reduction
+    whenever the hyperparameters are optimized, and new evidence is added to the sufficient
+    statistics of the approximation in between.
+    """
+
+    # Number of evidence points processed at a time
+    block_size = 2**12
+    n_kmeans_iters = 10
+
+    def __init__(self,
+                 parameter_names=None,
+                 bounds=None,
+                 kernel='rbf',
+                 noise_var=None,
+                 n_inducing=100,
+                 inducing='kmeans',
+                 approximation='vfe',
+                 n_restarts=1,
+                 max_opt_iters=50,
+                 seed=None):
+        """Initialize SparseGPRegression.
+
+        Parameters
+        ----------
+        parameter_names : list of str, optional
+            Names of parameter nodes. If None, sets dimension to 1.
+        bounds : dict, optional
+            The region where to estimate the posterior for each parameter in
+            model.parameters.
+            `{'parameter_name':(lower, upper), ... }`
+            If not supplied, defaults to (0, 1) bounds for all dimensions.
+        kernel : str or Stationary, optional
+            See `GPRegression`.
+        noise_var : float, optional
+            Initial noise variance. Defaults to max(y)**2 / 100 of the initial data.
+        n_inducing : int, optional
+            Number of inducing points. All the evidence is used while there is less of it.
+        inducing : str, optional
+            How to choose the inducing points: 'kmeans' for the centers of k-means clusters
+            of the evidence in the metric of the kernel or 'greedy' for evidence points
+            chosen one by one to maximally reduce the variance of the approximation.
+        approximation : str, optional
+            'vfe' or 'fitc'.
+        n_restarts : int, optional
+            Number of starting points in the optimization of the hyperparameters.
+        max_opt_iters : int, optional
+            Maximum number of iterations from each starting point.
+        seed : int, optional
+            Seed for the inducing points and the starting points of the optimization.
+
+        """
+        if inducing not in ('kmeans', 'greedy'):
+            raise ValueError("Unknown method {} for choosing the inducing points. Use "
+                             "'kmeans' or 'greedy'.".format(inducing))
+        if approximation not in ('vfe', 'fitc'):
+            raise ValueError("Unknown approximation {}. Use 'vfe' or 'fitc'.".format(
+                approximation))
+
+        super(SparseGPRegression, self).__init__(
+            parameter_names=parameter_names,
+            bounds=bounds,
+            kernel=kernel,
+            noise_var=noise_var,
+            n_restarts=n_restarts,
+            max_opt_iters=max_opt_iters,
+            seed=seed)
+
+        self.n_inducing = n_inducing
+        self.inducing = inducing
+        self.approximation = approximation
+
+        self.Z = None
+        self._stats = None
+        self._W = None
+
+    def __str__(self):
+        """Return the hyperparameters of the GP."""
+        s = super(SparseGPRegression, self).__str__()
+        if self.Z is not None:
+            s += "\n  inducing points: {}".format(len(self.Z))
+        return s
+
+    def predict(self, x, noiseless=False):
+        """Return the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+        noiseless : bool
+            whether to include the noise variance or not to the returned variance
+
+        Returns
+        -------
+        tuple
+            GP (mean, var) at x where
+                mean : np.array
+                    with shape (x.shape[0], 1)
+                var : np.array
+                    with shape (x.shape[0], 1)
+
+        """
+        x = np.asanyarray(x).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], 1)), \
+                np.ones((x.shape[0], 1))
+
+        kx = self.kern.K(x, self.Z)
+        mu = kx.dot(self._woodbury_vector)
+
+        var = self.kern.Kdiag(x)[:, None] - np.sum(kx.dot(self._W) * kx, 1)[:, None]
+        var = np.clip(var, 1e-15, np.inf)
+        if not noiseless:
+            var += self._noise_var
+
+        return mu, var
+
+    def predictive_gradients(self, x):
+        """Return the gradients of the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        tuple
+            GP (grad_mean, grad_var) at x where
+                grad_mean : np.array
+                    with shape (x.shape[0], input_dim)
+                grad_var : np.array
+                    with shape (x.shape[0], input_dim)
+
+        """
+        x = np.asanyarray(x).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], self.input_dim)), \
+                np.zeros((x.shape[0], self.input_dim))
+
+        n = len(x)
+        grad_mu = self.kern.gradients_X(np.tile(self._woodbury_vector.T, (n, 1)), x, self.Z)
+        kx = self.kern.K(x, self.Z)
+        grad_var = self.kern.gradients_X(-2. * kx.dot(self._W), x, self.Z)
+
+        return grad_mu, grad_var
+
+    def _select_inducing(self, kern):
+        X = self._X
+        m = self.n_inducing
+        if len(X) <= m:
+            return X.copy()
+
+        if self.inducing == 'kmeans':
+            x = X / kern.lengthscale
+            centers = x[self.random_state.choice(len(x), m, replace=False)]
+            for i in range(self.n_kmeans_iters):
+                labels = cKDTree(centers).query(x)[1]
+                counts = np.bincount(labels, minlength=m)
+                sums = np.zeros_like(centers)
+                np.add.at(sums, labels, x)
+                nonempty = counts > 0
+                centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+            return centers * kern.lengthscale
+
+        # Greedy variance reduction is a pivoted Cholesky decomposition of K(X, X)
+        residual = kern.Kdiag(X)
+        factor = np.empty((m, len(X)))
+        inds = []
+        for j in range(m):
+            i = np.argmax(residual)
+            if residual[i] <= 0:
+                break
+            inds.append(i)
+            row = kern.K(X[i:i + 1], X)[0] - factor[:j, i].dot(factor[:j])
+            factor[j] = row / np.sqrt(residual[i])
+            residual = residual - factor[j]**2
+            residual[i] = 0.
+        return X[inds]
+
+    def _chol_uu(self, kern):
+        # The same jitter as in the sparse inference of GPy
+        return np.linalg.cholesky(kern.K(self.Z) + 1e-6 * np.eye(len(self.Z)))
+
+    def _statistics(self, kern, noise_var, chol_uu, x, y):
+        """Return the sufficient statistics of evidence x, y given the inducing points.
+
+        With V = L_uu^{-1} K_uf and the diagonal Lambda of the noise of the approximation the
+        statistics are [V Lambda^{-1} V^T, V Lambda^{-1} y, y^T Lambda^{-1} y,
+        log |Lambda|, tr(K_ff - Q_ff)]. They are additive over the evidence points.
+        """
+        m = len(chol_uu)
+        stats = [np.zeros((m, m)), np.zeros((m, 1)), 0., 0., 0.]
+        for i in range(0, len(x), self.block_size):
+            x_block, y_block = x[i:i + self.block_size], y[i:i + self.block_size]
+            V = sl.solve_triangular(chol_uu, kern.K(self.Z, x_block), lower=True)
+            residual = np.clip(kern.Kdiag(x_block) - np.sum(V**2., 0), 0, np.inf)
+            lam = noise_var + residual if self.approximation == 'fitc' else \
+                np.full(len(x_block), noise_var)
+
+            V_scaled = V / np.sqrt(lam)
+            stats[0] += V_scaled.dot(V_scaled.T)
+            stats[1] += V.dot(y_block / lam[:, None])
+            stats[2] += np.sum(y_block[:, 0]**2. / lam)
+            stats[3] += np.sum(np.log(lam))
+            stats[4] += np.sum(residual)
+        return stats
+
+    def _log_likelihood(self, stats, noise_var, n):
+        """Return the approximate log marginal likelihood and the Cholesky factor of B.
+
+        B = I + V Lambda^{-1} V^T so that Q_ff + Lambda = Lambda + K_fu K_uu^{-1} K_uf has
+        log |Q_ff + Lambda| = log |B| + log |Lambda|.
+        """
+        P, p, yly, log_det, trace = stats
+        chol_b = np.linalg.cholesky(np.eye(len(P)) + P)
+        c = sl.solve_triangular(chol_b, p, lower=True)
+
+        log_likelihood = -.5 * (yly - np.sum(c**2.) + log_det + n * np.log(2. * np.pi)) - \
+            np.sum(np.log(np.diag(chol_b)))
+        if self.approximation == 'vfe':
+            log_likelihood -= .5 * trace / noise_var
+        return log_likelihood, chol_b, c
+
+    def _set_posterior(self, chol_uu):
+        _, chol_b, c = self._log_likelihood(self._stats, self._noise_var, len(self._X))
+        m = len(chol_uu)
+
+        # mean(x) = k_xu K_uu^{-T/2} B^{-1} V Lambda^{-1} y
+        v = sl.solve_triangular(chol_b, c, lower=True, trans='T')
+        self._woodbury_vector = sl.solve_triangular(chol_uu, v, lower=True, trans='T')
+
+        # var(x) = k_xx - k_xu K_uu^{-T/2} (I - B^{-1}) K_uu^{-1/2} k_ux
+        chol_uu_inv = sl.solve_triangular(chol_uu, np.eye(m), lower=True)
+        B_inv = sl.cho_solve((chol_b, True), np.eye(m))
+        self._W = chol_uu_inv.T.dot(np.eye(m) - B_inv).dot(chol_uu_inv)
+
+    def _fit(self):
+        if self.Z is None:
+            self.Z = self._select_inducing(self.kern)
+        chol_uu = self._chol_uu(self.kern)
+        self._stats = self._statistics(self.kern, self._noise_var, chol_uu, self._X, self._Y)
+        self._set_posterior(chol_uu)
+
+    def _update_incremental(self, x, y):
+        chol_uu = self._chol_uu(self.kern)
+        stats = self._statistics(self.kern, self._noise_var, chol_uu, x, y)
+        stats = [s + s_new for s, s_new in zip(self._stats, stats)]
+
+        X = np.r_[self._X, x]
+        Y = np.r_[self._Y, y]
+        self._stats = stats
+        self._X, self._Y = X, Y
+        self._set_posterior(chol_uu)
+
+    def _objective(self, params, kern):
+        """Return the negative approximate log marginal likelihood and log prior and its gradient.
+
+        The log marginal likelihood is differentiated with respect to K_uu, K_uf, the diagonal
+        of K_ff and the noise variance, which are then chained to the hyperparameters. With
+        A = Q_ff + Lambda and G = (alpha alpha^T - A^{-1}) / 2 for alpha = A^{-1} y, only the
+        products V G and V G V^T are needed, so that the cost is O(n m^2) as for the fit.
+
+        Parameters
+        ----------
+        params : np.ndarray
+            Logarithms of the kernel hyperparameters and the noise variance.
+        kern : Stationary
+            Kernel whose hyperparameters are set to `params`.
+
+        """
+        X, Y, Z = self._X, self._Y, self.Z
+        kern.set_params(params[:-1])
+        noise_var = np.exp(params[-1])
+        fitc = self.approximation == 'fitc'
+
+        chol_uu = self._chol_uu(kern)
+        stats = self._statistics(kern, noise_var, chol_uu, X, Y)
+        log_likelihood, chol_b, c = self._log_likelihood(stats, noise_var, len(X))
+
+        # beta = B^{-1} V Lambda^{-1} y = V alpha
+        m = len(chol_uu)
+        beta = sl.solve_triangular(chol_b, c, lower=True, trans='T')
+        B_inv = sl.cho_solve((chol_b, True), np.eye(m))
+        # V G V^T = (beta beta^T - I + B^{-1}) / 2 plus the terms of the diagonal of G
+        VGV = .5 * (beta.dot(beta.T) - np.eye(m) + B_inv)
+
+        grad_kern = np.zeros(kern.n_params)
+        dL_dnoise = 0.
+        for i in range(0, len(X), self.block_size):
+            x_block, y_block = X[i:i + self.block_size], Y[i:i + self.block_size]
+            V = sl.solve_triangular(chol_uu, kern.K(Z, x_block), lower=True)
+            residual = kern.Kdiag(x_block) - np.sum(V**2., 0)
+            positive = residual > 0
+            lam = noise_var + np.clip(residual, 0, np.inf) if fitc else \
+                np.full(len(x_block), noise_var)
+
+            # Diagonal of G with diag(A^{-1}) = 1 / lambda - |L_B^{-1} V|^2 / lambda^2
+            alpha = (y_block[:, 0] - V.T.dot(beta[:, 0])) / lam
+            diag_A_inv = 1. / lam - np.sum(sl.solve_triangular(chol_b, V, lower=True)**2., 0) / \
+                lam**2.
+            g = .5 * (alpha**2. - diag_A_inv)
+            dL_dnoise += np.sum(g)
+
+            # Derivatives with respect to the diagonal of Q_ff through Lambda in FITC or
+            # through the trace term in VFE, which K_ff enters with the opposite sign
+            if fitc:
+                h = np.where(positive, -g, 0.)
+            else:
+                h = np.where(positive, .5 / noise_var, 0.)
+                dL_dnoise += .5 * np.sum(np.clip(residual, 0, np.inf)) / noise_var**2.
+
+            VG = .5 * (beta.dot(alpha[None, :]) - B_inv.dot(V / lam)) + V * h
+            VGV += (V * h).dot(V.T)
+            dL_dKuf = 2. * sl.solve_triangular(chol_uu, VG, lower=True, trans='T')
+            grad_kern += kern.gradients_params(dL_dKuf, Z, x_block)
+            grad_kern += kern.gradients_params_diag(-h)
+
+        chol_uu_inv = sl.solve_triangular(chol_uu, np.eye(m), lower=True)
+        dL_dKuu = -chol_uu_inv.T.dot(VGV).dot(chol_uu_inv)
+        grad_kern += kern.gradients_params(dL_dKuu, Z)
+
+        grad = -np.r_[grad_kern, noise_var * dL_dnoise]
+        log_prior, grad_log_prior = self._log_prior(params)
+        return -log_likelihood - log_prior, grad - grad_log_prior
+
+    def optimize(self):
+        """Choose the inducing points and optimize GP hyperparameters."""
+        if self._X is None:
+            return
+        self.Z = self._select_inducing(self.kern)
+        super(SparseGPRegression, self).optimize()
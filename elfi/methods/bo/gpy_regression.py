@@ -2,11 +2,13 @@
 
 # TODO: make own general GPRegression and kernel classes
 
-import copy
 import logging
 
 import GPy
 import numpy as np
+import scipy.linalg as sl
+
+from elfi.methods.bo.utils import append_cholesky, parse_parameter_bounds
 
 logger = logging.getLogger(__name__)
 logging.getLogger("GP").setLevel(logging.WARNING)  # GPy library logger
@@ -24,6 +26,7 @@ class GPyRegression:
                  optimizer="scg",
                  max_opt_iters=50,
                  gp=None,
+                 incremental=False,
                  **gp_params):
         """Initialize GPyRegression.
 
@@ -42,36 +45,18 @@ class GPyRegression:
             See also: paramz.Model.optimize()
         max_opt_iters : int, optional
         gp : GPy.model.GPRegression instance, optional
+        incremental : bool, optional
+            Whether to add new data to the Cholesky factor of the current covariance with a
+            rank-k update instead of reconstructing the GPy model when the hyperparameters
+            are not optimized. The GPy model is reconstructed with all the data when the
+            hyperparameters are optimized or when `instance` is requested.
         **gp_params
             kernel : GPy.Kern
             noise_var : float
             mean_function
 
         """
-        if parameter_names is None:
-            input_dim = 1
-        elif isinstance(parameter_names, (list, tuple)):
-            input_dim = len(parameter_names)
-        else:
-            raise ValueError("Keyword `parameter_names` must be a list of strings")
-
-        if bounds is None:
-            logger.warning('Parameter bounds not specified. Using [0,1] for each parameter.')
-            bounds = [(0, 1)] * input_dim
-        elif len(bounds) != input_dim:
-            raise ValueError(
-                'Length of `bounds` ({}) does not match the length of `parameter_names` ({}).'
-                .format(len(bounds), input_dim))
-
-        elif isinstance(bounds, dict):
-            if len(bounds) == 1:  # might be the case parameter_names=None
-                bounds = [bounds[n] for n in bounds.keys()]
-            else:
-                # turn bounds dict into a list in the same order as parameter_names
-                bounds = [bounds[n] for n in parameter_names]
-        else:
-            raise ValueError("Keyword `bounds` must be a dictionary "
-                             "`{'parameter_name': (lower, upper), ... }`")
+        input_dim, bounds = parse_parameter_bounds(parameter_names, bounds)
 
         self.input_dim = input_dim
         self.bounds = bounds
@@ -83,6 +68,13 @@ class GPyRegression:
 
         self._gp = gp
 
+        self.incremental = incremental
+        # Data and posterior added incrementally after the GPy model was constructed
+        self._X = None
+        self._Y = None
+        self._chol = None
+        self._woodbury_vector = None
+
         self._rbf_is_cached = False
         self.is_sampling = False  # set to True once in sampling phase
 
@@ -128,7 +120,7 @@ class GPyRegression:
             if not self._rbf_is_cached:
                 self._cache_RBF_kernel()
 
-            r2 = np.sum(x**2., 1)[:, None] + self._rbf_x2sum - 2. * x.dot(self._gp.X.T)
+            r2 = np.sum(x**2., 1)[:, None] + self._rbf_x2sum - 2. * x.dot(self._rbf_x.T)
             kx = self._rbf_var * np.exp(r2 * self._rbf_factor) + self._rbf_bias
             mu = kx.dot(self._rbf_woodbury)
 
@@ -140,7 +132,9 @@ class GPyRegression:
         else:
             self._rbf_is_cached = False  # in case one resumes fitting the GP after sampling
 
-        if noiseless:
+        if self._X is not None:
+            return self._predict_incremental(x, noiseless)
+        elif noiseless:
             return self._gp.predict_noiseless(x)
         else:
             return self._gp.predict(x)
@@ -152,12 +146,49 @@ class GPyRegression:
         self._rbf_factor = -0.5 / float(self._gp.kern.rbf.lengthscale)**2
         self._rbf_bias = float(self._gp.kern.bias.K(self._gp.X)[0, 0])
         self._rbf_noisevar = float(self._gp.likelihood.variance[0])
-        self._rbf_woodbury = self._gp.posterior.woodbury_vector
-        self._rbf_woodbury_inv = self._gp.posterior.woodbury_inv
-        self._rbf_woodbury_chol = self._gp.posterior.woodbury_chol
-        self._rbf_x2sum = np.sum(self._gp.X**2., 1)[None, :]
+        if self._X is None:
+            self._rbf_woodbury = self._gp.posterior.woodbury_vector
+            self._rbf_woodbury_inv = self._gp.posterior.woodbury_inv
+            self._rbf_woodbury_chol = self._gp.posterior.woodbury_chol
+        else:
+            self._rbf_woodbury = self._woodbury_vector
+            self._rbf_woodbury_inv = sl.cho_solve((self._chol, True), np.eye(len(self._chol)))
+            self._rbf_woodbury_chol = self._chol
+        self._rbf_x = np.asarray(self.X)
+        self._rbf_x2sum = np.sum(self._rbf_x**2., 1)[None, :]
         self._rbf_is_cached = True
 
+    def _mean(self, x):
+        if self._gp.mean_function is None:
+            return 0.
+        return self._gp.mean_function.f(x)
+
+    def _predict_incremental(self, x, noiseless):
+        kern = self._gp.kern
+        kx = kern.K(x, self._X)
+        mu = kx.dot(self._woodbury_vector) + self._mean(x)
+
+        v = sl.solve_triangular(self._chol, kx.T, lower=True)
+        var = kern.Kdiag(x)[:, None] - np.sum(v**2., 0)[:, None]
+        var = np.clip(var, 1e-15, np.inf)
+        if not noiseless:
+            var += self.noise
+
+        return mu, var
+
+    def _predictive_gradients_incremental(self, x):
+        kern = self._gp.kern
+        n = len(x)
+        grad_mu = kern.gradients_X(np.tile(self._woodbury_vector.T, (n, 1)), x, self._X)
+        if self._gp.mean_function is not None:
+            grad_mu = grad_mu + self._gp.mean_function.gradients_X(np.ones((n, 1)), x)
+
+        # K^{-1} k(X, x) for the gradient of -k(x, X) K^{-1} k(X, x)
+        v = sl.cho_solve((self._chol, True), kern.K(self._X, x))
+        grad_var = kern.gradients_X_diag(np.ones(n), x) + kern.gradients_X(-2. * v.T, x, self._X)
+
+        return grad_mu, grad_var
+
     def predict_mean(self, x):
         """Return the GP model mean function at x.
 
@@ -207,14 +238,16 @@ class GPyRegression:
             if not self._rbf_is_cached:
                 self._cache_RBF_kernel()
 
-            r2 = np.sum(x**2., 1)[:, None] + self._rbf_x2sum - 2. * x.dot(self._gp.X.T)
+            r2 = np.sum(x**2., 1)[:, None] + self._rbf_x2sum - 2. * x.dot(self._rbf_x.T)
             kx = self._rbf_var * np.exp(r2 * self._rbf_factor)
-            dkdx = 2. * self._rbf_factor * (x - self._gp.X) * kx.T
+            dkdx = 2. * self._rbf_factor * (x - self._rbf_x) * kx.T
             grad_mu = dkdx.T.dot(self._rbf_woodbury).T
 
             v = np.linalg.solve(self._rbf_woodbury_chol, kx.T + self._rbf_bias)
             dvdx = np.linalg.solve(self._rbf_woodbury_chol, dkdx)
             grad_var = -2. * dvdx.T.dot(v).T
+        elif self._X is not None:
+            grad_mu, grad_var = self._predictive_gradients_incremental(x)
         else:
             grad_mu, grad_var = self._gp.predictive_gradients(x)
             grad_mu = grad_mu[:, :, 0]  # Assume 1D output (distance in ABC)
@@ -297,25 +330,62 @@ class GPyRegression:
         x = x.reshape((-1, self.input_dim))
         y = y.reshape((-1, 1))
 
+        self._rbf_is_cached = False
+
         if self._gp is None:
             self._init_gp(x, y)
+        elif self.incremental and not optimize:
+            try:
+                self._update_incremental(x, y)
+            except np.linalg.LinAlgError:
+                logger.warning("Numerical error in the incremental GP update. Reconstructing "
+                               "the GP")
+                self._reconstruct(x, y)
         else:
-            # Reconstruct with new data
-            x = np.r_[self._gp.X, x]
-            y = np.r_[self._gp.Y, y]
-            # It seems that GPy will do some optimization unless you make copies of everything
-            kernel = self._gp.kern.copy() if self._gp.kern else None
-            noise_var = self._gp.Gaussian_noise.variance[0]
-            mean_function = self._gp.mean_function.copy() if self._gp.mean_function else None
-            self._gp = self._make_gpy_instance(
-                x, y, kernel=kernel, noise_var=noise_var, mean_function=mean_function)
+            self._reconstruct(x, y)
 
         if optimize:
             self.optimize()
 
+    def _reconstruct(self, x=None, y=None):
+        # Reconstruct the GPy model with all the data
+        if x is not None:
+            x = np.r_[self.X, x]
+            y = np.r_[self.Y, y]
+        else:
+            x, y = self.X, self.Y
+        # It seems that GPy will do some optimization unless you make copies of everything
+        kernel = self._gp.kern.copy() if self._gp.kern else None
+        noise_var = self._gp.Gaussian_noise.variance[0]
+        mean_function = self._gp.mean_function.copy() if self._gp.mean_function else None
+        self._gp = self._make_gpy_instance(
+            x, y, kernel=kernel, noise_var=noise_var, mean_function=mean_function)
+
+        self._X = self._Y = self._chol = self._woodbury_vector = None
+
+    def _update_incremental(self, x, y):
+        if self._X is None:
+            X, Y = np.asarray(self._gp.X), np.asarray(self._gp.Y)
+            chol = self._gp.posterior.woodbury_chol
+        else:
+            X, Y, chol = self._X, self._Y, self._chol
+
+        kern = self._gp.kern
+        # GPy adds the same jitter to the diagonal in the exact inference
+        k_new = kern.K(x) + (self.noise + 1e-8) * np.eye(len(x))
+        chol = append_cholesky(chol, kern.K(X, x), k_new)
+
+        X = np.r_[X, x]
+        Y = np.r_[Y, y]
+        self._woodbury_vector = sl.cho_solve((chol, True), Y - self._mean(X))
+        self._X, self._Y, self._chol = X, Y, chol
+
     def optimize(self):
         """Optimize GP hyperparameters."""
         logger.debug("Optimizing GP hyperparameters")
+        if self._X is not None:
+            self._reconstruct()
+        self._rbf_is_cached = False
         try:
             self._gp.optimize(self.optimizer, max_iters=self.max_opt_iters)
         except np.linalg.linalg.LinAlgError:
@@ -326,16 +396,20 @@ class GPyRegression:
         """Return the number of observed samples."""
         if self._gp is None:
             return 0
-        return self._gp.num_data
+        return len(self.X)
 
     @property
     def X(self):
         """Return input evidence."""
+        if self._X is not None:
+            return self._X
         return self._gp.X
 
     @property
     def Y(self):
         """Return output evidence."""
+        if self._Y is not None:
+            return self._Y
         return self._gp.Y
 
     @property
@@ -343,14 +417,28 @@ class GPyRegression:
         """Return the noise."""
         return self._gp.Gaussian_noise.variance[0]
 
+    @property
+    def kern(self):
+        """Return the kernel of the gp without reconstructing the gp instance.
+
+        The incremental updates do not change the hyperparameters, so the kernel is up to
+        date also when the gp instance is not.
+        """
+        return self._gp.kern
+
     @property
     def instance(self):
         """Return the gp instance."""
+        if self._X is not None:
+            self._reconstruct()
         return self._gp
 
     def copy(self):
         """Return a copy of current instance."""
-        kopy = copy.copy(self)
+        # copy.copy would call __copy__ and recurse
+        kopy = self.__class__.__new__(self.__class__)
+        kopy.__dict__.update(self.__dict__)
+        kopy.gp_params = dict(self.gp_params)
         if self._gp:
             kopy._gp = self._gp.copy()
 
@@ -1,9 +1,95 @@
 """Utilities for Bayesian optimization."""
 
+import logging
+
 import numpy as np
+import scipy.linalg as sl
 import scipy.optimize
 from scipy.optimize import differential_evolution
 
+logger = logging.getLogger(__name__)
+
+
+def parse_parameter_bounds(parameter_names=None, bounds=None):
+    """Return the input dimension and a list of bounds in the order of `parameter_names`.
+
+    Parameters
+    ----------
+    parameter_names : list of str, optional
+        Names of parameter nodes. If None, sets dimension to 1.
+    bounds : dict, optional
+        `{'parameter_name':(lower, upper), ... }`
+        If not supplied, defaults to (0, 1) bounds for all dimensions.
+
+    Returns
+    -------
+    tuple
+        (input_dim, bounds)
+
+    """
+    if parameter_names is None:
+        input_dim = 1
+    elif isinstance(parameter_names, (list, tuple)):
+        input_dim = len(parameter_names)
+    else:
+        raise ValueError("Keyword `parameter_names` must be a list of strings")
+
+    if bounds is None:
+        logger.warning('Parameter bounds not specified. Using [0,1] for each parameter.')
+        bounds = [(0, 1)] * input_dim
+    elif len(bounds) != input_dim:
+        raise ValueError(
+            'Length of `bounds` ({}) does not match the length of `parameter_names` ({}).'
+            .format(len(bounds), input_dim))
+
+    elif isinstance(bounds, dict):
+        if len(bounds) == 1:  # might be the case parameter_names=None
+            bounds = [bounds[n] for n in bounds.keys()]
+        else:
+            # turn bounds dict into a list in the same order as parameter_names
+            bounds = [bounds[n] for n in parameter_names]
+    else:
+        raise ValueError("Keyword `bounds` must be a dictionary "
+                         "`{'parameter_name': (lower, upper), ... }`")
+
+    return input_dim, bounds
+
+
+def append_cholesky(chol, k_cross, k_new):
+    """Append rows and columns to the lower Cholesky factor of a covariance matrix.
+
+    The factor of [[K, k_cross], [k_cross^T, k_new]] is [[L, 0], [S^T, M]], where L S = k_cross
+    and M M^T = k_new - S^T S, so that adding k points to n costs O(n^2 k).
+
+    Parameters
+    ----------
+    chol : np.ndarray
+        Lower Cholesky factor L of the (n, n) covariance K.
+    k_cross : np.ndarray
+        Covariance between the old and the new points with shape (n, k).
+    k_new : np.ndarray
+        Covariance of the new points with shape (k, k).
+
+    Returns
+    -------
+    np.ndarray
+        Lower Cholesky factor with shape (n + k, n + k).
+
+    Raises
+    ------
+    np.linalg.LinAlgError
+        If the appended covariance is not positive definite.
+
+    """
+    n, k = k_cross.shape
+    S = sl.solve_triangular(chol, k_cross, lower=True)
+
+    appended = np.zeros((n + k, n + k))
+    appended[:n, :n] = chol
+    appended[n:, :n] = S.T
+    appended[n:, n:] = np.linalg.cholesky(k_new - S.T.dot(S))
+    return appended
+
 
 # TODO: remove or combine to minimize
 def stochastic_optimization(fun, bounds, maxiter=1000, polish=True, seed=0):
@@ -40,7 +126,9 @@ def minimize(fun,
              prior=None,
              n_start_points=10,
              maxiter=1000,
-             random_state=None):
+             random_state=None,
+             vectorized=False,
+             prune_interval=10):
     """Find the minimum of function 'fun'.
 
     Parameters
@@ -59,6 +147,15 @@ def minimize(fun,
         Maximum number of iterations.
     random_state : np.random.RandomState, optional
         Used only if no elfi.Priors given.
+    vectorized : bool, optional
+        Whether `fun` and `grad` accept an array of points with shape (n, ndim) and return
+        n values and an (n, ndim) array of gradients. If True, the optimizations from all
+        the initialization points are run simultaneously, each with its own L-BFGS memory,
+        line search and convergence, but with a single call of `fun` and `grad` per
+        iteration. The worse half of the points still iterating stops every
+        `prune_interval` iterations.
+    prune_interval : int, optional
+        Used only if `vectorized` is True.
 
     Returns
     -------
@@ -82,14 +179,18 @@ def minimize(fun,
         for i in range(ndim):
             start_points[:, i] = np.clip(start_points[:, i], *bounds[i])
 
-    # Run the optimisation from each initialization point.
-    locs = []
-    vals = np.empty(n_start_points)
-    for i in range(n_start_points):
-        result = scipy.optimize.minimize(fun, start_points[i, :],
-                                         method='L-BFGS-B', jac=grad, bounds=bounds)
-        locs.append(result['x'])
-        vals[i] = result['fun']
+    if vectorized:
+        locs, vals = _minimize_vectorized(fun, bounds, grad, start_points, maxiter,
+                                          prune_interval)
+    else:
+        # Run the optimisation from each initialization point.
+        locs = []
+        vals = np.empty(n_start_points)
+        for i in range(n_start_points):
+            result = scipy.optimize.minimize(fun, start_points[i, :],
+                                             method='L-BFGS-B', jac=grad, bounds=bounds)
+            locs.append(result['x'])
+            vals[i] = result['fun']
 
     # Return the optimal case.
     ind_min = np.argmin(vals)
@@ -98,3 +199,149 @@ def minimize(fun,
         locs_out[i] = np.clip(locs_out[i], *bounds[i])
 
     return locs[ind_min], vals[ind_min]
+
+
+def _minimize_vectorized(fun, bounds, grad, start_points, maxiter, prune_interval,
+                         n_memory=10, ftol=1e7 * np.finfo(float).eps, gtol=1e-5):
+    """Minimize `fun` from all the starting points at once.
+
+    Each point is optimized with its own projected L-BFGS iteration, i.e. its own memory,
+    backtracking line search and convergence test, but all the points that are still
+    iterating are evaluated with a single call of `fun` and `grad`. The tolerances
+    correspond to the defaults of L-BFGS-B in scipy.
+
+    Returns
+    -------
+    tuple of the found coordinates of minimum and the corresponding values of all the
+    starting points.
+
+    """
+    lower, upper = np.asarray(bounds, dtype=float).T
+    n, ndim = start_points.shape
+    eps = np.sqrt(np.finfo(float).eps)
+
+    def values(x):
+        return np.asarray(fun(x), dtype=float).reshape(len(x))
+
+    def gradients(x, f):
+        if grad is not None:
+            return np.asarray(grad(x), dtype=float).reshape(x.shape)
+        # Forward differences for all the points at once, one dimension at a time
+        g = np.empty_like(x)
+        for i in range(ndim):
+            h = eps * np.maximum(1., np.abs(x[:, i]))
+            h = np.where(x[:, i] + h > upper[i], -h, h)
+            x_h = x.copy()
+            x_h[:, i] += h
+            g[:, i] = (values(x_h) - f) / h
+        return g
+
+    x = np.clip(start_points, lower, upper)
+    f = values(x)
+    g = gradients(x, f)
+
+    # Memory of the steps and gradient changes of each point, the newest last. Empty slots
+    # have rho = 0.
+    S = np.zeros((n, n_memory, ndim))
+    Y = np.zeros((n, n_memory, ndim))
+    rho = np.zeros((n, n_memory))
+    active = np.ones(n, dtype=bool)
+
+    for n_iter in range(maxiter):
+        if n_iter > 0 and n_iter % prune_interval == 0:
+            # Stop iterating the worse half of the points
+            idx = np.flatnonzero(active)
+            active[idx[np.argsort(f[idx])[(len(idx) + 1) // 2:]]] = False
+
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        x_i, f_i, g_i = x[idx], f[idx], g[idx]
+
+        # Fix the variables at the bounds that the gradient points out of
+        free = ~(((x_i <= lower) & (g_i > 0)) | ((x_i >= upper) & (g_i < 0)))
+        g_free = np.where(free, g_i, 0.)
+        d = -np.where(free, _lbfgs_direction(g_free, S[idx], Y[idx], rho[idx]), 0.)
+
+        # Restart the points whose direction is not a descent direction
+        restart = np.sum(g_free * d, axis=1) >= 0
+        d[restart] = -g_free[restart]
+        rho[idx[restart]] = 0.
+
+        # Scale the first step to unit length
+        step = np.where(rho[idx, -1] > 0, 1.,
+                        np.minimum(1., 1. / np.maximum(np.linalg.norm(d, axis=1), eps)))
+
+        # Backtracking line search with the sufficient decrease condition
+        x_new = x_i.copy()
+        f_new = f_i.copy()
+        pending = np.arange(len(idx))
+        for _ in range(20):
+            x_t = np.clip(x_i[pending] + step[pending, None] * d[pending], lower, upper)
+            f_t = values(x_t)
+            ok = f_t <= f_i[pending] + 1e-4 * np.sum(g_i[pending] * (x_t - x_i[pending]), 1)
+            x_new[pending[ok]] = x_t[ok]
+            f_new[pending[ok]] = f_t[ok]
+            pending = pending[~ok]
+            if len(pending) == 0:
+                break
+            step[pending] *= .5
+
+        # The points with no sufficient decrease have converged
+        active[idx[pending]] = False
+        moved = np.setdiff1d(np.arange(len(idx)), pending)
+        if len(moved) == 0:
+            continue
+
+        idx, x_i, f_i, g_i = idx[moved], x_i[moved], f_i[moved], g_i[moved]
+        x_new, f_new = x_new[moved], f_new[moved]
+        g_new = gradients(x_new, f_new)
+
+        # Update the memory of the points with positive curvature
+        s_k = x_new - x_i
+        y_k = g_new - g_i
+        sy = np.sum(s_k * y_k, axis=1)
+        upd = sy > eps * np.sum(y_k * y_k, axis=1)
+        j = idx[upd]
+        S[j] = np.roll(S[j], -1, axis=1)
+        Y[j] = np.roll(Y[j], -1, axis=1)
+        rho[j] = np.roll(rho[j], -1, axis=1)
+        S[j, -1] = s_k[upd]
+        Y[j, -1] = y_k[upd]
+        rho[j, -1] = 1. / sy[upd]
+
+        x[idx], f[idx], g[idx] = x_new, f_new, g_new
+
+        scale = np.maximum(np.maximum(np.abs(f_i), np.abs(f_new)), 1.)
+        converged = f_i - f_new <= ftol * scale
+        pg = np.abs(x_new - np.clip(x_new - g_new, lower, upper))
+        converged |= np.max(pg, axis=1) <= gtol
+        active[idx[converged]] = False
+
+    return x, f
+
+
+def _lbfgs_direction(g, S, Y, rho):
+    """Return the L-BFGS approximation of the inverse Hessian times `g` for each row.
+
+    The two-loop recursion is computed for all the points at once. The empty slots of the
+    memory have rho = 0 and do not contribute.
+    """
+    q = g.copy()
+    n_memory = S.shape[1]
+    alpha = np.zeros(rho.shape)
+    for j in reversed(range(n_memory)):
+        alpha[:, j] = rho[:, j] * np.sum(S[:, j] * q, axis=1)
+        q -= alpha[:, j, None] * Y[:, j]
+
+    # Scale with the newest pair
+    yy = np.sum(Y[:, -1] * Y[:, -1], axis=1)
+    has_pair = (rho[:, -1] > 0) & (yy > 0)
+    gamma = np.ones(len(g))
+    gamma[has_pair] = 1. / (rho[has_pair, -1] * yy[has_pair])
+
+    r = gamma[:, None] * q
+    for j in range(n_memory):
+        beta = rho[:, j] * np.sum(Y[:, j] * r, axis=1)
+        r += S[:, j] * (alpha[:, j] - beta)[:, None]
+    return r
@@ -3,6 +3,9 @@
 __all__ = ['Rejection', 'SMC', 'BayesianOptimization', 'BOLFI']
 
 import logging
+import os
+import tempfile
+import time
 from math import ceil
 
 import matplotlib.pyplot as plt
@@ -19,8 +22,10 @@ from elfi.methods.bo.utils import stochastic_optimization
 from elfi.methods.posteriors import BolfiPosterior
 from elfi.methods.results import BolfiSample, OptimizationResult, Sample, SmcSample
 from elfi.methods.utils import (GMDistribution, ModelPrior, arr2d_to_batch,
-                                batch_to_arr2d, ceil_to_batch_size, weighted_var)
+                                batch_to_arr2d, ceil_to_batch_size, local_cov,
+                                select_smallest, weighted_cov, weighted_var)
 from elfi.model.elfi_model import ComputationContext, ElfiModel, NodeReference
+from elfi.store import NpyArray
 from elfi.utils import is_array
 from elfi.visualization.visualization import progress_bar
 
@@ -65,7 +70,9 @@ class ParameterInference:
                  batch_size=1,
                  seed=None,
                  pool=None,
-                 max_parallel_batches=None):
+                 max_parallel_batches=None,
+                 chunk_size=1,
+                 compile_cache=False):
         """Construct the inference algorithm object.
 
         If you are implementing your own algorithm do not forget to call `super`.
@@ -86,8 +93,17 @@ class ParameterInference:
             OutputPool both stores and provides precomputed values for batches.
         max_parallel_batches : int, optional
             Maximum number of batches allowed to be in computation at the same time.
-            Defaults to number of cores in the client
-
+            Defaults to number of cores in the client. With chunking this is the number of
+            chunks.
+        chunk_size : int or str, optional
+            Number of consecutive batches sent to the client as a single task. With 'auto' the
+            size is tuned from the computation time of the batches versus the latency of the
+            client. Chunking is useful with cheap simulators, whose batches take less time to
+            compute than to send to the workers. Default 1.
+        compile_cache : bool, optional
+            Whether to share the compiled model with the other inferences of identical
+            models, see `elfi.client.CompileCache`. The operations of the model must then be
+            deterministic and must not be modified while the inferences run. Default False.
 
         """
         model = model.model if isinstance(model, NodeReference) else model
@@ -102,7 +118,12 @@ class ParameterInference:
         # Prepare the computation_context
         context = ComputationContext(batch_size=batch_size, seed=seed, pool=pool)
         self.batches = elfi.client.BatchHandler(
-            self.model, context=context, output_names=output_names, client=self.client)
+            self.model,
+            context=context,
+            output_names=output_names,
+            client=self.client,
+            chunk_size=chunk_size,
+            cache=compile_cache)
         self.computation_context = context
         self.max_parallel_batches = max_parallel_batches or self.client.num_cores
 
@@ -289,21 +310,68 @@ class ParameterInference:
 
         New batches are submitted only while waiting for the next one to complete. There
         will never be more batches submitted in parallel than the `max_parallel_batches`
-        setting allows.
+        setting (times the chunk size) allows.
+
+        If the method does not require processing the batches in order (see
+        `_in_order`), the batch that completes first is processed instead of the next one in
+        succession.
 
         Returns
         -------
         None
 
         """
-        # Submit new batches if allowed
-        while self._allow_submit(self.batches.next_index):
-            next_batch = self.prepare_new_batch(self.batches.next_index)
-            logger.debug("Submitting batch %d" % self.batches.next_index)
-            self.batches.submit(next_batch)
+        self._submit_batches()
 
-        # Handle the next ready batch in succession
-        batch, batch_index = self.batches.wait_next()
+        # Handle the next ready batch in succession or any ready batch
+        if self._in_order:
+            batch, batch_index = self.batches.wait_next()
+        else:
+            batch, batch_index = self.batches.wait_any()
+        logger.debug('Received batch %d' % batch_index)
+        self.update(batch, batch_index)
+
+    async def ainfer(self, *args, **kwargs):
+        """Set the objective and advance the inference asynchronously until it is finished.
+
+        Asynchronous version of `infer` without the plotting and the progress bar. The
+        batches are awaited without blocking the event loop, so that several inferences can
+        run concurrently in a single thread, e.g. with `asyncio.gather`. Use a client that
+        is notified of completed tasks, such as `elfi.clients.asyncio`, to avoid polling
+        for the results.
+
+        See the arguments from the `set_objective` method.
+
+        Returns
+        -------
+        result : Sample
+
+        """
+        self.set_objective(*args, **kwargs)
+
+        while not self.finished:
+            await self.aiterate()
+
+        self.batches.cancel_pending()
+        return self.extract_result()
+
+    async def aiterate(self):
+        """Advance the inference by one iteration without blocking the event loop.
+
+        Asynchronous version of `iterate`.
+
+        Returns
+        -------
+        None
+
+        """
+        self._submit_batches()
+
+        # Handle the next ready batch in succession or any ready batch
+        if self._in_order:
+            batch, batch_index = await self.batches.await_next()
+        else:
+            batch, batch_index = await self.batches.await_any()
         logger.debug('Received batch %d' % batch_index)
         self.update(batch, batch_index)
 
@@ -311,9 +379,22 @@ class ParameterInference:
     def finished(self):
         return self._objective_n_batches <= self.state['n_batches']
 
+    @property
+    def _in_order(self):
+        """Return whether the batches must be processed in the order of their indices."""
+        return True
+
+    def _submit_batches(self):
+        """Submit new batches if allowed."""
+        while self._allow_submit(self.batches.next_index):
+            next_batch = self.prepare_new_batch(self.batches.next_index)
+            logger.debug("Submitting batch %d" % self.batches.next_index)
+            self.batches.submit(next_batch)
+
     def _allow_submit(self, batch_index):
-        return (self.max_parallel_batches > self.batches.num_pending and
-                self._has_batches_to_submit and (not self.batches.has_ready()))
+        max_pending = self.max_parallel_batches * self.batches.current_chunk_size
+        return (max_pending > self.batches.num_pending and self._has_batches_to_submit and
+                (not self.batches.has_ready(any_batch=not self._in_order)))
 
     @property
     def _has_batches_to_submit(self):
@@ -405,6 +486,25 @@ class Sampler(ParameterInference):
 
         return self.infer(n_samples, *args, bar=bar, **kwargs)
 
+    async def asample(self, n_samples, *args, **kwargs):
+        """Sample from the approximate posterior asynchronously.
+
+        Asynchronous version of `sample`, see `ParameterInference.ainfer`.
+
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples to generate from the (approximate) posterior
+        *args
+        **kwargs
+
+        Returns
+        -------
+        result : Sample
+
+        """
+        return await self.ainfer(n_samples, *args, **kwargs)
+
     def _extract_result_kwargs(self):
         kwargs = super(Sampler, self)._extract_result_kwargs()
         for state_key in ['threshold', 'accept_rate']:
@@ -421,6 +521,24 @@ class Rejection(Sampler):
     For a description of the rejection sampler and a general introduction to ABC, see e.g.
     Lintusaari et al. 2016.
 
+    The simulations with the smallest discrepancies are kept in an unsorted buffer. Only
+    the simulations below the discrepancy of the `n_samples` smallest seen so far are
+    stored, and the buffer is reduced to the `n_samples` smallest with a linear time
+    selection when it fills up. The samples are sorted only when the result is extracted.
+    The discrepancies of the kept simulations are also held in memory, from which
+    `state['threshold']` is updated after every batch with a linear time selection.
+
+    With `samples_path`, the buffer is stored in .npy files mapped to memory instead, and
+    the samples are moved in chunks of `merge_chunk_bytes`. This allows keeping more or
+    wider samples than fit in memory.
+
+    With a `threshold` objective, the simulations are instead accepted in the order of
+    their batches. The accepted ones are appended to the samples, the rejected ones are
+    never stored, and the inference finishes as soon as `n_samples` are accepted. The
+    batch completing the samples may have more acceptable simulations than are missing,
+    in which case the `n_samples` with the smallest discrepancies are kept. The
+    state reports the acceptance rate and the estimated remaining time `eta` in seconds.
+
     References
     ----------
     Lintusaari J, Gutmann M U, Dutta R, Kaski S, Corander J (2016). Fundamentals and
@@ -429,7 +547,11 @@ class Rejection(Sampler):
 
     """
 
-    def __init__(self, model, discrepancy_name=None, output_names=None, **kwargs):
+    # Maximum size of the chunks in which the samples are moved in the buffer
+    merge_chunk_bytes = 2**26
+
+    def __init__(self, model, discrepancy_name=None, output_names=None, samples_path=None,
+                 **kwargs):
         """Initialize the Rejection sampler.
 
         Parameters
@@ -440,6 +562,10 @@ class Rejection(Sampler):
         output_names : list, optional
             Additional outputs from the model to be included in the inference result, e.g.
             corresponding summaries to the acquired samples
+        samples_path : str, optional
+            Directory under which the samples are stored in .npy files instead of memory.
+            Each inference creates a new folder there, which is not removed afterwards. The
+            outputs of the extracted results are memory mapped to these files.
         kwargs:
             See InferenceMethod
 
@@ -449,6 +575,7 @@ class Rejection(Sampler):
         super(Rejection, self).__init__(model, output_names, **kwargs)
 
         self.discrepancy_name = discrepancy_name
+        self.samples_path = samples_path
 
     def set_objective(self, n_samples, threshold=None, quantile=None, n_sim=None):
         """Set objective for inference.
@@ -469,7 +596,11 @@ class Rejection(Sampler):
         """
         if quantile is None and threshold is None and n_sim is None:
             quantile = .01
-        self.state = dict(samples=None, threshold=np.Inf, n_sim=0, accept_rate=1, n_batches=0)
+        self.state = dict(samples=None, threshold=np.Inf, n_sim=0, accept_rate=1, n_batches=0,
+                          n_stored=0)
+        if threshold is not None:
+            self.state.update(threshold=threshold, n_accepted=0, eta=np.inf)
+            self._start_time = time.time()
 
         if quantile:
             n_sim = ceil(n_samples / quantile)
@@ -500,9 +631,13 @@ class Rejection(Sampler):
         if self.state['samples'] is None:
             # Lazy initialization of the outputs dict
             self._init_samples_lazy(batch)
-        self._merge_batch(batch)
-        self._update_state_meta()
-        self._update_objective_n_batches()
+
+        if self.objective.get('threshold') is None:
+            self._merge_batch(batch, batch_index)
+            self._update_state_meta()
+        else:
+            self._accept_batch(batch)
+            self._update_objective_n_batches()
 
     def extract_result(self):
         """Extract the result from the current state.
@@ -515,10 +650,19 @@ class Rejection(Sampler):
         if self.state['samples'] is None:
             raise ValueError('Nothing to extract')
 
+        if self.objective.get('threshold') is not None:
+            outputs = {k: self._accepted(v) for k, v in self.state['samples'].items()}
+            return Sample(outputs=outputs, **self._extract_result_kwargs())
+
+        self._sort_samples()
+
         # Take out the correct number of samples
+        n_samples = min(self.objective['n_samples'], self.state['n_stored'])
         outputs = dict()
         for k, v in self.state['samples'].items():
-            outputs[k] = v[:self.objective['n_samples']]
+            if isinstance(v, np.memmap):
+                v.flush()
+            outputs[k] = v[:n_samples]
 
         return Sample(outputs=outputs, **self._extract_result_kwargs())
 
@@ -528,6 +672,11 @@ class Rejection(Sampler):
         e_noarr = "Node {} output must be in a numpy array of length {} (batch_size)."
         e_len = "Node {} output has array length {}. It should be equal to the batch size {}."
 
+        path = None
+        if self.samples_path is not None:
+            os.makedirs(self.samples_path, exist_ok=True)
+            path = tempfile.mkdtemp(prefix='rejection-', dir=self.samples_path)
+
         for node in self.output_names:
             # Check the requested outputs
             if node not in batch:
@@ -539,36 +688,205 @@ class Rejection(Sampler):
             elif len(nbatch) != self.batch_size:
                 raise ValueError(e_len.format(node, len(nbatch), self.batch_size))
 
-            # Prepare samples
-            shape = (self.objective['n_samples'] + self.batch_size, ) + nbatch.shape[1:]
-            dtype = nbatch.dtype
+            if self.objective.get('threshold') is not None:
+                # The accepted samples are appended to lists of arrays or .npy files
+                if path is None:
+                    samples[node] = [nbatch[:0]]
+                else:
+                    samples[node] = NpyArray(os.path.join(path, node), truncate=True)
+                    samples[node].init_from_array(nbatch[:0])
+                continue
 
-            if node == self.discrepancy_name:
-                # Initialize the distances to inf
-                samples[node] = np.ones(shape, dtype=dtype) * np.inf
+            # Prepare the buffer. It holds the n_samples smallest and at least one batch.
+            n_samples = self.objective['n_samples']
+            shape = (n_samples + max(n_samples, self.batch_size), ) + nbatch.shape[1:]
+            if path is None:
+                samples[node] = np.empty(shape, dtype=nbatch.dtype)
             else:
-                samples[node] = np.empty(shape, dtype=dtype)
+                filename = os.path.join(path, node + '.npy')
+                samples[node] = np.lib.format.open_memmap(
+                    filename, mode='w+', dtype=nbatch.dtype, shape=shape)
 
         self.state['samples'] = samples
+        if self.objective.get('threshold') is not None:
+            return
+
+        # Simulation indices and discrepancies of the samples
+        self.state['sample_index'] = np.empty(shape[0], dtype=np.int64)
+        self.state['sample_discrepancy'] = np.empty(shape[0])
+        # Discrepancy and simulation index of the largest kept sample after the buffer is
+        # reduced. Simulations above it are not stored.
+        self.state['screen'] = (np.inf, np.iinfo(np.int64).max)
+
+    @staticmethod
+    def _discrepancies(discrepancy):
+        """Return the first components of the discrepancies with NaNs as infinite."""
+        discrepancy = discrepancy.reshape(len(discrepancy), -1)[:, 0]
+        return np.where(np.isnan(discrepancy), np.inf, discrepancy)
 
-    def _merge_batch(self, batch):
-        # TODO: add index vector so that you can recover the original order
-        samples = self.state['samples']
-        # Put the acquired samples to the end
+    def _merge_batch(self, batch, batch_index):
+        s = self.state
+        samples = s['samples']
+        index = batch_index * self.batch_size + np.arange(self.batch_size)
+        discrepancies = self._discrepancies(batch[self.discrepancy_name])
+
+        # Screen out the simulations that cannot be among the smallest. Ties are ordered by
+        # the simulation index so that the result does not depend on the order in which the
+        # batches are merged.
+        d_max, i_max = s['screen']
+        mask = (discrepancies < d_max) | ((discrepancies == d_max) & (index < i_max))
+        n_new = np.count_nonzero(mask)
+        if n_new == 0:
+            return
+
+        if s['n_stored'] + n_new > len(s['sample_index']):
+            self._reduce_samples()
+
+        rows = slice(s['n_stored'], s['n_stored'] + n_new)
         for node, v in samples.items():
-            v[self.objective['n_samples']:] = batch[node]
+            v[rows] = batch[node][mask]
+        s['sample_index'][rows] = index[mask]
+        s['sample_discrepancy'][rows] = discrepancies[mask]
+        s['n_stored'] += n_new
+
+    def _accepted_rows(self, batch):
+        """Return the rows to accept with a threshold objective.
+
+        When the batch completes the samples, the `n_samples` simulations with the smallest
+        discrepancies among the accepted ones and the batch are kept.
+
+        Returns
+        -------
+        kept : np.ndarray or None
+            Rows of the accepted samples to keep in increasing order, or None for all.
+        rows : np.ndarray
+            Rows of the batch to accept.
+
+        """
+        n_accepted = self.state['n_accepted']
+        n_samples = self.objective['n_samples']
+        discrepancies = self._discrepancies(batch[self.discrepancy_name])
+        rows = np.flatnonzero(discrepancies <= self.objective['threshold'])
+        if n_accepted + len(rows) <= n_samples:
+            return None, rows
+
+        # Ties are broken by the order of the simulations
+        candidates = discrepancies[rows]
+        if n_accepted > 0:
+            accepted = self._accepted(self.state['samples'][self.discrepancy_name])
+            candidates = np.concatenate((self._discrepancies(accepted), candidates))
+        keep = np.sort(select_smallest(candidates, np.arange(len(candidates)), n_samples))
+        kept = keep[keep < n_accepted]
+        return kept, rows[keep[len(kept):] - n_accepted]
+
+    def _accept_batch(self, batch):
+        """Append the accepted simulations of the batch until `n_samples` are accepted."""
+        s = self.state
+        kept, rows = self._accepted_rows(batch)
+
+        if kept is not None:
+            self._keep_accepted(kept)
+            s['n_accepted'] = len(kept)
+        if len(rows) > 0:
+            for node, v in s['samples'].items():
+                v.append(batch[node][rows])
+            s['n_accepted'] += len(rows)
+
+        s['accept_rate'] = s['n_accepted'] / s['n_sim']
+        if s['n_accepted'] > 0:
+            elapsed = time.time() - self._start_time
+            s['eta'] = elapsed * (self.objective['n_samples'] - s['n_accepted']) / \
+                s['n_accepted']
+        logger.debug('Accepted {} samples, acceptance rate {:.3g}, ETA {:.1f} s'.format(
+            s['n_accepted'], s['accept_rate'], s['eta']))
+
+    def _keep_accepted(self, rows):
+        """Keep only the `rows` of the accepted samples, given in increasing order."""
+        for node, v in self.state['samples'].items():
+            if isinstance(v, list):
+                v[:] = [self._accepted(v)[rows]]
+                continue
+            if len(rows) > 0:
+                v[:len(rows)] = v[rows]
+                v.memmap.flush()
+            v.truncate(len(rows))
+
+    @staticmethod
+    def _accepted(samples):
+        """Return the accepted samples from a list of arrays or an NpyArray."""
+        if isinstance(samples, list):
+            # Concatenate once for the later calls
+            samples[:] = [np.concatenate(samples)]
+            return samples[0]
+        elif len(samples) == 0:
+            return np.empty((0, ) + samples.shape[1:], dtype=samples.dtype)
+        samples.flush()
+        return samples.memmap
+
+    def _reduce_samples(self):
+        """Reduce the buffer to the `n_samples` smallest and update the screening."""
+        s = self.state
+        n_samples = self.objective['n_samples']
+        n_stored = s['n_stored']
+        index = s['sample_index']
+
+        if n_stored > n_samples:
+            discrepancies = s['sample_discrepancy'][:n_stored]
+            keep = select_smallest(discrepancies, index[:n_stored], n_samples)
+            # The rows are moved forward in increasing order so they can be moved in place
+            self._move_rows(np.sort(keep), 0)
+            s['n_stored'] = n_samples
+
+        if s['n_stored'] == n_samples:
+            discrepancies = s['sample_discrepancy'][:n_samples]
+            d_max = np.max(discrepancies)
+            i_max = np.max(index[:n_samples][discrepancies == d_max])
+            s['screen'] = (d_max, i_max)
+            s['threshold'] = d_max.item()
+
+    def _sort_samples(self):
+        """Reduce the buffer to the `n_samples` smallest sorted by their discrepancies."""
+        self._reduce_samples()
+
+        s = self.state
+        n = s['n_stored']
+        sort_mask = np.lexsort((s['sample_index'][:n], s['sample_discrepancy'][:n]))
+
+        # Sort via the free space after the samples, which holds at least n rows
+        self._move_rows(sort_mask, n)
+        self._move_rows(np.arange(n, 2 * n), 0)
 
-        # Sort the smallest to the beginning
-        sort_mask = np.argsort(samples[self.discrepancy_name], axis=0).ravel()
-        for k, v in samples.items():
-            v[:] = v[sort_mask]
+    def _move_rows(self, rows, start):
+        """Copy `rows` of the buffer in chunks to the consecutive rows from `start`.
+
+        A row may be overwritten only after it has been copied.
+        """
+        s = self.state
+        for v in list(s['samples'].values()) + [s['sample_index'], s['sample_discrepancy']]:
+            row_bytes = max(v[:1].nbytes, 1)
+            chunk = max(self.merge_chunk_bytes // row_bytes, 1)
+            for i in range(0, len(rows), chunk):
+                rows_i = rows[i:i + chunk]
+                v[start + i:start + i + len(rows_i)] = v[rows_i]
+
+    @property
+    def _in_order(self):
+        """Return whether the batches must be processed in order.
+
+        Only the threshold objective depends on the order, as it may finish before all the
+        submitted batches are processed.
+        """
+        return self.objective.get('threshold') is not None
 
     def _update_state_meta(self):
-        """Update `n_sim`, `threshold`, and `accept_rate`."""
+        """Update `threshold` and `accept_rate`."""
         o = self.objective
         s = self.state
-        s['threshold'] = s['samples'][self.discrepancy_name][o['n_samples'] - 1].item()
-        s['accept_rate'] = min(1, o['n_samples'] / s['n_sim'])
+        n_samples, n_stored = o['n_samples'], s['n_stored']
+        if n_stored >= n_samples:
+            discrepancies = s['sample_discrepancy'][:n_stored]
+            s['threshold'] = np.partition(discrepancies, n_samples - 1)[n_samples - 1].item()
+        s['accept_rate'] = min(1, n_samples / s['n_sim'])
 
     def _update_objective_n_batches(self):
         # Only in the case that the threshold is used
@@ -576,21 +894,22 @@ class Rejection(Sampler):
             return
 
         s = self.state
-        t, n_samples = [self.objective.get(k) for k in ('threshold', 'n_samples')]
+        n_samples = self.objective['n_samples']
 
-        # noinspection PyTypeChecker
-        n_acceptable = np.sum(s['samples'][self.discrepancy_name] <= t) if s['samples'] else 0
-        if n_acceptable == 0:
+        n_accepted = s['n_accepted']
+        if n_accepted >= n_samples:
+            # Finish exactly when the samples are accepted
+            n_batches = s['n_batches']
+        elif n_accepted == 0:
             # No acceptable samples found yet, increase n_batches of objective by one in
             # order to keep simulating
             n_batches = self.objective['n_batches'] + 1
         else:
-            accept_rate_t = n_acceptable / s['n_sim']
             # Add some margin to estimated n_batches. One could also use confidence
             # bounds here
-            margin = .2 * self.batch_size * int(n_acceptable < n_samples)
-            n_batches = (n_samples / accept_rate_t + margin) / self.batch_size
-            n_batches = ceil(n_batches)
+            margin = .2 * self.batch_size
+            n_batches = (n_samples / s['accept_rate'] + margin) / self.batch_size
+            n_batches = max(ceil(n_batches), s['n_batches'] + 1)
 
         self.objective['n_batches'] = n_batches
         logger.debug('Estimated objective n_batches=%d' % self.objective['n_batches'])
@@ -606,18 +925,42 @@ class Rejection(Sampler):
             displays.append(
                 display.HTML('<span>Threshold: {}</span>'.format(self.state['threshold'])))
 
+        if self.objective.get('threshold') is None:
+            samples = self.state['samples']
+            n = min(self.objective['n_samples'], self.state['n_stored'])
+        else:
+            samples = {k: self._accepted(v) for k, v in self.state['samples'].items()}
+            n = self.state['n_accepted']
+
         visin.plot_sample(
-            self.state['samples'],
+            samples,
             nodes=self.parameter_names,
-            n=self.objective['n_samples'],
+            n=n,
             displays=displays,
             **options)
 
 
 class SMC(Sampler):
-    """Sequential Monte Carlo ABC sampler."""
+    """Sequential Monte Carlo ABC sampler.
+
+    The rounds are pipelined. The importance weights of the accepted samples are computed
+    as their batches arrive, so that the next round can start right after the previous one
+    is finished. The `max_parallel_batches` batches following the last batch of a round are
+    drawn from its proposal and used as the first candidates of the next round, weighted
+    by the proposal they were drawn from. They are mostly being simulated already when the
+    round finishes. Later batches are cancelled, so that the results do not depend on the
+    timing of the batches.
+    """
+
+    n_neighbours = 20
 
-    def __init__(self, model, discrepancy_name=None, output_names=None, **kwargs):
+    def __init__(self,
+                 model,
+                 discrepancy_name=None,
+                 output_names=None,
+                 kernel_truncation=None,
+                 proposal_cov='diagonal',
+                 **kwargs):
         """Initialize the SMC-ABC sampler.
 
         Parameters
@@ -628,29 +971,72 @@ class SMC(Sampler):
         output_names : list, optional
             Additional outputs from the model to be included in the inference result, e.g.
             corresponding summaries to the acquired samples
+        kernel_truncation : float, optional
+            Approximate the proposal density in the importance weights by summing only the
+            kernels of the particles within `kernel_truncation` standard deviations of each
+            sample. This makes the weights of large populations much faster to compute. The
+            proposal density is underestimated by at most
+            `GMDistribution.truncation_error`, e.g. by less than 1e-10 times the peak of a
+            single kernel with `kernel_truncation=7`. Defaults to the exact density.
+        proposal_cov : str, optional
+            Covariance of the Gaussian kernels of the proposal, estimated from the previous
+            population. Either 'diagonal' (default) for twice the weighted variances,
+            'full' for twice the weighted covariance matrix or 'local' for twice the average
+            covariance of the `n_neighbours` nearest neighbourhoods of the particles (see
+            `elfi.methods.utils.local_cov`).
         kwargs:
             See InferenceMethod
 
         """
         model, discrepancy_name = self._resolve_model(model, discrepancy_name)
+        if proposal_cov not in ('diagonal', 'full', 'local'):
+            raise ValueError("Unknown proposal_cov {}".format(proposal_cov))
 
         super(SMC, self).__init__(model, output_names, **kwargs)
 
         self._prior = ModelPrior(self.model)
         self.discrepancy_name = discrepancy_name
+        self.kernel_truncation = kernel_truncation
+        self.proposal_cov = proposal_cov
         self.state['round'] = 0
         self._populations = []
         self._rejection = None
         self._round_random_state = None
+        # Rounds of the proposals of the pending batches
+        self._batch_rounds = {}
+        # Log importance weights of the accepted samples of the current round
+        self._log_weights = []
+
+    def set_objective(self, n_samples, thresholds=None, quantile=.5, min_accept_rate=.01):
+        """Set the objective of the inference.
+
+        Without `thresholds` the thresholds are chosen adaptively. The first population is
+        the `quantile` of the prior samples with the smallest discrepancies. The threshold
+        of each following round is the `quantile` of the discrepancies of the previous
+        population. The inference finishes after the first round whose acceptance rate is
+        below `min_accept_rate`, or when the threshold can no longer be decreased.
 
-    def set_objective(self, n_samples, thresholds):
-        """Set the objective of the inference."""
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples in each population
+        thresholds : list, optional
+            Acceptance thresholds of the rounds
+        quantile : float, optional
+            In between (0,1). Quantile of the discrepancies for the adaptive thresholds.
+        min_accept_rate : float, optional
+            Acceptance rate for finishing the inference with adaptive thresholds.
+
+        """
+        adaptive = thresholds is None
         self.objective.update(
             dict(
                 n_samples=n_samples,
                 n_batches=self.max_parallel_batches,
-                round=len(thresholds) - 1,
-                thresholds=thresholds))
+                round=np.inf if adaptive else len(thresholds) - 1,
+                thresholds=[None] if adaptive else thresholds,
+                quantile=quantile,
+                min_accept_rate=min_accept_rate))
         self._init_new_round()
 
     def extract_result(self):
@@ -682,14 +1068,25 @@ class SMC(Sampler):
 
         """
         super(SMC, self).update(batch, batch_index)
+        round = self._batch_rounds.pop(batch_index, self.state['round'])
+        if self._rejection.objective.get('threshold') is not None:
+            kept, rows = self._rejection._accepted_rows(batch)
+            if kept is not None:
+                self._log_weights = [np.concatenate([np.zeros(0)] + self._log_weights)[kept]]
+            self._log_weights.append(self._compute_log_weights(batch, rows, round))
         self._rejection.update(batch, batch_index)
 
         if self._rejection.finished:
-            self.batches.cancel_pending()
             if self.state['round'] < self.objective['round']:
-                self._populations.append(self._extract_population())
-                self.state['round'] += 1
-                self._init_new_round()
+                pop = self._extract_population()
+                if self._adaptive and not self._adapt_threshold(pop):
+                    # Finish with the current round
+                    self.objective['round'] = self.state['round']
+                else:
+                    self._carry_over(batch_index)
+                    self._populations.append(pop)
+                    self.state['round'] += 1
+                    self._init_new_round()
 
         self._update_objective()
 
@@ -708,18 +1105,38 @@ class SMC(Sampler):
             default values or operations in those nodes.
 
         """
-        if self.state['round'] == 0:
+        round = self.state['round']
+        self._batch_rounds[batch_index] = round
+        if round == 0:
             # Use the actual prior
             return
 
         # Sample from the proposal, condition on actual prior
-        params = GMDistribution.rvs(*self._gm_params, size=self.batch_size,
+        params = GMDistribution.rvs(*self._proposal_params(round), size=self.batch_size,
                                     prior_logpdf=self._prior.logpdf,
-                                    random_state=self._round_random_state)
+                                    random_state=self._round_random_state,
+                                    bounds=self._prior.bounds)
 
         batch = arr2d_to_batch(params, self.parameter_names)
         return batch
 
+    def _carry_over(self, batch_index):
+        """Leave the batches after `batch_index` from the current proposal to the next round.
+
+        Exactly `max_parallel_batches` batches are carried over, submitting the missing ones
+        and cancelling the rest, so that the same batches are carried over with any client.
+        """
+        last_index = batch_index + self.max_parallel_batches
+        self.batches.cancel_pending(from_index=last_index + 1)
+        for index in list(self._batch_rounds):
+            if index > last_index:
+                del self._batch_rounds[index]
+
+        while self.batches.next_index <= last_index:
+            next_batch = self.prepare_new_batch(self.batches.next_index)
+            logger.debug("Submitting batch %d" % self.batches.next_index)
+            self.batches.submit(next_batch)
+
     def _init_new_round(self):
         round = self.state['round']
 
@@ -729,17 +1146,49 @@ class SMC(Sampler):
         # Get a subseed for this round for ensuring consistent results for the round
         seed = self.seed if round == 0 else get_sub_seed(self.seed, round)
         self._round_random_state = np.random.RandomState(seed)
+        self._log_weights = []
+
+        # The rejection sampler and its compiled net are reused for all the rounds
+        if self._rejection is None:
+            self._rejection = Rejection(
+                self.model,
+                discrepancy_name=self.discrepancy_name,
+                output_names=self.output_names,
+                batch_size=self.batch_size,
+                seed=seed,
+                max_parallel_batches=self.max_parallel_batches)
+        else:
+            # The seed of a context is immutable
+            context = ComputationContext(batch_size=self.batch_size, seed=seed)
+            self._rejection.computation_context = context
+            self._rejection.batches.context = context
+
+        if self.current_population_threshold is None:
+            self._rejection.set_objective(
+                self.objective['n_samples'], quantile=self.objective['quantile'])
+        else:
+            self._rejection.set_objective(
+                self.objective['n_samples'], threshold=self.current_population_threshold)
 
-        self._rejection = Rejection(
-            self.model,
-            discrepancy_name=self.discrepancy_name,
-            output_names=self.output_names,
-            batch_size=self.batch_size,
-            seed=seed,
-            max_parallel_batches=self.max_parallel_batches)
+    def _adapt_threshold(self, pop):
+        """Choose the threshold of the next round from the population `pop`.
+
+        Returns False if the inference should finish with `pop`.
+        """
+        thresholds = self.objective['thresholds']
+        thresholds[-1] = pop.threshold
+        if pop.accept_rate < self.objective['min_accept_rate']:
+            logger.info('Acceptance rate %.4g is below %.4g, finishing.', pop.accept_rate,
+                        self.objective['min_accept_rate'])
+            return False
 
-        self._rejection.set_objective(
-            self.objective['n_samples'], threshold=self.current_population_threshold)
+        threshold = np.percentile(pop.discrepancies, 100 * self.objective['quantile'])
+        if not threshold < pop.threshold:
+            logger.info('The threshold %.4g cannot be decreased, finishing.', pop.threshold)
+            return False
+
+        thresholds.append(threshold)
+        return True
 
     def _extract_population(self):
         sample = self._rejection.extract_result()
@@ -750,14 +1199,34 @@ class SMC(Sampler):
         sample.meta['cov'] = cov
         return sample
 
+    def _compute_log_weights(self, batch, rows, round):
+        """Compute the log importance weights of the `rows` of a batch.
+
+        Parameters
+        ----------
+        batch : dict
+        rows : np.ndarray
+            Indices of the rows
+        round : int
+            Round of the proposal from which the batch was drawn
+
+        """
+        if round == 0 or len(rows) == 0:
+            return np.zeros(len(rows))
+
+        params = np.column_stack(tuple([batch[p][rows] for p in self.parameter_names]))
+        q_logpdf = GMDistribution.logpdf(params, *self._proposal_params(round),
+                                         truncate=self.kernel_truncation)
+        p_logpdf = self._prior.logpdf(params)
+        return p_logpdf - q_logpdf
+
     def _compute_weights_and_cov(self, pop):
         params = np.column_stack(tuple([pop.outputs[p] for p in self.parameter_names]))
 
-        if self._populations:
-            q_logpdf = GMDistribution.logpdf(params, *self._gm_params)
-            p_logpdf = self._prior.logpdf(params)
-            w = np.exp(p_logpdf - q_logpdf)
+        if self._rejection.objective.get('threshold') is not None:
+            w = np.exp(np.concatenate([np.zeros(0)] + self._log_weights))
         else:
+            # Samples from the prior
             w = np.ones(pop.n_samples)
 
         if np.count_nonzero(w) == 0:
@@ -766,9 +1235,14 @@ class SMC(Sampler):
                                "a too small sample size.")
 
         # New covariance
-        cov = 2 * np.diag(weighted_var(params, w))
+        if self.proposal_cov == 'full':
+            cov = 2 * weighted_cov(params, w)
+        elif self.proposal_cov == 'local':
+            cov = 2 * local_cov(params, w, n_neighbours=self.n_neighbours)
+        else:
+            cov = 2 * np.diag(weighted_var(params, w))
 
-        if not np.all(np.isfinite(cov)):
+        if not np.all(np.isfinite(cov)) or np.linalg.eigvalsh(cov)[0] <= 0:
             logger.warning("Could not estimate the sample covariance. This is often "
                            "caused by majority of the sample weights becoming zero."
                            "Falling back to using unit covariance.")
@@ -781,12 +1255,16 @@ class SMC(Sampler):
         n_batches = sum([pop.n_batches for pop in self._populations])
         self.objective['n_batches'] = n_batches + self._rejection.objective['n_batches']
 
-    @property
-    def _gm_params(self):
-        sample = self._populations[-1]
+    def _proposal_params(self, round):
+        """Return the means, covariance and weights of the proposal mixture of `round`."""
+        sample = self._populations[round - 1]
         params = sample.samples_array
         return params, sample.cov, sample.weights
 
+    @property
+    def _adaptive(self):
+        return self.objective['round'] == np.inf
+
     @property
     def current_population_threshold(self):
         """Return the threshold for current population."""
@@ -826,7 +1304,7 @@ class BayesianOptimization(ParameterInference):
             and discrepancy values. Default value depends on the dimensionality.
         update_interval : int, optional
             How often to update the GP hyperparameters of the target_model
-        target_model : GPyRegression, optional
+        target_model : GPyRegression or GPRegression, optional
         acquisition_method : Acquisition, optional
             Method of acquiring evidence points. Defaults to LCBSC.
         acq_noise_var : float or np.array, optional
@@ -1045,6 +1523,11 @@ class BayesianOptimization(ParameterInference):
 
         return True
 
+    @property
+    def _in_order(self):
+        """Return whether the batches must be processed in order, i.e. unless async."""
+        return not getattr(self, 'async')
+
     def _should_optimize(self):
         current = self.target_model.n_evidence + self.batch_size
         next_update = self.state['last_GP_update'] + self.update_interval
@@ -1084,7 +1567,7 @@ class BayesianOptimization(ParameterInference):
             if len(gp.X) > 1:
                 f.axes[1].scatter(*point, color='red')
 
-        displays = [gp._gp]
+        displays = [gp.instance]
 
         if options.get('interactive'):
             from IPython import display
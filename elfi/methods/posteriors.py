@@ -70,7 +70,8 @@ class BolfiPosterior:
                 self.prior,
                 self.n_inits,
                 self.max_opt_iters,
-                random_state=self.random_state)
+                random_state=self.random_state,
+                vectorized=True)
             self.threshold = minval
             logger.info("Using optimized minimum value (%.4f) of the GP discrepancy mean "
                         "function as a threshold" % (self.threshold))
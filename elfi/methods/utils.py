@@ -1,10 +1,14 @@
 """This module contains utilities for methods."""
 
+import itertools
 import logging
 from math import ceil
 
 import numpy as np
+import scipy.linalg as sl
 import scipy.stats as ss
+from scipy.spatial import cKDTree
+from scipy.special import logsumexp
 
 import elfi.model.augmenter as augmenter
 from elfi.clients.native import Client
@@ -80,6 +84,39 @@ def ceil_to_batch_size(num, batch_size):
     return int(batch_size * ceil(num / batch_size))
 
 
+def select_smallest(values, index, k):
+    """Return the positions of the `k` smallest values in linear time.
+
+    Ties are broken by the smaller `index`, so that the selection does not depend on the
+    order of the values. NaN values are taken as infinite.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        1d array
+    index : np.ndarray
+        1d array of unique integers
+    k : int
+
+    Returns
+    -------
+    np.ndarray
+        Positions of the selected values in no particular order.
+
+    """
+    if k >= len(values):
+        return np.arange(len(values))
+    elif k <= 0:
+        return np.arange(0)
+
+    values = np.where(np.isnan(values), np.inf, values)
+    kth = values[np.argpartition(values, k - 1)[k - 1]]
+    below = np.flatnonzero(values < kth)
+    ties = np.flatnonzero(values == kth)
+    ties = ties[np.argsort(index[ties], kind='mergesort')[:k - len(below)]]
+    return np.concatenate((below, ties))
+
+
 def normalize_weights(weights):
     """Normalize weights to sum to unity."""
     w = np.atleast_1d(weights)
@@ -125,11 +162,105 @@ def weighted_var(x, weights=None):
     return s2
 
 
+def weighted_cov(x, weights=None):
+    """Unbiased weighted covariance matrix (sample covariance) of x.
+
+    The weights are assumed to be non random (reliability weights) as in `weighted_var`.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        2d array with observations in rows
+    weights : np.ndarray or None
+        1d array of weights. None defaults to standard covariance.
+
+    Returns
+    -------
+    cov : np.ndarray
+        2d covariance matrix
+
+    """
+    if weights is None:
+        weights = np.ones(len(x))
+
+    V_1 = np.sum(weights)
+    V_2 = np.sum(weights**2)
+
+    xbar = np.average(x, weights=weights, axis=0)
+    d = x - xbar
+    numerator = (weights[:, None] * d).T.dot(d)
+    return numerator / (V_1 - (V_2 / V_1))
+
+
+def local_cov(x, weights=None, n_neighbours=20):
+    """Average weighted covariance matrix of the nearest neighbourhoods of the points in x.
+
+    The covariance of the neighbourhood of each point is computed from its `n_neighbours`
+    nearest neighbours (including itself) found with the components of x scaled to unit
+    variance. The covariances are averaged with the weights of the points. In contrast to
+    the covariance of x, this describes the local spread of x, e.g. that of a single mode.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        2d array with observations in rows
+    weights : np.ndarray or None
+        1d array of weights. None defaults to equal weights.
+    n_neighbours : int, optional
+
+    Returns
+    -------
+    cov : np.ndarray
+        2d covariance matrix
+
+    References
+    ----------
+    Filippi S, Barnes C P, Cornebise J, Stumpf M P H (2013). On optimality of kernels for
+    approximate Bayesian computation using sequential Monte Carlo. Statistical Applications
+    in Genetics and Molecular Biology 12(1):87-107.
+
+    """
+    if weights is None:
+        weights = np.ones(len(x))
+
+    # Points with zero weight are not part of any neighbourhood
+    x = x[weights > 0]
+    weights = weights[weights > 0]
+    k = min(n_neighbours, len(x))
+
+    scale = np.std(x, axis=0)
+    scale[scale == 0] = 1
+    _, neighbours = cKDTree(x / scale).query(x / scale, k=k)
+    neighbours = neighbours.reshape(len(x), k)
+
+    # Weighted deviations of the neighbours from the means of the neighbourhoods
+    w = weights[neighbours]
+    w = w / np.sum(w, axis=1, keepdims=True)
+    d = x[neighbours] - np.einsum('ij,ijk->ik', w, x[neighbours])[:, None, :]
+    coef = weights[:, None] * w
+    return np.einsum('ij,ijk,ijl->kl', coef, d, d) / np.sum(weights)
+
+
 class GMDistribution:
-    """Gaussian mixture distribution with a shared covariance matrix."""
+    """Gaussian mixture distribution with a shared covariance matrix.
+
+    The densities are evaluated for all the points and components at once. The shared
+    covariance is factored once and the squared Mahalanobis distances are computed in
+    blocks of at most `block_size` point-component pairs. The log density is computed with
+    log-sum-exp, so it does not underflow for points far from all the components.
+
+    For large mixtures the densities can be approximated by truncating the kernels of the
+    components at a given number of standard deviations. The components near each point
+    are then found from a KD-tree of the whitened means, so that the cost does not grow
+    quadratically with the number of components.
+    """
+
+    block_size = 2**22
+    tree_block_size = 2**14
+    max_oversampling = 100
 
     @classmethod
-    def pdf(cls, x, means, cov=1, weights=None):
+    def pdf(cls, x, means, cov=1, weights=None, truncate=None):
         """Evaluate the density at points x.
 
         Parameters
@@ -143,28 +274,15 @@ class GMDistribution:
             1d array of weights of the gaussian mixture components
         cov : array_like, float
             A shared covariance matrix for the mixture components
+        truncate : float, optional
+            Leave out the components further than `truncate` standard deviations (in
+            Mahalanobis distance) from the point. See `truncation_error`.
 
         """
-        means, weights = cls._normalize_params(means, weights)
-
-        ndim = np.asanyarray(x).ndim
-        if means.ndim == 1:
-            x = np.atleast_1d(x)
-        if means.ndim == 2:
-            x = np.atleast_2d(x)
-
-        d = np.zeros(len(x))
-        for m, w in zip(means, weights):
-            d += w * ss.multivariate_normal.pdf(x, mean=m, cov=cov)
-
-        # Cast to correct ndim
-        if ndim == 0 or (ndim == 1 and means.ndim == 2):
-            return d.squeeze()
-        else:
-            return d
+        return np.exp(cls.logpdf(x, means=means, cov=cov, weights=weights, truncate=truncate))
 
     @classmethod
-    def logpdf(cls, x, means, cov=1, weights=None):
+    def logpdf(cls, x, means, cov=1, weights=None, truncate=None):
         """Evaluate the log density at points x.
 
         Parameters
@@ -178,14 +296,53 @@ class GMDistribution:
             1d array of weights of the gaussian mixture components
         cov : array_like, float
             A shared covariance matrix for the mixture components
+        truncate : float, optional
+            Leave out the components further than `truncate` standard deviations (in
+            Mahalanobis distance) from the point. The points with no components within
+            this distance are evaluated exactly. See `truncation_error`.
 
         """
-        return np.log(cls.pdf(x, means=means, cov=cov, weights=weights))
+        means, weights = cls._normalize_params(means, weights)
+
+        ndim = np.asanyarray(x).ndim
+        means_ndim = means.ndim
+        if means_ndim == 1:
+            x = np.atleast_1d(x)
+        if means_ndim == 2:
+            x = np.atleast_2d(x)
+
+        x, means, log_norm = cls._whiten(x, means, cov)
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(weights)
+
+        if truncate is None:
+            d = cls._logsumexp_all(x, means, log_weights)
+        else:
+            d = cls._logsumexp_truncated(x, means, log_weights, truncate)
+        d += log_norm
+
+        # Cast to correct ndim
+        if ndim == 0 or (ndim == 1 and means_ndim == 2):
+            return d.squeeze()
+        else:
+            return d
 
     @classmethod
-    def rvs(cls, means, cov=1, weights=None, size=1, prior_logpdf=None, random_state=None):
+    def rvs(cls,
+            means,
+            cov=1,
+            weights=None,
+            size=1,
+            prior_logpdf=None,
+            random_state=None,
+            bounds=None):
         """Draw random variates from the distribution.
 
+        The variates are drawn in batches using a Cholesky factor of the covariance. If some
+        of them are rejected as invalid, the next batch is oversampled according to the
+        observed acceptance rate so that the remaining variates are usually found in a
+        single pass.
+
         Parameters
         ----------
         means : array_like
@@ -200,6 +357,9 @@ class GMDistribution:
         prior_logpdf : callable, optional
             Can be used to check validity of random variable.
         random_state : np.random.RandomState, optional
+        bounds : tuple of array_like, optional
+            Lower and upper bounds of the valid random variables, e.g. `ModelPrior.bounds`.
+            If given, used for checking the validity instead of `prior_logpdf`.
 
         """
         random_state = random_state or np.random
@@ -211,29 +371,40 @@ class GMDistribution:
         else:
             no_wrap = False
 
-        output = np.empty((size,) + means.shape[1:])
+        shape = means.shape[1:]
+        dim = int(np.prod(shape))
+        chol = cls._cholesky(cov, dim)
+        output = np.empty((size,) + shape)
 
         n_accepted = 0
-        n_left = size
+        n_drawn = 0
         trials = 0
 
         while n_accepted < size:
-            inds = random_state.choice(len(means), size=n_left, p=weights)
-            rvs = means[inds]
-            perturb = ss.multivariate_normal.rvs(mean=means[0] * 0,
-                                                 cov=cov,
-                                                 random_state=random_state,
-                                                 size=n_left)
-            x = rvs + perturb
+            n_left = size - n_accepted
+            oversampling = cls.max_oversampling
+            if n_accepted > 0:
+                oversampling = min(1.2 * n_drawn / n_accepted, oversampling)
+            elif n_drawn == 0:
+                oversampling = 1
+            n = int(ceil(n_left * oversampling))
+
+            inds = random_state.choice(len(means), size=n, p=weights)
+            perturb = random_state.standard_normal((n, dim)).dot(chol.T)
+            x = means[inds] + perturb.reshape((n,) + shape)
 
             # check validity of x
-            if prior_logpdf is not None:
+            if bounds is not None:
+                x_2d = x.reshape((n, dim))
+                x = x[np.all((x_2d >= bounds[0]) & (x_2d <= bounds[1]), axis=1)]
+            elif prior_logpdf is not None:
                 x = x[np.isfinite(prior_logpdf(x))]
 
-            n_accepted1 = len(x)
-            output[n_accepted: n_accepted+n_accepted1] = x
-            n_accepted += n_accepted1
-            n_left -= n_accepted1
+            n_valid = len(x)
+            n_drawn += n
+            n_accepted1 = min(n_valid, n_left)
+            output[n_accepted:n_accepted + n_accepted1] = x[:n_accepted1]
+            n_accepted += n_valid
 
             trials += 1
             if trials == 100:
@@ -247,6 +418,123 @@ class GMDistribution:
         else:
             return output
 
+    @classmethod
+    def truncation_error(cls, means, cov, truncate):
+        """Return the bound for the absolute error of the truncated density.
+
+        Every component left out is further than `truncate` standard deviations from the
+        point, so its kernel is at most exp(-truncate**2 / 2) times its maximum. Since the
+        weights sum to one, the truncated density underestimates the density by at most the
+        returned value.
+
+        Parameters
+        ----------
+        means : array_like
+            Means of the Gaussian mixture components
+        cov : array_like, float
+            A shared covariance matrix for the mixture components
+        truncate : float
+            Truncation radius in standard deviations
+
+        Returns
+        -------
+        float
+
+        """
+        means = np.atleast_1d(means)
+        dim = means.shape[1] if means.ndim == 2 else 1
+        log_norm = -.5 * dim * np.log(2 * np.pi) - \
+            np.sum(np.log(np.diag(cls._cholesky(cov, dim))))
+        return np.exp(log_norm - .5 * truncate**2)
+
+    @classmethod
+    def _logsumexp_all(cls, x, means, log_weights):
+        """Sum the kernels of all the components at the whitened points."""
+        d = np.empty(len(x))
+        block = max(cls.block_size // len(means), 1)
+        means_sq = np.sum(means**2, axis=1)
+        for i in range(0, len(x), block):
+            xi = x[i:i + block]
+            # Squared Mahalanobis distances of the points to all the components
+            dist_sq = np.sum(xi**2, axis=1)[:, None] + means_sq[None, :] - 2 * xi.dot(means.T)
+            d[i:i + block] = logsumexp(log_weights - .5 * np.maximum(dist_sq, 0), axis=1)
+        return d
+
+    @classmethod
+    def _logsumexp_truncated(cls, x, means, log_weights, truncate):
+        """Sum the kernels of the components within `truncate` of the whitened points."""
+        # The components with zero weight do not contribute
+        nonzero = np.isfinite(log_weights)
+        means, log_weights = means[nonzero], log_weights[nonzero]
+
+        tree = cKDTree(means)
+        d = np.empty(len(x))
+        for i in range(0, len(x), cls.tree_block_size):
+            xi = x[i:i + cls.tree_block_size]
+            neighbours = tree.query_ball_point(xi, truncate)
+            counts = np.array([len(n) for n in neighbours])
+
+            # Pairs of points and their neighbouring components, grouped by the point
+            found = counts > 0
+            rows = np.repeat(np.arange(len(xi)), counts)
+            cols = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.intp,
+                               count=len(rows))
+            terms = log_weights[cols] - .5 * np.sum((xi[rows] - means[cols])**2, axis=1)
+
+            di = np.empty(len(xi))
+            if len(rows) > 0:
+                starts = np.cumsum(counts)[found] - counts[found]
+                max_terms = np.maximum.reduceat(terms, starts)
+                sums = np.add.reduceat(np.exp(terms - np.repeat(max_terms, counts[found])),
+                                       starts)
+                di[found] = max_terms + np.log(sums)
+
+            # Points far from all the components are evaluated exactly
+            if not np.all(found):
+                di[~found] = cls._logsumexp_all(xi[~found], means, log_weights)
+            d[i:i + cls.tree_block_size] = di
+        return d
+
+    @staticmethod
+    def _cholesky(cov, dim):
+        """Return the lower triangular Cholesky factor of the covariance."""
+        cov = np.asanyarray(cov, dtype=float)
+        if cov.ndim == 0:
+            cov = cov * np.eye(dim)
+        elif cov.ndim == 1:
+            cov = np.diag(cov)
+        return sl.cholesky(cov, lower=True)
+
+    @classmethod
+    def _whiten(cls, x, means, cov):
+        """Transform the points and means so that the covariance is the identity.
+
+        Returns
+        -------
+        x : np.ndarray
+            2d array of the whitened points
+        means : np.ndarray
+            2d array of the whitened means
+        log_norm : float
+            Log normalization constant of the components
+
+        """
+        x = np.asanyarray(x, dtype=float)
+        means = np.asanyarray(means, dtype=float)
+        if means.ndim == 1:
+            x = x.reshape(-1, 1)
+            means = means.reshape(-1, 1)
+        dim = means.shape[1]
+
+        # Center for the accuracy of the distances
+        center = np.mean(means, axis=0)
+        chol = cls._cholesky(cov, dim)
+        x = sl.solve_triangular(chol, (x - center).T, lower=True).T
+        means = sl.solve_triangular(chol, (means - center).T, lower=True).T
+
+        log_norm = -.5 * dim * np.log(2 * np.pi) - np.sum(np.log(np.diag(chol)))
+        return x, means, log_norm
+
     @staticmethod
     def _normalize_params(means, weights):
         means = np.atleast_1d(means)
@@ -305,9 +593,31 @@ def numgrad(fn, x, h=None, replace_neg_inf=True):
 #       pdfs and gradients wouldn't be correct in those cases as it would require
 #       integrating out those latent variables. This is equivalent to that all
 #       stochastic nodes are parameters.
-# TODO: could use some optimization
 class ModelPrior:
-    """Construct a joint prior distribution over all the parameter nodes in `ElfiModel`."""
+    """Construct a joint prior distribution over all the parameter nodes in `ElfiModel`.
+
+    If the parameters are scalars whose distributions depend only on constants and other
+    parameters, the densities are evaluated by calling the distributions directly with the
+    columns of the parameter array instead of computing the ELFI graph. The gradients of
+    the log density are then analytic if the distributions are among `analytic_gradients`
+    with constant parameters, and numerical from the direct evaluation otherwise.
+    """
+
+    # Derivatives of the log densities of `scipy.stats` distributions with respect to the
+    # standardized x, i.e. (x - loc) / scale, given the shape parameters
+    analytic_gradients = {
+        'norm': lambda z: -z,
+        'uniform': lambda z: np.zeros_like(z),
+        'expon': lambda z: -np.ones_like(z),
+        'halfnorm': lambda z: -z,
+        'laplace': lambda z: -np.sign(z),
+        'cauchy': lambda z: -2 * z / (1 + z**2),
+        't': lambda z, df: -(df + 1) * z / (df + z**2),
+        'gamma': lambda z, a: (a - 1) / z - 1,
+        'beta': lambda z, a, b: (a - 1) / z - (b - 1) / (1 - z),
+        'lognorm': lambda z, s: -(1 + np.log(z) / s**2) / z,
+        'truncnorm': lambda z, a, b: -z,
+    }
 
     def __init__(self, model):
         """Initialize a ModelPrior.
@@ -320,15 +630,19 @@ class ModelPrior:
         model = model.copy()
         self.parameter_names = model.parameter_names
         self.dim = len(self.parameter_names)
+        self._terms = self._compile_terms(model)
+        self._gradient_terms = self._compile_gradient_terms(self._terms)
+        self.bounds = self._support_bounds(self._terms)
         self.client = Client()
 
-        # Prepare nets for the pdf methods
-        self._pdf_node = augmenter.add_pdf_nodes(model, log=False)[0]
-        self._logpdf_node = augmenter.add_pdf_nodes(model, log=True)[0]
-
         self._rvs_net = self.client.compile(model.source_net, outputs=self.parameter_names)
-        self._pdf_net = self.client.compile(model.source_net, outputs=self._pdf_node)
-        self._logpdf_net = self.client.compile(model.source_net, outputs=self._logpdf_node)
+
+        # Prepare nets for the pdf methods if the terms cannot be evaluated directly
+        if self._terms is None:
+            self._pdf_node = augmenter.add_pdf_nodes(model, log=False)[0]
+            self._logpdf_node = augmenter.add_pdf_nodes(model, log=True)[0]
+            self._pdf_net = self.client.compile(model.source_net, outputs=self._pdf_node)
+            self._logpdf_net = self.client.compile(model.source_net, outputs=self._logpdf_node)
 
     def rvs(self, size=None, random_state=None):
         """Sample the joint prior."""
@@ -339,7 +653,7 @@ class ModelPrior:
 
         # Change to the correct random_state instance
         # TODO: allow passing random_state to ComputationContext seed
-        loaded_net.node['_random_state'] = {'output': random_state}
+        loaded_net.set_output('_random_state', random_state)
 
         batch = self.client.compute(loaded_net)
         rvs = np.column_stack([batch[p] for p in self.parameter_names])
@@ -358,6 +672,9 @@ class ModelPrior:
         return self._evaluate_pdf(x, log=True)
 
     def _evaluate_pdf(self, x, log=False):
+        if self._terms is not None:
+            return self._evaluate_terms(x, log)
+
         if log:
             net = self._logpdf_net
             node = self._logpdf_node
@@ -377,7 +694,7 @@ class ModelPrior:
 
         # Override
         for k, v in batch.items():
-            loaded_net.node[k] = {'output': v}
+            loaded_net.set_output(k, v)
 
         val = self.client.compute(loaded_net)[node]
         if ndim == 0 or (ndim == 1 and self.dim > 1):
@@ -385,6 +702,113 @@ class ModelPrior:
 
         return val
 
+    @staticmethod
+    def _compile_terms(model):
+        """Compile the factors of the joint density for evaluating them directly.
+
+        Returns
+        -------
+        terms : list or None
+            Tuples `(distribution, args)` in the order of the parameters, where the args
+            are tuples `(index, value)`. The index is that of a parent parameter, or None for
+            a constant value. None if some parameter is not a scalar or has parents that are
+            not constants or parameters.
+
+        """
+        parameter_names = model.parameter_names
+        terms = []
+        for name in parameter_names:
+            node = model[name]
+            if node.size is not None:
+                return None
+
+            parents = model.get_parents(name)
+            if len(parents) != len(list(model.source_net.predecessors(name))):
+                # Parents given by keyword
+                return None
+
+            args = []
+            for parent in parents:
+                state = model.get_state(parent)
+                if parent in parameter_names:
+                    args.append((parameter_names.index(parent), None))
+                elif '_output' in state and '_operation' not in state:
+                    args.append((None, state['_output']))
+                else:
+                    return None
+            terms.append((node.distribution, args))
+        return terms
+
+    @classmethod
+    def _compile_gradient_terms(cls, terms):
+        """Return the analytic gradients of the terms or None if some are not known.
+
+        Returns
+        -------
+        gradient_terms : list or None
+            Tuples `(gradient, shapes, loc, scale)`, see `analytic_gradients`.
+
+        """
+        if terms is None:
+            return None
+
+        gradient_terms = []
+        for distribution, args in terms:
+            if not isinstance(distribution, ss.rv_continuous) or \
+                    distribution.name not in cls.analytic_gradients or \
+                    any(index is not None for index, _ in args):
+                return None
+
+            shapes, loc, scale = distribution._parse_args(*[value for _, value in args])
+            gradient_terms.append((cls.analytic_gradients[distribution.name], shapes, loc,
+                                   scale))
+        return gradient_terms
+
+    @staticmethod
+    def _support_bounds(terms):
+        """Return the lower and upper bounds of the support of the joint prior.
+
+        The bounds can be found only for simple priors, i.e. continuous `scipy.stats`
+        distributions with scalar outputs and constant parameters. Otherwise returns None.
+        """
+        if terms is None:
+            return None
+
+        lower = []
+        upper = []
+        for distribution, args in terms:
+            if not isinstance(distribution, ss.rv_continuous) or \
+                    any(index is not None for index, _ in args):
+                return None
+
+            low, high = distribution.interval(1, *[value for _, value in args])
+            if np.ndim(low) != 0 or np.isnan(low) or np.isnan(high):
+                return None
+            lower.append(float(low))
+            upper.append(float(high))
+
+        return np.array(lower), np.array(upper)
+
+    def _evaluate_terms(self, x, log=False):
+        x = np.asanyarray(x)
+        ndim = x.ndim
+        x = x.reshape((-1, self.dim))
+
+        val = None
+        for i, (distribution, args) in enumerate(self._terms):
+            args = [x[:, index] if index is not None else value for index, value in args]
+            if log:
+                term = distribution.logpdf(x[:, i], *args)
+                val = term if val is None else val + term
+            else:
+                term = distribution.pdf(x[:, i], *args)
+                val = term if val is None else val * term
+
+        if ndim == 0 or (ndim == 1 and self.dim > 1):
+            val = val[0]
+
+        return val
+
     def gradient_pdf(self, x):
         """Return the gradient of density of the joint prior at x."""
         raise NotImplementedError
@@ -403,11 +827,18 @@ class ModelPrior:
         ndim = x.ndim
         x = x.reshape((-1, self.dim))
 
-        grads = np.zeros_like(x)
-
-        for i in range(len(grads)):
-            xi = x[i]
-            grads[i] = numgrad(self.logpdf, xi, h=stepsize)
+        if self._gradient_terms is not None:
+            grads = np.empty(x.shape)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for i, (gradient, shapes, loc, scale) in enumerate(self._gradient_terms):
+                    grads[:, i] = gradient((x[:, i] - loc) / scale, *shapes) / scale
+            # Zero outside the support as with the numerical gradient
+            grads[~np.isfinite(self.logpdf(x))] = 0
+        else:
+            grads = np.zeros_like(x, dtype=float)
+            for i in range(len(grads)):
+                xi = x[i]
+                grads[i] = numgrad(self.logpdf, xi, h=stepsize)
 
         grads[np.isinf(grads)] = 0
         grads[np.isnan(grads)] = 0
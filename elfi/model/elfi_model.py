@@ -170,7 +170,7 @@ class ComputationContext:
         self._pool = pool
 
         # Caches will not be used if they are not found from the caches dict
-        self.caches = {'executor': {}, 'sub_seed': {}}
+        self.caches = {'sub_seed': {}}
 
         # Count the number of submissions from this context
         self.num_submissions = 0
@@ -7,15 +7,18 @@ import pytest
 import scipy.stats as ss
 
 import elfi
+import elfi.clients.asyncio as easync
 import elfi.clients.ipyparallel as eipp
 import elfi.clients.multiprocessing as mp
 import elfi.clients.native as native
+import elfi.clients.threading as ethreading
 import elfi.examples.gauss
 import elfi.examples.ma2
 from elfi.methods.bo.gpy_regression import GPyRegression
 from elfi.methods.bo.acquisition import ExpIntVar, MaxVar, RandMaxVar
 from elfi.methods.utils import ModelPrior
 
+# Each client module sets itself as the default when imported
 elfi.clients.native.set_as_default()
 
 
@@ -31,7 +34,7 @@ def pytest_addoption(parser):
 """Functional fixtures"""
 
 
-@pytest.fixture(scope="session", params=[native, eipp, mp])
+@pytest.fixture(scope="session", params=[native, eipp, mp, ethreading, easync])
 def client(request):
     """Provides a fixture for all the different supported clients
     """
@@ -1,7 +1,11 @@
 import ipyparallel
+import numpy as np
 import pytest
 
 import elfi
+from elfi.client import ClientBase
+from elfi.executor import Cancelled, Executor, cancel_token
+from elfi.model.elfi_model import ComputationContext
 
 
 @pytest.mark.usefixtures('with_all_clients')
@@ -45,3 +49,76 @@ def test_reduce_compiler(ma2, client):
 
     compiled_net2 = client.compile(ma2.source_net, ['MA2'])
     assert not compiled_net2.has_node('S1')
+
+
+def test_execution_plan(ma2):
+    compiled_net = ClientBase.compile(ma2.source_net, ['d'])
+    plan = compiled_net.graph['plan']
+    assert 'd' in plan
+    assert 'S1' in plan
+
+    loaded_net = ClientBase.load_data(compiled_net, ComputationContext(), 0)
+    order = Executor.get_execution_order(loaded_net)
+    assert order.index('MA2') < order.index('S1') < order.index('d')
+    # The observed data is loaded so its simulator is not run
+    assert '_MA2_observed' not in order
+
+    # Given outputs cut off their dependencies
+    given = [node for node in plan.nodes if node != 'd']
+    assert plan.execution_order(['d'], given=given) == ['d']
+
+
+def test_load_data_overlay(ma2):
+    compiled_net = ClientBase.compile(ma2.source_net, ['d'])
+    context = ComputationContext(seed=123)
+    loaded_net = ClientBase.load_data(compiled_net, context, 0)
+
+    # The compiled net is shared, not copied
+    assert loaded_net.plan is compiled_net.graph['plan']
+    assert 'output' not in compiled_net.node['_MA2_observed']
+    assert '_MA2_observed' in loaded_net.data
+
+    res1 = Executor.execute(loaded_net)
+    res2 = Executor.execute(loaded_net)
+    assert np.array_equal(res1['d'], res2['d'])
+
+    # Overriding a node cuts off its dependencies
+    loaded_net.set_output('S1', res1['d'] * 0)
+    assert 'MA2' in Executor.get_execution_order(loaded_net)
+    loaded_net.set_output('S2', res1['d'] * 0)
+    assert 'MA2' not in Executor.get_execution_order(loaded_net)
+
+
+def test_cancel_token(ma2):
+    compiled_net = ClientBase.compile(ma2.source_net, ['d'])
+    loaded_net = ClientBase.load_data(compiled_net, ComputationContext(seed=123), 0)
+
+    with cancel_token(lambda: False):
+        Executor.execute(loaded_net)
+    with pytest.raises(Cancelled):
+        with cancel_token(lambda: True):
+            Executor.execute(loaded_net)
+
+
+def test_batch_invariant_memoization(ma2):
+    calls = []
+
+    def summary(x):
+        calls.append(len(x))
+        return x[:, 0]
+
+    m = ma2.copy()
+    elfi.Summary(summary, m['MA2'], model=m, name='S3')
+    elfi.Distance('euclidean', m['S3'], model=m, name='d3')
+
+    compiled_net = ClientBase.compile(m.source_net, ['d3'])
+    plan = compiled_net.graph['plan']
+    context = ComputationContext(seed=123, batch_size=5)
+    for batch_index in range(3):
+        loaded_net = ClientBase.load_data(compiled_net, context, batch_index)
+        Executor.execute(loaded_net)
+
+    # The summary of the observed data is computed only once
+    assert sorted(calls) == [1, 5, 5, 5]
+    assert plan.index['_S3_observed'] in plan._memo
+    assert plan.index['S3'] not in plan._memo
@@ -1,8 +1,11 @@
+import copy
+
 import numpy as np
 import pytest
 
 import elfi
 import elfi.methods.bo.acquisition as acquisition
+from elfi.methods.bo.gp_regression import RBF, GPRegression, SparseGPRegression
 from elfi.methods.bo.gpy_regression import GPyRegression
 
 
@@ -115,6 +118,19 @@ def test_acquisition():
     with pytest.raises(ValueError):
         acquisition.LCBSC(target_model, noise_var=acq_noise_cov)
 
+    # check the Kriging believer batch acquisition
+    acquisition_method = acquisition.LCBSC(target_model, batch_method='kriging_believer')
+    new = acquisition_method.acquire(n2, t=t)
+    assert new.shape == (n2, n_params)
+    assert not np.allclose(new[1:], new[0])
+    assert np.all((new[:, 0] >= bounds['a'][0]) & (new[:, 0] <= bounds['a'][1]))
+    assert np.all((new[:, 1] >= bounds['b'][0]) & (new[:, 1] <= bounds['b'][1]))
+    # The believed points are not added to the model
+    assert target_model.n_evidence == n
+    assert acquisition_method.model is target_model
+    with pytest.raises(ValueError):
+        acquisition.LCBSC(target_model, batch_method='unknown')
+
     # test Uniform Acquisition
     t = 1
     acquisition_method = acquisition.UniformAcquisition(target_model, noise_var=acq_noise_var)
@@ -124,6 +140,182 @@ def test_acquisition():
     assert np.all((new[:, 1] >= bounds['b'][0]) & (new[:, 1] <= bounds['b'][1]))
 
 
+def test_gpy_regression_copy():
+    gp = GPyRegression(['a'], bounds={'a': [0, 1]})
+    gp.update(np.random.rand(5, 1), np.random.rand(5))
+
+    for kopy in [gp.copy(), copy.copy(gp)]:
+        kopy.update(np.random.rand(2, 1), np.random.rand(2))
+        assert kopy.n_evidence == 7
+        assert gp.n_evidence == 5
+
+
+def test_incremental_update():
+    parameter_names = ['a', 'b']
+    bounds = {'a': [-2, 3], 'b': [5, 6]}
+    gp = GPyRegression(parameter_names, bounds=bounds)
+    gp_incremental = GPyRegression(parameter_names, bounds=bounds, incremental=True)
+
+    def batch(n):
+        x = np.column_stack([np.random.uniform(*bounds[k], n) for k in parameter_names])
+        return x, np.random.rand(n)
+
+    for i in range(4):
+        x, y = batch(5)
+        gp.update(x, y)
+        gp_incremental.update(x, y)
+
+    assert gp_incremental.n_evidence == 20
+    assert np.array_equal(gp_incremental.X, gp.X)
+    # The GPy model was not reconstructed after the first batch
+    assert gp_incremental._gp.num_data == 5
+
+    x = batch(10)[0]
+    for noiseless in [False, True]:
+        mu, var = gp.predict(x, noiseless=noiseless)
+        mu_incremental, var_incremental = gp_incremental.predict(x, noiseless=noiseless)
+        assert np.allclose(mu, mu_incremental)
+        assert np.allclose(var, var_incremental)
+
+    grad_mu, grad_var = gp.predictive_gradients(x)
+    grad_mu_incremental, grad_var_incremental = gp_incremental.predictive_gradients(x)
+    assert np.allclose(grad_mu, grad_mu_incremental)
+    assert np.allclose(grad_var, grad_var_incremental)
+
+    # The kernel is read without reconstructing the GPy model
+    assert np.allclose(gp_incremental.kern.K(x), gp.kern.K(x))
+    assert gp_incremental._gp.num_data == 5
+
+    # Optimizing the hyperparameters reconstructs the GPy model with all the data
+    x, y = batch(5)
+    gp_incremental.update(x, y, optimize=True)
+    assert gp_incremental._gp.num_data == 25
+    assert gp_incremental.n_evidence == 25
+
+
+@pytest.mark.parametrize('kernel', ['rbf', 'matern32', 'matern52'])
+def test_gp_regression(kernel):
+    from scipy.optimize import approx_fprime
+
+    parameter_names = ['a', 'b']
+    bounds = {'a': [-2, 3], 'b': [5, 6]}
+    gp = GPRegression(parameter_names, bounds=bounds, kernel=kernel, seed=1)
+
+    def batch(n):
+        x = np.column_stack([np.random.uniform(*bounds[k], n) for k in parameter_names])
+        return x, np.sin(x[:, 0]) + x[:, 1] + .1 * np.random.rand(n)
+
+    gp.update(*batch(20))
+    for i in range(2):
+        gp.update(*batch(5))
+    assert gp.n_evidence == 30
+
+    # The incremental updates match a fit with all the data
+    chol = gp._chol
+    gp._fit()
+    assert np.allclose(chol, gp._chol)
+
+    # Gradient of the objective of the hyperparameters
+    kern = gp.copy().kern
+    params = np.r_[gp.kern.get_params(), np.log(gp.noise)]
+    value, grad = gp._objective(params, kern)
+    grad_approx = approx_fprime(params, lambda p: gp._objective(p, kern)[0], 1e-6)
+    assert np.allclose(grad, grad_approx, rtol=1e-3, atol=1e-3)
+
+    # The optimization does not make the objective worse
+    gp.optimize()
+    params = np.r_[gp.kern.get_params(), np.log(gp.noise)]
+    assert gp._objective(params, kern)[0] <= value
+
+    # Predictive gradients
+    x = batch(3)[0]
+    grad_mu, grad_var = gp.predictive_gradients(x)
+    for i in range(len(x)):
+        grad_mu_approx = approx_fprime(x[i], lambda x: gp.predict(x)[0][0, 0], 1e-6)
+        grad_var_approx = approx_fprime(x[i], lambda x: gp.predict(x)[1][0, 0], 1e-6)
+        assert np.allclose(grad_mu[i], grad_mu_approx, rtol=1e-3, atol=1e-4)
+        assert np.allclose(grad_var[i], grad_var_approx, rtol=1e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize('approximation', ['vfe', 'fitc'])
+def test_sparse_gp_regression(approximation):
+    from scipy.optimize import approx_fprime
+
+    parameter_names = ['a', 'b']
+    bounds = {'a': [-2, 3], 'b': [5, 6]}
+
+    def batch(n):
+        x = np.column_stack([np.random.uniform(*bounds[k], n) for k in parameter_names])
+        return x, np.sin(x[:, 0]) + .1 * np.random.rand(n)
+
+    # With all the evidence as inducing points the approximation is exact
+    kernel = RBF(2, variance=1., lengthscale=.5)
+    gp = GPRegression(parameter_names, bounds=bounds, kernel=kernel, noise_var=.1)
+    sparse_gp = SparseGPRegression(parameter_names, bounds=bounds, kernel=kernel, noise_var=.1,
+                                   n_inducing=20, approximation=approximation)
+    x, y = batch(20)
+    gp.update(x, y)
+    sparse_gp.update(x, y)
+
+    x = batch(10)[0]
+    for noiseless in [False, True]:
+        mu, var = gp.predict(x, noiseless=noiseless)
+        mu_sparse, var_sparse = sparse_gp.predict(x, noiseless=noiseless)
+        assert np.allclose(mu, mu_sparse, rtol=1e-3, atol=1e-4)
+        assert np.allclose(var, var_sparse, rtol=1e-3, atol=1e-4)
+
+    for inducing in ['kmeans', 'greedy']:
+        sparse_gp = SparseGPRegression(parameter_names, bounds=bounds, n_inducing=10,
+                                       inducing=inducing, approximation=approximation, seed=1)
+        sparse_gp.update(*batch(30), optimize=True)
+        assert sparse_gp.Z.shape == (10, 2)
+
+        # The incremental updates match a fit with all the evidence
+        for i in range(2):
+            sparse_gp.update(*batch(5))
+        assert sparse_gp.n_evidence == 40
+        woodbury_vector = sparse_gp._woodbury_vector
+        sparse_gp._fit()
+        assert np.allclose(woodbury_vector, sparse_gp._woodbury_vector)
+
+        # Gradient of the objective of the hyperparameters, also over several blocks
+        sparse_gp.block_size = 16
+        kern = sparse_gp.copy().kern
+        params = np.r_[sparse_gp.kern.get_params(), np.log(sparse_gp.noise)] + .2
+        grad = sparse_gp._objective(params, kern)[1]
+        grad_approx = approx_fprime(params, lambda p: sparse_gp._objective(p, kern)[0], 1e-6)
+        assert np.allclose(grad, grad_approx, rtol=1e-3, atol=1e-3)
+
+        x = batch(3)[0]
+        grad_mu, grad_var = sparse_gp.predictive_gradients(x)
+        for i in range(len(x)):
+            grad_mu_approx = approx_fprime(x[i], lambda x: sparse_gp.predict(x)[0][0, 0], 1e-6)
+            grad_var_approx = approx_fprime(x[i], lambda x: sparse_gp.predict(x)[1][0, 0], 1e-6)
+            assert np.allclose(grad_mu[i], grad_mu_approx, rtol=1e-3, atol=1e-4)
+            assert np.allclose(grad_var[i], grad_var_approx, rtol=1e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize('target_model_class', [GPRegression, SparseGPRegression])
+def test_BO_gp_regression(ma2, target_model_class):
+    log_d = elfi.Operation(np.log, ma2['d'], name='log_d')
+    bounds = {n: (-2, 2) for n in ma2.parameter_names}
+    target_model = target_model_class(ma2.parameter_names, bounds=bounds, kernel='matern52',
+                                      seed=1)
+    bolfi = elfi.BOLFI(
+        log_d,
+        target_model=target_model,
+        initial_evidence=10,
+        update_interval=5,
+        batch_size=5,
+        bounds=bounds,
+        seed=1)
+    bolfi.infer(20)
+    assert target_model.n_evidence == 20
+
+    post = bolfi.extract_posterior()
+    assert np.isfinite(post.logpdf(np.zeros(2)))
+
+
 class Test_MaxVar:
     """Run a collection of tests for the MaxVar acquisition."""
 
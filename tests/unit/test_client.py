@@ -1,9 +1,25 @@
+import asyncio
+import gc
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pytest
 import scipy.stats as ss
 
 import elfi
 import elfi.client
+import elfi.clients.asyncio
+import elfi.clients.multiprocessing as mp
+import elfi.clients.native as native
+import elfi.clients.threading
+import elfi.executor
+from elfi.client import ClientBase, PlanRegistry
+from elfi.executor import Executor
 
 
 @pytest.mark.usefixtures('with_all_clients')
@@ -45,3 +61,392 @@ def test_multiprocessing_kwargs(simple_model):
     elfi.set_client(pre)
 
 # TODO: add testing that client is cleared from tasks after they are retrieved
+
+
+def test_execute_cached(ma2):
+    compiled_net = ClientBase.compile(ma2.source_net, ['d'])
+    loaded_net = ClientBase.load_data(compiled_net, elfi.ComputationContext(seed=123), 0)
+    key, payload = PlanRegistry().register(loaded_net.plan)
+
+    # The observed data is left out from the batch
+    batch_data = loaded_net.batch_data()
+    assert '_MA2_observed' in loaded_net.data
+    assert '_MA2_observed' not in batch_data
+
+    args = (loaded_net.outputs, batch_data, loaded_net.operations)
+    assert Executor.execute_cached('not cached', *args) is None
+
+    res = Executor.execute(loaded_net)
+    res_cached = Executor.execute_cached(key, *args, plan=payload)
+    assert np.array_equal(res['d'], res_cached['d'])
+    res_cached = Executor.execute_cached(key, *args)
+    assert np.array_equal(res['d'], res_cached['d'])
+
+    # Plans missing from the cache are loaded from their files
+    with tempfile.TemporaryDirectory() as directory:
+        registry = PlanRegistry(directory=directory)
+        key, payload = registry.register(loaded_net.plan)
+        path = os.path.join(directory, '{}.plan'.format(key))
+        assert registry._prepare(loaded_net)[1] == {'plan': path}
+        elfi.executor._plan_cache.pop(key)
+        res_cached = Executor.execute_cached(key, *args, plan=path)
+        assert np.array_equal(res['d'], res_cached['d'])
+
+    # The plans of separate compilations are cached separately with their memoized outputs
+    other_net = ClientBase.compile(ma2.source_net, ['d'])
+    assert PlanRegistry().register(other_net.graph['plan'])[0] != key
+
+    # The plans are serialized with the serializer of the client
+    dumped = []
+    registry = PlanRegistry(dumps=lambda plan: dumped.append(plan) or b'plan')
+    assert registry.register(loaded_net.plan)[1] == b'plan'
+    assert dumped == [loaded_net.plan]
+
+
+def identity(x):
+    return x
+
+
+def test_compile_cache(ma2):
+    # The inferences compile copies of the model
+    rej1 = elfi.Rejection(ma2, 'd', batch_size=5, compile_cache=True)
+    rej2 = elfi.Rejection(ma2, 'd', batch_size=5, compile_cache=True)
+    assert rej1.batches.compiled_net is rej2.batches.compiled_net
+
+    # The cache is opt-in
+    rej3 = elfi.Rejection(ma2, 'd', batch_size=5)
+    assert rej3.batches.compiled_net is not rej1.batches.compiled_net
+    assert ClientBase.compile(ma2.source_net, ['d']) is not \
+        ClientBase.compile(ma2.source_net, ['d'])
+
+    # Different outputs
+    compiled_net = ClientBase.compile(ma2.source_net, ['d'], cache=True)
+    assert ClientBase.compile(ma2.source_net, ['S1'], cache=True) is not compiled_net
+
+    # Modified nodes
+    m = ma2.copy()
+    assert ClientBase.compile(m.source_net, ['d'], cache=True) is compiled_net
+    m['t1'].become(elfi.Prior('uniform', 0, 1, model=m))
+    assert ClientBase.compile(m.source_net, ['d'], cache=True) is not compiled_net
+
+    # Values compared by their contents and type
+    nets = []
+    for value in [1, 1, 1., True, [1, 2], [1, 2]]:
+        m = elfi.ElfiModel()
+        elfi.Constant(value, model=m, name='c')
+        elfi.Operation(identity, m['c'], model=m, name='op')
+        nets.append(ClientBase.compile(m.source_net, ['op'], cache=True))
+    assert nets[0] is nets[1]
+    assert nets[4] is nets[5]
+    assert len(set(map(id, nets))) == 4
+
+    # Arrays compared by their contents, also after modifying them in place
+    arrays = [np.zeros(3), np.zeros(3), np.ones(3)]
+    models = []
+    for value in arrays:
+        m = elfi.ElfiModel()
+        elfi.Constant(value, model=m, name='c')
+        elfi.Operation(identity, m['c'], model=m, name='op')
+        models.append(m)
+    del nets
+    gc.collect()
+    n_cached = len(ClientBase.compile_cache)
+    nets = [ClientBase.compile(m.source_net, ['op'], cache=True) for m in models]
+    assert nets[0] is nets[1]
+    assert nets[2] is not nets[0]
+    arrays[0][:] = 1
+    assert ClientBase.compile(models[0].source_net, ['op'], cache=True) is nets[2]
+
+    # The compilations are dropped when they are no longer used
+    assert len(ClientBase.compile_cache) == n_cached + 2
+    del nets
+    gc.collect()
+    assert len(ClientBase.compile_cache) == n_cached
+
+
+def test_multiprocessing_plan_not_cached(simple_model):
+    # The workers load the plan from its file when they first get a batch
+    client = mp.Client(num_processes=2)
+    context = elfi.ComputationContext(seed=123, batch_size=10)
+    batches = elfi.client.BatchHandler(simple_model, context, 'k2', client=client)
+    for i in range(4):
+        batches.submit()
+    outputs = [batches.wait_next()[0]['k2'] for i in range(4)]
+
+    batches = elfi.client.BatchHandler(simple_model, context, 'k2', client=native.Client())
+    for i in range(4):
+        batches.submit()
+        assert np.array_equal(batches.wait_next()[0]['k2'], outputs[i])
+
+
+@pytest.mark.usefixtures('with_all_clients')
+def test_batch_handler_chunks(simple_model):
+    m = simple_model
+    computation_context = elfi.ComputationContext(seed=123, batch_size=10)
+    batches = elfi.client.BatchHandler(m, computation_context, 'k2', chunk_size=3)
+
+    for i in range(4):
+        batches.submit()
+    # The last batch waits for its chunk to fill up
+    assert batches.num_pending == 4
+    outputs = [batches.wait_next() for i in range(4)]
+    assert [i for _, i in outputs] == list(range(4))
+    assert not batches.has_pending
+
+    # Cancel a partially received chunk
+    for i in range(3):
+        batches.submit()
+    batches.wait_next()
+    batches.cancel_pending()
+    assert batches.next_index == 5
+
+    batches = elfi.client.BatchHandler(m, computation_context, 'k2')
+    for i in range(4):
+        batches.submit()
+        assert np.array_equal(batches.wait_next()[0]['k2'], outputs[i][0]['k2'])
+
+
+def test_batch_handler_cancel_from_index(simple_model):
+    computation_context = elfi.ComputationContext(seed=123, batch_size=10)
+    batches = elfi.client.BatchHandler(simple_model, computation_context, 'k2',
+                                       client=native.Client(), chunk_size=2)
+    for i in range(5):
+        batches.submit()
+
+    # Cancel a batch of a sent chunk and a batch waiting for its chunk
+    batches.cancel_pending(from_index=3)
+    assert list(batches.pending_indices) == [0, 1, 2]
+    assert batches.next_index == 3
+    assert [batches.wait_next()[1] for i in range(3)] == [0, 1, 2]
+
+
+@pytest.mark.usefixtures('with_all_clients')
+def test_rejection_chunks(ma2):
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1)
+    sample = rej.sample(10, n_sim=200)
+
+    for chunk_size in [3, 'auto']:
+        rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1, chunk_size=chunk_size)
+        sample_chunked = rej.sample(10, n_sim=200)
+        assert np.array_equal(sample.outputs['d'], sample_chunked.outputs['d'])
+
+
+def slow_first_batch(batch_size, meta):
+    if meta['batch_index'] % 3 == 0:
+        time.sleep(.5)
+    return np.full(batch_size, meta['batch_index'])
+
+
+def test_batch_handler_wait_any():
+    m = elfi.ElfiModel()
+    op = elfi.Operation(slow_first_batch, model=m, name='op')
+    op['_uses_batch_size'] = True
+    op['_uses_meta'] = True
+
+    client = mp.Client(num_processes=2)
+    computation_context = elfi.ComputationContext(seed=123, batch_size=3)
+    batches = elfi.client.BatchHandler(m, computation_context, 'op', client=client)
+
+    for i in range(3):
+        batches.submit()
+
+    # Batch 0 is still being computed
+    out1, i1 = batches.wait_any()
+    out2, i2 = batches.wait_any()
+    out0, i0 = batches.wait_any()
+    assert (i1, i2, i0) == (1, 2, 0)
+    assert np.array_equal(out1['op'], [1, 1, 1])
+
+    # Cancelling batch 3 rewinds the next index to it but skips the received batches
+    for i in range(3):
+        batches.submit()
+    assert sorted([batches.wait_any()[1], batches.wait_any()[1]]) == [4, 5]
+    batches.cancel_pending()
+    assert batches.next_index == 3
+    batches.submit()
+    assert batches.next_index == 6
+    batches.submit()
+    assert sorted([batches.wait_any()[1], batches.wait_any()[1]]) == [3, 6]
+    assert not batches.has_ready(any_batch=True)
+
+
+def test_threading_client_shares_memory():
+    # A closure over a local object cannot be pickled but is shared with the threads
+    calls = []
+
+    def sim(batch_size, random_state=None):
+        calls.append(batch_size)
+        return np.zeros(batch_size)
+
+    m = elfi.ElfiModel()
+    elfi.Simulator(sim, model=m, name='sim')
+
+    client = elfi.clients.threading.Client(num_threads=2)
+    assert client.num_cores == 2
+    computation_context = elfi.ComputationContext(seed=123, batch_size=3)
+    batches = elfi.client.BatchHandler(m, computation_context, 'sim', client=client)
+
+    for i in range(4):
+        batches.submit()
+    outputs = [batches.wait_next()[0]['sim'] for i in range(4)]
+    assert calls == [3, 3, 3, 3]
+    assert all(np.array_equal(o, np.zeros(3)) for o in outputs)
+
+
+def run_until_complete(*coroutines):
+    async def gather():
+        return await asyncio.gather(*coroutines)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
+
+
+def test_asyncio_client_ainfer(ma2):
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1)
+    sample = rej.sample(10, n_sim=200)
+
+    pre = elfi.get_client()
+    try:
+        # The inferences share the workers of the client
+        elfi.set_client(elfi.clients.asyncio.Client(num_processes=2))
+        rejs = [elfi.Rejection(ma2, 'd', batch_size=5, seed=1) for i in range(3)]
+        samples = run_until_complete(*[rej.asample(10, n_sim=200) for rej in rejs])
+        for s in samples:
+            assert np.array_equal(sample.outputs['d'], s.outputs['d'])
+
+        # Clients without notification of completed tasks are polled
+        elfi.set_client(native.Client())
+        rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1)
+        s, = run_until_complete(rej.ainfer(10, n_sim=200))
+        assert np.array_equal(sample.outputs['d'], s.outputs['d'])
+    finally:
+        elfi.set_client(pre)
+
+
+def test_asyncio_client_wait_ready():
+    client = elfi.clients.asyncio.Client(executor=ThreadPoolExecutor(max_workers=1))
+    release = threading.Event()
+    task_id = client.apply(release.wait, 5)
+
+    async def wait():
+        waiting = [asyncio.ensure_future(client.wait_ready(task_id)) for i in range(3)]
+        await asyncio.sleep(.1)
+        # The waiting coroutines share a single future that survives their cancellation
+        assert len(client._waiters) == 1
+        waiting[0].cancel()
+        release.set()
+        await asyncio.gather(*waiting[1:])
+
+    run_until_complete(wait())
+    assert client.get_result(task_id) is True
+    assert len(client._waiters) == 0
+
+    # Removing the tasks wakes up the coroutines waiting for them
+    for remove in [client.remove_task, lambda task_id: client.reset()]:
+        release.clear()
+        task_id = client.apply(release.wait, 5)
+
+        async def wait_removed():
+            waiting = asyncio.ensure_future(client.wait_ready(task_id))
+            await asyncio.sleep(.1)
+            remove(task_id)
+            await asyncio.wait_for(waiting, 1)
+
+        run_until_complete(wait_removed())
+        assert len(client._waiters) == 0
+        release.set()
+
+
+def large_output(batch_size, random_state=None):
+    return np.arange(batch_size * 10000, dtype=float).reshape(batch_size, -1)
+
+
+def test_multiprocessing_shared_results():
+    m = elfi.ElfiModel()
+    elfi.Simulator(large_output, model=m, name='sim')
+
+    client = mp.Client(num_processes=2, shared_min_bytes=1000)
+    computation_context = elfi.ComputationContext(seed=123, batch_size=3)
+    batches = elfi.client.BatchHandler(m, computation_context, 'sim', client=client,
+                                       chunk_size=2)
+    for i in range(4):
+        batches.submit()
+    for i in range(4):
+        batch, _ = batches.wait_next()
+        assert np.array_equal(batch['sim'], large_output(3))
+        # The results do not map the scratch files
+        assert not isinstance(batch['sim'], np.memmap)
+
+    # The scratch files are removed when the arrays are received
+    assert os.listdir(client.scratch_dir) == ['plans']
+
+
+def sleep_short(batch_size, random_state=None):
+    time.sleep(.5)
+    return np.zeros(batch_size)
+
+
+def sleep_long(x):
+    time.sleep(30)
+    return x
+
+
+def test_multiprocessing_cancel():
+    m = elfi.ElfiModel()
+    elfi.Simulator(sleep_short, model=m, name='sim')
+    elfi.Summary(sleep_long, m['sim'], model=m, name='slow')
+
+    client = mp.Client(num_processes=1)
+    computation_context = elfi.ComputationContext(seed=123, batch_size=3)
+    batches = elfi.client.BatchHandler(m, computation_context, 'slow', client=client)
+    for i in range(3):
+        batches.submit()
+    time.sleep(.2)
+    batches.cancel_pending()
+
+    # The running task stops before the slow node and the queued tasks are not started
+    start = time.time()
+    client.apply_sync(os.getpid)
+    assert time.time() - start < 5
+
+
+def sleep_long_sim(batch_size, random_state=None):
+    time.sleep(30)
+    return np.zeros(batch_size)
+
+
+def test_multiprocessing_force_cancel():
+    m = elfi.ElfiModel()
+    elfi.Simulator(sleep_long_sim, model=m, name='sim')
+
+    client = mp.Client(num_processes=1, force_cancel=True)
+    pid = client.apply_sync(os.getpid)
+    computation_context = elfi.ComputationContext(seed=123, batch_size=3)
+    batches = elfi.client.BatchHandler(m, computation_context, 'sim', client=client)
+    batches.submit()
+    time.sleep(.5)
+    batches.cancel_pending()
+
+    # The worker was terminated and replaced with a new process
+    assert client.apply_sync(os.getpid) != pid
+
+    # The pool does not wait for the result of the terminated task
+    client.pool.close()
+    closer = threading.Thread(target=client.pool.join, daemon=True)
+    closer.start()
+    closer.join(10)
+    assert not closer.is_alive()
+
+
+def test_task_table_reclaims_dead_workers():
+    table = mp.TaskTable(1)
+    process = multiprocessing.Process(target=table.start, args=(1, ))
+    process.start()
+    process.join()
+    assert list(table.running) == [1]
+
+    # The slot of the dead worker is freed for the next task
+    assert table.start(2) == 0
@@ -2,7 +2,9 @@ import numpy as np
 import pytest
 
 import elfi
+import elfi.clients.multiprocessing as mp
 import elfi.examples.ma2 as exma2
+from elfi.loader import get_sub_seed
 from elfi.methods.parameter_inference import ParameterInference
 
 
@@ -44,6 +46,96 @@ def test_smc(ma2):
     assert np.all(exma2.CustomPrior2.pdf(samples[:, 1], samples[:, 0], 1) > 0)
 
 
+def test_smc_rounds_reuse_rejection(ma2):
+    smc = elfi.SMC(ma2['d'], batch_size=500, seed=1)
+    res = smc.sample(100, thresholds=[.5, .2, .1])
+    assert len(res.populations) == 3
+
+    # The rejection sampler of the rounds is reused with the seed of the last round
+    rejection = smc._rejection
+    assert rejection.seed == get_sub_seed(1, 2)
+    assert rejection.batches.context is rejection.computation_context
+
+
+def test_smc_kernel_truncation(ma2):
+    thresholds = [.5, .2]
+    N = 1000
+    smc = elfi.SMC(ma2['d'], batch_size=20000, seed=1)
+    res = smc.sample(N, thresholds=thresholds)
+
+    smc = elfi.SMC(ma2['d'], batch_size=20000, seed=1, kernel_truncation=10)
+    res_truncated = smc.sample(N, thresholds=thresholds)
+    assert np.allclose(res.weights, res_truncated.weights)
+
+
+def test_smc_adaptive_thresholds(ma2):
+    N = 500
+    smc = elfi.SMC(ma2['d'], batch_size=5000, seed=1)
+    res = smc.sample(N, quantile=.5, min_accept_rate=.1)
+
+    thresholds = [pop.threshold for pop in res.populations]
+    assert len(thresholds) > 1
+    assert np.all(np.diff(thresholds) < 0)
+    assert res.threshold == thresholds[-1]
+
+    # Finished after the first round below the acceptance rate
+    accept_rates = [pop.accept_rate for pop in res.populations]
+    assert np.all(np.array(accept_rates[:-1]) >= .1)
+    assert accept_rates[-1] < .1
+
+
+def test_smc_pipelined_rounds(ma2):
+    N = 1000
+    thresholds = [.5, .2, .1]
+    res_native = elfi.SMC(ma2['d'], batch_size=500, seed=1, max_parallel_batches=4).sample(
+        N, thresholds=thresholds)
+
+    pre = elfi.get_client()
+    try:
+        # The batches of a parallel client are simulated while the rounds are processed
+        elfi.set_client(mp.Client(num_processes=2))
+        smc = elfi.SMC(ma2['d'], batch_size=500, seed=1, max_parallel_batches=4)
+
+        # Record the rounds of the proposals of the batches when they are received
+        rounds = []
+        compute_log_weights = smc._compute_log_weights
+
+        def spy(batch, rows, round):
+            rounds.append((round, smc.state['round']))
+            return compute_log_weights(batch, rows, round)
+
+        smc._compute_log_weights = spy
+        res = smc.sample(N, thresholds=thresholds)
+    finally:
+        elfi.set_client(pre)
+
+    # The batches following the last batch of a round were used in the next round
+    assert any(r < current for r, current in rounds)
+    assert sum(pop.n_batches for pop in res.populations) == smc.state['n_batches']
+    for pop in res.populations:
+        assert len(pop.weights) == N
+        assert np.all(np.isfinite(pop.weights)) and np.all(pop.weights >= 0)
+
+    # The carried over batches do not depend on the client
+    assert np.array_equal(res.samples_array, res_native.samples_array)
+    assert np.array_equal(res.weights, res_native.weights)
+
+
+@pytest.mark.parametrize('proposal_cov', ['full', 'local'])
+def test_smc_proposal_cov(ma2, proposal_cov):
+    smc = elfi.SMC(ma2['d'], batch_size=5000, seed=1, proposal_cov=proposal_cov)
+    res = smc.sample(500, thresholds=[.5, .2])
+
+    cov = res.populations[0].cov
+    assert cov.shape == (2, 2)
+    assert cov[0, 1] != 0
+    assert np.all(np.linalg.eigvalsh(cov) > 0)
+    assert np.all(np.isfinite(res.weights))
+
+    with pytest.raises(ValueError):
+        elfi.SMC(ma2['d'], proposal_cov='unknown')
+
+
 # A superficial test to compensate for test_inference.test_BOLFI not being run on Travis
 @pytest.mark.usefixtures('with_all_clients')
 def test_BOLFI_short(ma2, distribution_test):
@@ -90,3 +182,59 @@ def test_BOLFI_short(ma2, distribution_test):
     grad_cached_mu, grad_cached_var = bolfi.target_model.predictive_gradients(x)
     assert (np.allclose(grad_mu[:, :, 0], grad_cached_mu))
     assert (np.allclose(grad_var, grad_cached_var))
+
+
+def test_rejection_streaming_selection(ma2):
+    pool = elfi.OutputPool(['d'])
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1, pool=pool)
+    res = rej.sample(20, n_sim=500)
+
+    discrepancies = np.concatenate([pool.stores['d'][i] for i in range(100)])
+    assert np.array_equal(res.discrepancies, np.sort(discrepancies)[:20])
+    assert res.threshold == res.discrepancies[-1]
+
+    # The threshold is updated after every batch
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1)
+    rej.set_objective(20, n_sim=500)
+    while not rej.finished:
+        rej.iterate()
+        n = rej.state['n_sim']
+        expected = np.sort(discrepancies[:n])[19] if n >= 20 else np.inf
+        assert rej.state['threshold'] == expected
+
+
+def test_rejection_samples_path(ma2, tmpdir):
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1)
+    res = rej.sample(20, n_sim=500)
+
+    rej = elfi.Rejection(ma2, 'd', batch_size=5, seed=1, samples_path=str(tmpdir))
+    # Move the samples a few rows at a time
+    rej.merge_chunk_bytes = 30
+    res_path = rej.sample(20, n_sim=500)
+
+    assert isinstance(res_path.outputs['t1'], np.memmap)
+    for k, v in res.outputs.items():
+        assert np.array_equal(v, res_path.outputs[k])
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_rejection_threshold_streaming(ma2, tmpdir):
+    pool = elfi.OutputPool(['d'])
+    rej = elfi.Rejection(ma2, 'd', batch_size=50, seed=1, pool=pool)
+    res = rej.sample(20, threshold=.5)
+
+    # The smallest acceptable simulations in the order of the batches
+    discrepancies = np.concatenate([pool.stores['d'][i] for i in range(rej.state['n_batches'])])
+    acceptable = discrepancies[discrepancies <= .5]
+    smallest = np.sort(np.argsort(acceptable, kind='mergesort')[:20])
+    assert np.array_equal(res.discrepancies, acceptable[smallest])
+    assert len(acceptable) > 20
+    # The inference finishes on the batch that completes the samples
+    assert np.sum(discrepancies[:-50] <= .5) < 20
+    assert res.threshold == .5
+    assert rej.state['eta'] == 0
+
+    rej = elfi.Rejection(ma2, 'd', batch_size=50, seed=1, samples_path=str(tmpdir))
+    res_path = rej.sample(20, threshold=.5)
+    for k, v in res.outputs.items():
+        assert np.array_equal(v, res_path.outputs[k])
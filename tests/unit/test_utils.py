@@ -3,12 +3,14 @@ from collections import OrderedDict
 
 import numpy as np
 import scipy.stats as ss
+from scipy.special import logsumexp
 
 import elfi
 from elfi.examples.ma2 import get_model
-from elfi.methods.bo.utils import minimize, stochastic_optimization
-from elfi.methods.utils import (GMDistribution, ModelPrior, normalize_weights, numgrad,
-                                numpy_to_python_type, sample_object_to_dict, weighted_var)
+from elfi.methods.bo.utils import _minimize_vectorized, minimize, stochastic_optimization
+from elfi.methods.utils import (GMDistribution, ModelPrior, local_cov, normalize_weights,
+                                numgrad, numpy_to_python_type, sample_object_to_dict,
+                                select_smallest, weighted_cov, weighted_var)
 
 
 def test_stochastic_optimization():
@@ -46,6 +48,41 @@ def test_minimize_with_approx_gradient():
     assert np.allclose(loc, np.array([0, 1]), atol=0.02)
 
 
+def test_minimize_vectorized():
+    calls = []
+
+    def fun(x):
+        calls.append(len(x))
+        return x[:, 0]**2 + (x[:, 1] - 1)**4
+
+    def grad(x):
+        return np.column_stack((2 * x[:, 0], 4 * (x[:, 1] - 1)**3))
+
+    bounds = ((-2, 2), (-2, 3))
+    for g in [grad, None]:
+        calls.clear()
+        loc, val = minimize(fun, bounds, g, n_start_points=8, vectorized=True,
+                            random_state=np.random.RandomState(0))
+        assert np.isclose(val, 0, atol=0.01)
+        assert np.allclose(loc, np.array([0, 1]), atol=0.02)
+        # All the starting points are evaluated in the same call
+        assert calls[0] == 8
+
+
+def test_minimize_vectorized_per_start():
+    def fun(x):
+        return (1 - x[:, 0])**2 + 100 * (x[:, 1] - x[:, 0]**2)**2
+
+    bounds = ((-2, 2), (-1, 3))
+    start_points = np.array([[1, 1], [-1.5, 2.], [1.5, -.5], [0, 0]])
+
+    # Each point converges on its own, also after the point already at the minimum
+    locs, vals = _minimize_vectorized(fun, bounds, None, start_points, maxiter=1000,
+                                      prune_interval=1000)
+    assert np.allclose(locs, 1, atol=1e-3)
+    assert np.allclose(vals, 0, atol=1e-6)
+
+
 def test_weighted_var():
     # 1d case
     std = .3
@@ -60,6 +97,40 @@ def test_weighted_var():
     assert np.linalg.norm(weighted_var(x, w) - np.diag(cov)) < .1
 
 
+def test_weighted_cov():
+    random = np.random.RandomState(0)
+    x = random.randn(100, 3)
+    w = random.rand(100)
+    cov = weighted_cov(x, w)
+    assert np.allclose(cov, np.cov(x, rowvar=False, aweights=w))
+    assert np.allclose(np.diag(cov), weighted_var(x, w))
+
+
+def test_local_cov():
+    # Two distant modes with a small local spread
+    random = np.random.RandomState(0)
+    x = np.vstack([random.randn(200, 2) * .1, random.randn(200, 2) * .1 + 10])
+    w = random.rand(400)
+    w[0] = 0
+
+    cov = local_cov(x, w, n_neighbours=20)
+    assert cov.shape == (2, 2)
+    assert np.all(np.diag(cov) < .1**2)
+    assert np.all(np.diag(cov) > 0)
+    assert np.all(np.diag(weighted_cov(x, w)) > 10)
+
+
+def test_select_smallest():
+    values = np.array([3., 1., np.nan, 2., 1., 2., 0.])
+    index = np.array([6, 5, 4, 3, 2, 1, 0])
+
+    assert set(select_smallest(values, index, 3)) == {6, 1, 4}
+    # Ties are broken by the smaller index
+    assert set(select_smallest(values, index, 4)) == {6, 1, 4, 5}
+    assert set(select_smallest(values, index, 7)) == set(range(7))
+    assert len(select_smallest(values, index, 0)) == 0
+
+
 class TestGMDistribution:
     def test_pdf(self, distribution_test):
         # 1d case
@@ -91,6 +162,56 @@ class TestGMDistribution:
         # Distribution_test with 3d means
         distribution_test(GMDistribution, means, weights=weights)
 
+    def test_logpdf(self):
+        means = [[0, 0], [1, -2], [3, 1]]
+        weights = normalize_weights([.2, .5, .3])
+        cov = [[2, .5], [.5, 1]]
+        x = np.random.RandomState(0).randn(50, 2) * 3
+        d = GMDistribution.logpdf(x, means, cov=cov, weights=weights)
+        d_true = np.log(sum(w * ss.multivariate_normal.pdf(x, mean=m, cov=cov)
+                            for m, w in zip(means, weights)))
+        assert np.allclose(d, d_true)
+
+        # Computed in blocks
+        GMDistribution.block_size = 10
+        try:
+            assert np.allclose(GMDistribution.logpdf(x, means, cov=cov, weights=weights), d)
+        finally:
+            GMDistribution.block_size = 2**22
+
+        # Does not underflow far from the components
+        x_far = [[100, 100]]
+        d_far = GMDistribution.logpdf(x_far, means, cov=cov, weights=weights)
+        d_true = logsumexp([np.log(w) + ss.multivariate_normal.logpdf(x_far, mean=m, cov=cov)
+                            for m, w in zip(means, weights)])
+        assert np.isfinite(d_far)
+        assert np.allclose(d_far, d_true)
+
+    def test_logpdf_truncated(self):
+        random = np.random.RandomState(0)
+        means = random.randn(500, 2)
+        weights = normalize_weights(random.rand(500))
+        weights[0] = 0
+        cov = [[.1, .02], [.02, .05]]
+        x = np.vstack([random.randn(200, 2), [[50, 50]]])
+
+        d = GMDistribution.pdf(x, means, cov=cov, weights=weights)
+        d_trunc = GMDistribution.pdf(x, means, cov=cov, weights=weights, truncate=3)
+        error = GMDistribution.truncation_error(means, cov, 3)
+        assert np.all(d_trunc <= d * (1 + 1e-12))
+        assert np.all(d - d_trunc <= error)
+        assert not np.allclose(d_trunc, d)
+
+        # Points far from all the components are evaluated exactly. Their densities
+        # underflow, so the log densities are compared.
+        logd = GMDistribution.logpdf(x, means, cov=cov, weights=weights)
+        logd_trunc = GMDistribution.logpdf(x, means, cov=cov, weights=weights, truncate=3)
+        assert np.isfinite(logd_trunc[-1])
+        assert np.allclose(logd_trunc[-1], logd[-1])
+
+        logd_trunc = GMDistribution.logpdf(x, means, cov=cov, weights=weights, truncate=10)
+        assert np.allclose(logd_trunc, logd)
+
     def test_rvs(self):
         means = [[1000, 3], [-1000, -3]]
         weights = [.3, .7]
@@ -115,6 +236,31 @@ class TestGMDistribution:
         # Ensure prior pdf > 0 for all samples
         assert np.all(np.isfinite(prior_logpdf(rvs)))
 
+    def test_rvs_bounds(self):
+        means = [[.8, 0], [.5, 1]]
+        cov = [[.5, .1], [.1, .2]]
+        N = 10000
+        bounds = (np.array([0, -1]), np.array([1, 1]))
+        random = np.random.RandomState(0)
+        rvs = GMDistribution.rvs(means, cov=cov, size=N, bounds=bounds, random_state=random)
+
+        assert rvs.shape == (N, 2)
+        assert np.all((rvs >= bounds[0]) & (rvs <= bounds[1]))
+
+        # The same variates are found with the prior
+        prior = ModelPrior(self._uniform_model())
+        random = np.random.RandomState(0)
+        rvs_prior = GMDistribution.rvs(means, cov=cov, size=N, prior_logpdf=prior.logpdf,
+                                       random_state=random)
+        assert np.allclose(rvs, rvs_prior)
+
+    @staticmethod
+    def _uniform_model():
+        m = elfi.ElfiModel()
+        elfi.Prior('uniform', 0, 1, model=m, name='a')
+        elfi.Prior('uniform', -1, 2, model=m, name='b')
+        return m
+
 
 def test_numgrad():
     assert np.allclose(numgrad(lambda x: np.log(x), 3), [1 / 3])
@@ -133,6 +279,21 @@ class TestModelPrior:
         prior = ModelPrior(ma2)
         distribution_test(prior)
 
+    def test_bounds(self, ma2):
+        m = elfi.ElfiModel()
+        a = elfi.Prior('uniform', 0, 2, model=m, name='a')
+        elfi.Prior('norm', 1, model=m, name='b')
+        lower, upper = ModelPrior(m).bounds
+        assert np.array_equal(lower, [0, -np.inf])
+        assert np.array_equal(upper, [2, np.inf])
+
+        # The support of dependent priors is not known
+        elfi.Prior('uniform', a, 1, model=m, name='c')
+        assert ModelPrior(m).bounds is None
+
+        # Nor the support of custom distributions
+        assert ModelPrior(ma2).bounds is None
+
     def test_pdf(self, ma2):
         prior = ModelPrior(ma2)
         rv = prior.rvs(size=10)
@@ -145,6 +306,46 @@ class TestModelPrior:
         assert grads.shape == rv.shape
         assert np.allclose(grads, 0)
 
+    def test_direct_evaluation(self):
+        m = elfi.ElfiModel()
+        a = elfi.Prior('uniform', 0, 2, model=m, name='a')
+        elfi.Prior('norm', a, 3, model=m, name='b')
+        prior = ModelPrior(m)
+        assert prior._terms is not None
+
+        x = np.array([[.5, 1.], [1.5, -2.], [3., 0.]])
+        logpdf = ss.uniform.logpdf(x[:, 0], 0, 2) + ss.norm.logpdf(x[:, 1], x[:, 0], 3)
+        assert np.allclose(prior.logpdf(x), logpdf)
+        assert np.allclose(prior.pdf(x), np.exp(logpdf))
+        assert np.isscalar(prior.logpdf(x[0]))
+
+        # Parents that are not constants or parameters are evaluated with the graph
+        b2 = elfi.Operation(lambda a: 2 * a, a, model=m, name='a2')
+        elfi.Prior('norm', b2, model=m, name='c')
+        prior = ModelPrior(m)
+        assert prior._terms is None
+        x = np.array([[.5, 1., 2.], [1.5, -2., 0.]])
+        logpdf = logpdf[:2] + ss.norm.logpdf(x[:, 2], 2 * x[:, 0])
+        assert np.allclose(prior.logpdf(x), logpdf)
+
+    def test_analytic_grad_logpdf(self):
+        m = elfi.ElfiModel()
+        priors = [('norm', 1, 2), ('gamma', 2, 0, 3), ('beta', 2, 3), ('t', 4, 1),
+                  ('lognorm', .5), ('expon', 1), ('uniform', -1, 2)]
+        for i, p in enumerate(priors):
+            elfi.Prior(*p, model=m, name='p{}'.format(i))
+        prior = ModelPrior(m)
+        assert prior._gradient_terms is not None
+
+        x = np.array([[.3, 2., .4, .5, 1.2, 1.5, .2], [-1, 5., .7, 2., .6, 3., -.5]])
+        grads = prior.gradient_logpdf(x)
+        for xi, grad in zip(x, grads):
+            assert np.allclose(grad, numgrad(prior.logpdf, xi), atol=1e-4)
+
+        # Zero outside the support
+        x[0, 2] = 2
+        assert np.all(prior.gradient_logpdf(x[0]) == 0)
+
     def test_numerical_grad_logpdf(self):
         # Test gradient with a normal distribution
         loc = 2.2